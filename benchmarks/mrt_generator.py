@@ -0,0 +1,264 @@
+""" Synthetic MRT file generator
+
+  Writes deterministic TABLE_DUMP_V2 RIB files and BGP4MP_MESSAGE_AS4 update files for benchmarks. The same
+  parameters and seed always produce the same file.
+
+  Usage: python benchmarks/mrt_generator.py [--prefixes N] [--peers N] ... <rib file> [<updates file>]
+"""
+import argparse
+import bz2
+import gzip
+import random
+import socket
+import struct
+
+# MRT types and subtypes (RFC 6396).
+TABLE_DUMP_V2 = 13
+PEER_INDEX_TABLE = 1
+RIB_IPV4_UNICAST = 2
+RIB_IPV6_UNICAST = 4
+BGP4MP = 16
+BGP4MP_MESSAGE_AS4 = 4
+
+# BGP path attribute flags.
+ATTR_FLAG_OPTIONAL = 0x80
+ATTR_FLAG_TRANSITIVE = 0x40
+ATTR_FLAG_EXTENDED_LENGTH = 0x10
+
+RIB_TIMESTAMP = 1587117288
+
+
+def createMrtRecord(ts, msg_type, msg_subtype, body):
+    return struct.pack('!I H H I', ts, msg_type, msg_subtype, len(body)) + body
+
+
+def createAttribute(flag, type_code, value):
+    if len(value) > 255:
+        return struct.pack('!B B H', flag | ATTR_FLAG_EXTENDED_LENGTH, type_code, len(value)) + value
+
+    return struct.pack('!B B B', flag, type_code, len(value)) + value
+
+
+def createPrefix(address, prefix_len):
+    """ Prefix length and prefix bytes, host bits of the last byte cleared """
+    prefix = bytearray(address[:(prefix_len + 7) // 8])
+
+    if prefix_len % 8:
+        prefix[-1] &= 0xff << (8 - prefix_len % 8) & 0xff
+
+    return struct.pack('!B', prefix_len) + bytes(prefix)
+
+
+def createPeers(peers, ipv6_peers):
+    """ List of (address, asn, bgp id) of the peers, IPv4 peers first """
+    peer_list = [('192.0.2.%d' % (i % 250 + 1) if i < 250 else '198.51.100.%d' % (i % 250 + 1),
+                  64512 + i, '10.1.%d.%d' % (i // 250, i % 250 + 1)) for i in range(peers)]
+
+    peer_list += [('2001:db8::%x' % (i + 1), 65000 + i, '10.2.%d.%d' % (i // 250, i % 250 + 1))
+                  for i in range(ipv6_peers)]
+
+    return peer_list
+
+
+def createPeerIndexTable(peer_list):
+    body = socket.inet_aton('10.0.0.1') + struct.pack('!H', 9) + b'benchmark' + struct.pack('!H', len(peer_list))
+
+    for address, asn, bgp_id in peer_list:
+        is_ipv6 = ':' in address
+
+        # Peer type: AS number size 4 and address family.
+        body += struct.pack('!B', 2 | (1 if is_ipv6 else 0)) + socket.inet_aton(bgp_id)
+        body += socket.inet_pton(socket.AF_INET6 if is_ipv6 else socket.AF_INET, address) + struct.pack('!I', asn)
+
+    return createMrtRecord(RIB_TIMESTAMP, TABLE_DUMP_V2, PEER_INDEX_TABLE, body)
+
+
+def createAttributeSets(r, count, as_path_length):
+    """ Distinct attribute sets without next hop, shared by prefixes as in real tables """
+    attribute_sets = []
+
+    for i in range(count):
+        as_path = [r.randint(1, 4199999999) for _ in range(as_path_length)]
+        as_path_segment = struct.pack('!B B', 2, len(as_path)) + struct.pack('!%dI' % len(as_path), *as_path)
+
+        communities = struct.pack('!%dI' % 4, *[r.getrandbits(32) for _ in range(4)])
+
+        attribute_sets.append(createAttribute(ATTR_FLAG_TRANSITIVE, 1, b'\x00') +
+                              createAttribute(ATTR_FLAG_TRANSITIVE, 2, as_path_segment) +
+                              createAttribute(ATTR_FLAG_OPTIONAL, 4, struct.pack('!I', i)) +
+                              createAttribute(ATTR_FLAG_OPTIONAL | ATTR_FLAG_TRANSITIVE, 8, communities))
+
+    return attribute_sets
+
+
+def generateRib(path, prefixes=100000, peers=20, ipv6_ratio=0.2, attribute_sets=1000, as_path_length=5,
+                peer_coverage=0.8, seed=1, compression=None):
+    """ Write a TABLE_DUMP_V2 RIB file
+
+        :param path:            Output file
+        :param prefixes:        Number of RIB records (prefixes)
+        :param peers:           Number of peers, IPv6 prefixes are announced by a share of ipv6_ratio of them
+        :param ipv6_ratio:      Share of IPv6 prefixes
+        :param attribute_sets:  Number of distinct path attribute sets (attribute diversity)
+        :param as_path_length:  Number of ASNs in the AS path
+        :param peer_coverage:   Probability of a peer to have a RIB entry for a prefix
+        :param seed:            Random seed
+        :param compression:     None, 'gz' or 'bz2'
+
+        :return: Number of records and uncompressed size in bytes
+    """
+    r = random.Random(seed)
+
+    ipv6_peers = max(1, int(peers * ipv6_ratio)) if ipv6_ratio > 0 else 0
+    peer_list = createPeers(peers, ipv6_peers)
+    attribute_list = createAttributeSets(r, attribute_sets, as_path_length)
+
+    records = [createPeerIndexTable(peer_list)]
+
+    # Prefixes drawn so far by subtype, a prefix has only one record in a RIB.
+    drawn_prefixes = {RIB_IPV4_UNICAST: set(), RIB_IPV6_UNICAST: set()}
+
+    for seq in range(prefixes):
+        entries = []
+
+        if r.random() < ipv6_ratio:
+            subtype = RIB_IPV6_UNICAST
+
+            # Global unicast 2000::/3, every prefix length has at least 2^29 distinct prefixes.
+            prefix = None
+            while prefix is None or prefix in drawn_prefixes[subtype]:
+                prefix = createPrefix((1 << 125 | r.getrandbits(125)).to_bytes(16, 'big'), r.choice([32, 40, 48]))
+
+            for peer_index in range(peers, peers + ipv6_peers):
+                if r.random() < peer_coverage:
+                    # MP_REACH_NLRI in RIB entries only holds the next hop (RFC 6396 4.3.4).
+                    next_hop = socket.inet_pton(socket.AF_INET6, peer_list[peer_index][0])
+                    attributes = r.choice(attribute_list) + createAttribute(ATTR_FLAG_OPTIONAL, 14,
+                                                                            b'\x10' + next_hop)
+                    entries.append(struct.pack('!H I H', peer_index, RIB_TIMESTAMP, len(attributes)) + attributes)
+
+        else:
+            subtype = RIB_IPV4_UNICAST
+
+            prefix = None
+            while prefix is None or prefix in drawn_prefixes[subtype]:
+                prefix = createPrefix(struct.pack('!I', r.randint(0x01000000, 0xDFFFFFFF)), r.choice([16, 20, 22, 24]))
+
+            for peer_index in range(peers):
+                if r.random() < peer_coverage:
+                    next_hop = socket.inet_aton(peer_list[peer_index][0])
+                    attributes = r.choice(attribute_list) + createAttribute(ATTR_FLAG_TRANSITIVE, 3, next_hop)
+                    entries.append(struct.pack('!H I H', peer_index, RIB_TIMESTAMP, len(attributes)) + attributes)
+
+        drawn_prefixes[subtype].add(prefix)
+
+        body = struct.pack('!I', seq) + prefix + struct.pack('!H', len(entries)) + b''.join(entries)
+        records.append(createMrtRecord(RIB_TIMESTAMP, TABLE_DUMP_V2, subtype, body))
+
+    return writeMrtFile(path, records, compression)
+
+
+def createBgpUpdate(withdrawn_routes, path_attributes, nlri):
+    body = struct.pack('!H', len(withdrawn_routes)) + withdrawn_routes + struct.pack('!H', len(path_attributes)) + \
+        path_attributes + nlri
+
+    return b'\xff' * 16 + struct.pack('!H B', 19 + len(body), 2) + body
+
+
+def generateUpdates(path, messages=100000, peers=20, prefix_pool=10000, prefixes_per_update=3,
+                    withdraw_ratio=0.3, as_path_length=5, seed=2, compression=None):
+    """ Write a BGP4MP_MESSAGE_AS4 update file of IPv4 peers
+
+        :param path:                Output file
+        :param messages:            Number of BGP UPDATE records
+        :param peers:               Number of peers, the first peers of the RIB peer index table
+        :param prefix_pool:         Number of distinct prefixes updated
+        :param prefixes_per_update: Number of prefixes per UPDATE
+        :param withdraw_ratio:      Share of withdrawing UPDATEs
+        :param as_path_length:      Number of ASNs in the AS path
+        :param seed:                Random seed
+        :param compression:         None, 'gz' or 'bz2'
+
+        :return: Number of records and uncompressed size in bytes
+    """
+    r = random.Random(seed)
+
+    peer_list = createPeers(peers, 0)
+
+    # Distinct prefixes in draw order, the set is for the lookups.
+    pool = []
+    pool_prefixes = set()
+
+    while len(pool) < prefix_pool:
+        prefix = createPrefix(struct.pack('!I', r.randint(0x01000000, 0xDFFFFFFF)), 24)
+
+        if prefix not in pool_prefixes:
+            pool.append(prefix)
+            pool_prefixes.add(prefix)
+
+    records = []
+
+    for i in range(messages):
+        address, asn, bgp_id = peer_list[r.randrange(peers)]
+        peer_address = socket.inet_aton(address)
+        nlri = b''.join(r.sample(pool, prefixes_per_update))
+
+        if r.random() < withdraw_ratio:
+            update = createBgpUpdate(nlri, b'', b'')
+
+        else:
+            as_path = [asn] + [r.randint(1, 4199999999) for _ in range(as_path_length - 1)]
+            as_path_segment = struct.pack('!B B', 2, len(as_path)) + struct.pack('!%dI' % len(as_path), *as_path)
+
+            attributes = createAttribute(ATTR_FLAG_TRANSITIVE, 1, b'\x00') + \
+                createAttribute(ATTR_FLAG_TRANSITIVE, 2, as_path_segment) + \
+                createAttribute(ATTR_FLAG_TRANSITIVE, 3, peer_address)
+
+            update = createBgpUpdate(b'', attributes, nlri)
+
+        body = struct.pack('!I I H H', asn, 64511, 0, 1) + peer_address + socket.inet_aton('10.0.0.1') + update
+        records.append(createMrtRecord(RIB_TIMESTAMP + 600 + i // 100, BGP4MP, BGP4MP_MESSAGE_AS4, body))
+
+    return writeMrtFile(path, records, compression)
+
+
+def writeMrtFile(path, records, compression=None):
+    data = b''.join(records)
+
+    if compression == 'gz':
+        f = gzip.open(path, 'wb', compresslevel=6)
+    elif compression == 'bz2':
+        f = bz2.open(path, 'wb')
+    else:
+        f = open(path, 'wb')
+
+    with f:
+        f.write(data)
+
+    return len(records), len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic MRT files')
+    parser.add_argument('rib_file')
+    parser.add_argument('updates_file', nargs='?')
+    parser.add_argument('--prefixes', type=int, default=100000)
+    parser.add_argument('--peers', type=int, default=20)
+    parser.add_argument('--ipv6-ratio', type=float, default=0.2)
+    parser.add_argument('--attribute-sets', type=int, default=1000)
+    parser.add_argument('--updates', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--compression', choices=['gz', 'bz2'])
+    args = parser.parse_args()
+
+    print("%s: %d records, %d bytes" % ((args.rib_file,) + generateRib(
+        args.rib_file, args.prefixes, args.peers, args.ipv6_ratio, args.attribute_sets, seed=args.seed,
+        compression=args.compression)))
+
+    if args.updates_file:
+        print("%s: %d records, %d bytes" % ((args.updates_file,) + generateUpdates(
+            args.updates_file, args.updates, args.peers, seed=args.seed + 1, compression=args.compression)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+""" Benchmark harness
+
+  Generates synthetic MRT files and times the pipeline stages on them:
+
+    parse_rib           MrtParser decoding all RIB records and attributes
+    parse_rib_raw       MrtParser in raw_only mode, as used for RIB conversion
+    parse_updates       MrtParser decoding the update file
+    rib_processor       RibProcessor packing RIB prefixes into route monitoring messages
+    update_processor    UpdateProcessor converting BGP4MP messages
+    end_to_end          RouterProcessor and BMPWriter delivering to a local dummy TCP collector
+
+  Every stage runs in a fresh process. The peak RSS is reset when the stage starts on Linux, a spawned process
+  otherwise reports the peak RSS of the parent generating the files. Results are written as JSON.
+
+  Usage: python benchmarks/run_benchmarks.py [--prefixes N] [--updates N] [--output report.json] ...
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mrt_generator
+
+ROUTER_NAME = 'benchmark'
+RIB_FILE_NAME = 'rib.2020-04-17.09:54:48.mrt'
+UPDATES_FILE_NAME = 'updates.2020-04-17.10:00:00.mrt'
+
+STAGES = ('parse_rib', 'parse_rib_raw', 'parse_updates', 'rib_processor', 'update_processor', 'end_to_end')
+
+
+class CountingQueue():
+    """ Forward queue counting the messages put, optionally passing them on to another queue """
+
+    def __init__(self, next_queue=None):
+        self._next_queue = next_queue
+        self.messages = 0
+        self.bytes = 0
+
+    def put(self, qm, block=True, timeout=None):
+        self.messages += 1
+        self.bytes += len(qm)
+
+        if self._next_queue is not None:
+            self._next_queue.put(qm)
+
+    def qsize(self):
+        return self._next_queue.qsize() if self._next_queue is not None else 0
+
+
+class DummyCollector(threading.Thread):
+    """ TCP server discarding everything it receives and counting the bytes """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(5)
+
+        self.port = self._sock.getsockname()[1]
+        self.bytes = 0
+
+    def run(self):
+        while True:
+            conn, _ = self._sock.accept()
+
+            while True:
+                data = conn.recv(1 << 20)
+                if not data:
+                    break
+
+                self.bytes += len(data)
+
+
+def getRouterConfig(args):
+    return {'timestamp_interval_limit': 20, 'ignore_timestamp_interval_abnormality': True,
+            'max_queue_size': args['max_queue_size'], 'rib_max_buckets': args['rib_max_buckets'],
+            'rib_max_bucket_memory': args['rib_max_bucket_memory'] * 1024 * 1024,
+            'rib_workers': args['rib_workers'], 'rib_chunk_records': args['rib_chunk_records'],
+            'extended_messages': args['extended_messages'], 'forward_queue_type': args['forward_queue_type'],
+            'forward_queue_bytes': args['forward_queue_bytes'] * 1024 * 1024, 'checkpoint_interval': 0}
+
+
+def runParse(path, raw_only=False):
+    from mrt2bmp.MrtParser import MrtParser
+
+    records = 0
+    size = 0
+
+    start = time.monotonic()
+
+    for m in MrtParser(path, raw_only=raw_only):
+        records += 1
+        size += m.mrt_header.length + 12
+
+    return {'seconds': time.monotonic() - start, 'records': records, 'bytes': size}
+
+
+def runRibProcessor(data_dir, args):
+    from mrt2bmp.MrtProcessors import RibProcessor
+
+    fwd_queue = CountingQueue()
+
+    start = time.monotonic()
+
+    rp = RibProcessor(RIB_FILE_NAME, data_dir, ROUTER_NAME, '10.0.0.1', fwd_queue, queue.Queue(), None,
+                      getRouterConfig(args))
+    rp.processRibFile()
+
+    return {'seconds': time.monotonic() - start, 'messages': fwd_queue.messages, 'message_bytes': fwd_queue.bytes}
+
+
+def runUpdateProcessor(data_dir, args):
+    from mrt2bmp.MrtProcessors import RibProcessor, UpdateProcessor
+
+    # Writes router_pit.json the update processor looks up the peers in.
+    RibProcessor(RIB_FILE_NAME, data_dir, ROUTER_NAME, '10.0.0.1', CountingQueue(), queue.Queue(), None,
+                 getRouterConfig(args))
+
+    fwd_queue = CountingQueue()
+
+    start = time.monotonic()
+
+    up = UpdateProcessor(UPDATES_FILE_NAME, data_dir, ROUTER_NAME, '10.0.0.1', fwd_queue, queue.Queue(),
+                         getRouterConfig(args))
+    up.processUpdateFile()
+
+    return {'seconds': time.monotonic() - start, 'messages': fwd_queue.messages, 'message_bytes': fwd_queue.bytes}
+
+
+def runEndToEnd(data_dir, args):
+    from mrt2bmp.CollectorSender import BMPWriter
+    from mrt2bmp.ForwardQueue import createForwardQueue
+    from mrt2bmp.MrtProcessors import RouterProcessor
+
+    # Processed files are deleted, work on a copy.
+    work_dir = tempfile.mkdtemp(dir=data_dir)
+    for file_name in (RIB_FILE_NAME, UPDATES_FILE_NAME):
+        shutil.copy(os.path.join(data_dir, file_name), work_dir)
+
+    collector = DummyCollector()
+    collector.start()
+
+    cfg = {'collector': {'host': '127.0.0.1', 'port': collector.port, 'delay_after_init_and_peer_ups': 0,
+                         'batch_max_messages': args['writer_batch_messages'],
+                         'batch_max_bytes': args['writer_batch_bytes'],
+                         'batch_flush_latency': args['writer_flush_latency'] / 1000.0},
+           'router_data': getRouterConfig(args)}
+
+    manager = multiprocessing.Manager()
+    log_queue = multiprocessing.Queue()
+    fwd_queue = createForwardQueue(cfg['router_data'], manager)
+
+    counting_queue = CountingQueue(fwd_queue)
+
+    start = time.monotonic()
+
+    rp = RouterProcessor(ROUTER_NAME, work_dir, counting_queue, log_queue, cfg['router_data'])
+    init_message = rp.getInitMessage()
+    peer_messages = rp.getPeerMessages()
+
+    writer = BMPWriter(cfg, fwd_queue, log_queue)
+    writer.setInitialMessages(init_message, peer_messages, rp.getTerminationMessage())
+    writer.start()
+
+    rp.processRouteView(True)
+
+    processed = time.monotonic() - start
+
+    # Wait until the collector received everything.
+    expected = len(init_message) + sum(len(m) for m in peer_messages) + counting_queue.bytes
+    while collector.bytes < expected and writer.is_alive():
+        time.sleep(0.01)
+
+    result = {'seconds': time.monotonic() - start, 'processing_seconds': processed,
+              'messages': counting_queue.messages, 'message_bytes': counting_queue.bytes,
+              'collector_bytes': collector.bytes}
+
+    writer.terminate()
+    writer.join()
+    manager.shutdown()
+
+    if cfg['router_data']['forward_queue_type'] == 'shm':
+        fwd_queue.unlink()
+
+    return result
+
+
+def resetPeakRss():
+    """ Reset the peak RSS of the process, the peak is inherited from the parent process on fork and exec
+
+        :return: True if reset, False where /proc/self/clear_refs is not available
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+
+        return True
+
+    except OSError:
+        return False
+
+
+def getPeakRssMb(peak_reset):
+    """ Peak RSS in MB since resetPeakRss(), else since the process started """
+    if peak_reset:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+
+    # ru_maxrss is in KB on Linux, bytes on macOS.
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1048576.0
+
+
+def runStage(stage, data_dir, args, files, conn):
+    """ Run a stage and send the result through the pipe, executed in a fresh process """
+    peak_reset = resetPeakRss()
+
+    rib_path = os.path.join(data_dir, RIB_FILE_NAME)
+    updates_path = os.path.join(data_dir, UPDATES_FILE_NAME)
+
+    if stage == 'parse_rib':
+        result = runParse(rib_path)
+    elif stage == 'parse_rib_raw':
+        result = runParse(rib_path, True)
+    elif stage == 'parse_updates':
+        result = runParse(updates_path)
+    elif stage == 'rib_processor':
+        result = runRibProcessor(data_dir, args)
+    elif stage == 'update_processor':
+        result = runUpdateProcessor(data_dir, args)
+    else:
+        result = runEndToEnd(data_dir, args)
+
+    # MRT input of the stage.
+    if 'records' not in result:
+        inputs = [files['updates']] if stage == 'update_processor' else \
+            [files['rib']] if stage == 'rib_processor' else [files['rib'], files['updates']]
+        result['records'] = sum(f['records'] for f in inputs)
+        result['bytes'] = sum(f['bytes'] for f in inputs)
+
+    scale = 1 if sys.platform == 'darwin' else 1024
+    result['peak_rss_mb'] = getPeakRssMb(peak_reset)
+    result['peak_children_rss_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 1048576.0
+
+    conn.send(result)
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the MRT to BMP pipeline on synthetic MRT files')
+    parser.add_argument('--prefixes', type=int, default=100000, help='RIB records')
+    parser.add_argument('--peers', type=int, default=20)
+    parser.add_argument('--ipv6-ratio', type=float, default=0.2)
+    parser.add_argument('--attribute-sets', type=int, default=1000, help='distinct path attribute sets')
+    parser.add_argument('--updates', type=int, default=100000, help='BGP4MP update records')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--compression', choices=['gz', 'bz2'])
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma separated stages to run')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per stage, the fastest is reported')
+    parser.add_argument('--rib-workers', type=int, default=1)
+    parser.add_argument('--rib-chunk-records', type=int, default=10000)
+    parser.add_argument('--rib-max-buckets', type=int, default=100000)
+    parser.add_argument('--rib-max-bucket-memory', type=int, default=256, help='MB')
+    parser.add_argument('--extended-messages', action='store_true')
+    parser.add_argument('--forward-queue-type', choices=['manager', 'shm'], default='manager')
+    parser.add_argument('--forward-queue-bytes', type=int, default=64, help='MB')
+    parser.add_argument('--max-queue-size', type=int, default=10000)
+    parser.add_argument('--writer-batch-messages', type=int, default=1000)
+    parser.add_argument('--writer-batch-bytes', type=int, default=1048576)
+    parser.add_argument('--writer-flush-latency', type=int, default=10, help='ms')
+    parser.add_argument('--data-dir', help='directory for the generated files, temporary if not set')
+    parser.add_argument('--output', default='benchmark_report.json')
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='mrt2bmp-benchmark-')
+    os.makedirs(data_dir, exist_ok=True)
+
+    print("Generating MRT files in %s" % data_dir)
+    rib_records, rib_bytes = mrt_generator.generateRib(os.path.join(data_dir, RIB_FILE_NAME), args.prefixes,
+                                                       args.peers, args.ipv6_ratio, args.attribute_sets,
+                                                       seed=args.seed, compression=args.compression)
+    updates_records, updates_bytes = mrt_generator.generateUpdates(os.path.join(data_dir, UPDATES_FILE_NAME),
+                                                                   args.updates, args.peers, seed=args.seed + 1,
+                                                                   compression=args.compression)
+
+    files = {'rib': {'records': rib_records, 'bytes': rib_bytes,
+                     'file_bytes': os.path.getsize(os.path.join(data_dir, RIB_FILE_NAME))},
+             'updates': {'records': updates_records, 'bytes': updates_bytes,
+                         'file_bytes': os.path.getsize(os.path.join(data_dir, UPDATES_FILE_NAME))}}
+
+    ctx = multiprocessing.get_context('spawn')
+    stage_args = vars(args)
+    results = {}
+
+    for stage in args.stages.split(','):
+        if stage not in STAGES:
+            parser.error("unknown stage %s" % stage)
+
+        runs = []
+        exitcode = None
+
+        for i in range(args.repeat):
+            # Fresh directory state, router_pit.json decides which peer messages are generated.
+            pit_path = os.path.join(data_dir, 'router_pit.json')
+            if os.path.exists(pit_path):
+                os.remove(pit_path)
+
+            parent_conn, child_conn = ctx.Pipe(False)
+            p = ctx.Process(target=runStage, args=(stage, data_dir, stage_args, files, child_conn))
+            p.start()
+
+            # Only the child holds the write end, recv() fails once it ends without a result.
+            child_conn.close()
+
+            try:
+                runs.append(parent_conn.recv())
+
+            except EOFError:
+                pass
+
+            parent_conn.close()
+            p.join()
+
+            if p.exitcode:
+                exitcode = p.exitcode
+                break
+
+        if exitcode is not None or not runs:
+            results[stage] = {'failed': True, 'exitcode': exitcode}
+            print("%-17s failed with exit code %s" % (stage, exitcode))
+            continue
+
+        result = min(runs, key=lambda r: r['seconds'])
+        result['records_per_sec'] = result['records'] / result['seconds']
+        result['mb_per_sec'] = result['bytes'] / 1048576.0 / result['seconds']
+        results[stage] = result
+
+        print("%-17s %8.2f s %12.0f records/s %8.2f MB/s %8.1f MB peak RSS" % (
+            stage, result['seconds'], result['records_per_sec'], result['mb_per_sec'], result['peak_rss_mb']))
+
+    report = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              'python': sys.version.split()[0], 'platform': platform.platform(), 'cpus': os.cpu_count(),
+              'parameters': stage_args, 'files': files, 'results': results}
+
+    with open(args.output, 'w') as fp:
+        json.dump(report, fp, sort_keys=True, indent=4)
+
+    print("Report written to %s" % args.output)
+
+    if not args.data_dir:
+        shutil.rmtree(data_dir)
+
+
+if __name__ == '__main__':
+    main()
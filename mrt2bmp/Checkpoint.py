@@ -0,0 +1,127 @@
+""" Checkpoint journal
+
+  Records the MRT file in progress and the offset of the first record whose BMP messages may not have been
+  written to the collector yet, so processing of the file resumes there after a restart.
+
+  Processors put checkpoint messages into the forward queue in order with the BMP messages. The BMP writer
+  does not send them, it saves them to the journal once all messages queued before have been written.
+  Promote messages work the same way for files only valid once the messages before are written, like the
+  RIB delta fingerprint: the writer renames the pending file to its final path.
+"""
+import json
+import os
+
+# Journal file name in the router working directory, next to router_pit.json.
+JOURNAL_FILE_NAME = 'router_checkpoint.json'
+
+# Prefix of checkpoint messages. BMP messages start with the version (3), checkpoint messages with zero.
+CHECKPOINT_MESSAGE_MARKER = b'\x00MRT2BMP-CHECKPOINT\x00'
+
+
+def createCheckpointMessage(journal_path, file_name, offset):
+    """ Create a checkpoint message for the forward queue
+
+        :param journal_path:    Path of the journal file
+        :param file_name:       Name of the MRT file
+        :param offset:          Offset of the next record in the uncompressed file
+
+        :return: Checkpoint message
+    """
+    return CHECKPOINT_MESSAGE_MARKER + json.dumps({'journal': journal_path, 'file': file_name,
+                                                   'offset': offset}).encode()
+
+
+def createPromoteMessage(pending_path, path):
+    """ Create a message renaming a pending file once the messages queued before have been written
+
+        :param pending_path:    Path of the pending file
+        :param path:            Path the pending file is renamed to
+
+        :return: Promote message, a checkpoint message for the forward queue
+    """
+    return CHECKPOINT_MESSAGE_MARKER + json.dumps({'promote': pending_path, 'path': path}).encode()
+
+
+def isCheckpointMessage(qm):
+    return qm[0] == 0 and qm.startswith(CHECKPOINT_MESSAGE_MARKER)
+
+
+def parseCheckpointMessage(qm):
+    """ Parse a checkpoint message
+
+        :return: Dictionary with journal, file and offset, or with promote and path for a promote message
+    """
+    return json.loads(bytes(qm[len(CHECKPOINT_MESSAGE_MARKER):]).decode())
+
+
+def promoteFile(pending_path, path):
+    """ Rename a pending file to its path, a file already promoted or superseded is skipped
+
+        :return: True if renamed
+    """
+    try:
+        os.replace(pending_path, path)
+        return True
+
+    except FileNotFoundError:
+        return False
+
+
+class CheckpointJournal():
+    """ Journal file holding the last checkpoint of a router """
+
+    def __init__(self, path):
+        """ Constructor
+
+            :param path:        Path of the journal file
+        """
+        self._path = path
+
+    def load(self):
+        """ Load the checkpoint
+
+            :return: Dictionary with file and offset, None if there is no valid journal
+        """
+        try:
+            with open(self._path) as data_file:
+                checkpoint = json.load(data_file)
+
+            if isinstance(checkpoint.get('file'), str) and isinstance(checkpoint.get('offset'), int):
+                return checkpoint
+
+        except (OSError, ValueError, AttributeError):
+            pass
+
+        return None
+
+    def getOffset(self, file_name):
+        """ Offset to resume the file at
+
+            :param file_name:   Name of the MRT file
+
+            :return: Offset of the checkpoint if it is for the file, else 0
+        """
+        checkpoint = self.load()
+
+        if checkpoint is not None and checkpoint['file'] == file_name:
+            return checkpoint['offset']
+
+        return 0
+
+    def save(self, file_name, offset):
+        """ Save the checkpoint
+
+            The journal is written to a temporary file which replaces the journal, so a crash leaves either
+            the previous or the new checkpoint.
+
+            :param file_name:   Name of the MRT file
+            :param offset:      Offset of the next record in the uncompressed file
+        """
+        tmp_path = self._path + '.tmp'
+
+        with open(tmp_path, 'w') as data_file:
+            json.dump({'file': file_name, 'offset': offset}, data_file)
+            data_file.flush()
+            os.fsync(data_file.fileno())
+
+        os.replace(tmp_path, self._path)
@@ -8,13 +8,23 @@
 
   .. moduleauthor:: Tim Evens <tievens@cisco.com>
 """
+import asyncio
+import collections
+import concurrent.futures
 import socket
 import multiprocessing
+import threading
 import time
 import queue
 
 from time import sleep
 from mrt2bmp.logger import init_mp_logger
+from mrt2bmp.Metrics import METRICS
+from mrt2bmp.Checkpoint import CheckpointJournal, isCheckpointMessage, parseCheckpointMessage, promoteFile
+
+# Min and max delay in seconds between two reconnect attempts of the asyncio writer, doubled on every failure.
+RECONNECT_BACKOFF_MIN = 1
+RECONNECT_BACKOFF_MAX = 60
 
 class BMPWriter(multiprocessing.Process):
     """ BMP Writer
@@ -36,6 +46,9 @@ class BMPWriter(multiprocessing.Process):
         self.term_message = None
         self.peer_up_messages = None
 
+        # Initial messages set after the writer process is started, used from the next connect on.
+        self._initial_messages_queue = multiprocessing.Queue()
+
         self._cfg = cfg
         self._fwd_queue = forward_queue
         self._log_queue = log_queue
@@ -43,6 +56,11 @@ class BMPWriter(multiprocessing.Process):
         self._isConnected = False
         self._delay_after_peer_ups = self._cfg['collector']['delay_after_init_and_peer_ups']
 
+        # Batching of queued messages into a single socket write.
+        self._batch_max_messages = self._cfg['collector'].get('batch_max_messages', 1)
+        self._batch_max_bytes = self._cfg['collector'].get('batch_max_bytes', 0)
+        self._batch_flush_latency = self._cfg['collector'].get('batch_flush_latency', 0)
+
         self._sock = None
 
     def run(self):
@@ -60,27 +78,117 @@ class BMPWriter(multiprocessing.Process):
                 # Do not pop any message unless connected
                 if self._isConnected:
 
-                    qm = self._fwd_queue.get()
+                    batch = self.readBatch()
+
+                    # Checkpoint messages are not sent, they are saved once the messages before are sent.
+                    checkpoints = [qm for qm in batch if isCheckpointMessage(qm)]
+                    if checkpoints:
+                        batch = [qm for qm in batch if not isCheckpointMessage(qm)]
+
+                    if batch:
+                        qm = b"".join(batch)
 
-                    sent = False
-                    while not sent:
-                        sent = self.send(qm)
+                        start = time.monotonic()
+
+                        sent = False
+                        while not sent:
+                            sent = self.send(qm)
+
+                        METRICS.observe('writer_send_seconds', time.monotonic() - start)
+                        METRICS.inc('writer_messages_sent_total', len(batch))
+                        METRICS.inc('writer_bytes_sent_total', len(qm))
+
+                    if checkpoints:
+                        self.saveCheckpoints(checkpoints)
 
                 else:
                     self.LOG.info("Not connected, attempting to reconnect")
+                    METRICS.inc('writer_reconnects_total')
                     sleep(1)
                     self.connect()
 
+                METRICS.flush()
+
         except (KeyboardInterrupt, IOError, EOFError):
             pass
 
         self.LOG.info("rewrite stopped")
 
+    def readBatch(self):
+        """ Read a batch of messages from the forward queue
+
+            Blocks up to a second for the first message, then collects more messages until the batch has
+            max messages or max bytes, or the flush latency after the first message has passed.
+
+            :return: List of messages, empty if no message was queued
+        """
+        batch = []
+
+        try:
+            qm = self._fwd_queue.get(True, 1)
+
+        except queue.Empty:
+            return batch
+
+        batch.append(qm)
+        batch_bytes = len(qm)
+        deadline = time.monotonic() + self._batch_flush_latency
+
+        while len(batch) < self._batch_max_messages and \
+                (not self._batch_max_bytes or batch_bytes < self._batch_max_bytes):
+
+            try:
+                remaining = deadline - time.monotonic()
+
+                if remaining > 0:
+                    qm = self._fwd_queue.get(True, remaining)
+                else:
+                    qm = self._fwd_queue.get_nowait()
+
+            except queue.Empty:
+                break
+
+            batch.append(qm)
+            batch_bytes += len(qm)
+
+        return batch
+
+    def saveCheckpoints(self, checkpoints):
+        """ Save the last checkpoint of each journal and promote the pending files
+
+            :param checkpoints:     List of checkpoint messages in queue order
+        """
+        last = {}
+
+        for qm in checkpoints:
+            checkpoint = parseCheckpointMessage(qm)
+
+            if 'promote' in checkpoint:
+                try:
+                    if promoteFile(checkpoint['promote'], checkpoint['path']):
+                        self.LOG.debug("Promoted %s", checkpoint['path'])
+
+                except OSError as e:
+                    self.LOG.error("Failed to promote %s: %r", checkpoint['promote'], e)
+
+            else:
+                last[checkpoint['journal']] = checkpoint
+
+        for journal_path, checkpoint in last.items():
+            try:
+                CheckpointJournal(journal_path).save(checkpoint['file'], checkpoint['offset'])
+                self.LOG.debug("Saved checkpoint %s:%d", checkpoint['file'], checkpoint['offset'])
+
+            except OSError as e:
+                self.LOG.error("Failed to save checkpoint to %s: %r", journal_path, e)
+
     def connect(self):
         """ Connect to remote collector
 
         :return: True if connected, False otherwise/error
         """
+        self.loadInitialMessages()
+
         try:
             self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self._sock.connect((self._cfg['collector']['host'], self._cfg['collector']['port']))
@@ -128,6 +236,7 @@ class BMPWriter(multiprocessing.Process):
         except socket.error as msg:
             self.LOG.error("Failed to send message to collector: %r", msg)
             self.disconnect()
+            METRICS.inc('writer_reconnects_total')
             sleep(1)
             self.connect()
 
@@ -154,6 +263,20 @@ class BMPWriter(multiprocessing.Process):
         self.peer_up_messages = peer_up_message_list
         self.term_message = term_message
 
+        # The writer process has its own copy, pass the messages on if it is running.
+        if self.pid is not None:
+            self._initial_messages_queue.put((init_message, peer_up_message_list, term_message))
+
+    def loadInitialMessages(self):
+        """ Use the latest initial messages set after the writer process was started """
+        try:
+            while True:
+                self.init_message, self.peer_up_messages, self.term_message = \
+                    self._initial_messages_queue.get_nowait()
+
+        except queue.Empty:
+            pass
+
     def isConnected(self):
         return self._isConnected
 
@@ -165,3 +288,237 @@ class BMPWriter(multiprocessing.Process):
 
     def stopped(self):
         return self._stop.is_set()
+
+
+class AsyncBMPWriter(BMPWriter):
+    """ BMP writer sending with asyncio streams
+
+        A thread reads batches from the forward queue into a send buffer bounded in bytes, so the producers
+        are only blocked once the buffer is full. The event loop writes the buffer to the collector with
+        drain() flow control. Connects and writes have timeouts, failed connections are retried with
+        exponential backoff and INIT and PEER UP messages are replayed after every connect while the
+        buffer keeps filling.
+    """
+
+    def __init__(self, cfg, forward_queue, log_queue):
+        """ Constructor
+
+            :param cfg:             Configuration dictionary
+            :param forward_queue:   Output for BMP raw message forwarding
+            :param log_queue:       Logging queue - sync logging
+        """
+        BMPWriter.__init__(self, cfg, forward_queue, log_queue)
+
+        self._connect_timeout = self._cfg['collector'].get('connect_timeout', 5)
+        self._write_timeout = self._cfg['collector'].get('write_timeout', 30)
+        self._max_buffer_bytes = self._cfg['collector'].get('send_buffer_bytes', 16777216)
+
+        self._loop = None
+        self._writer = None
+
+        # Batches of (data, number of messages, checkpoint messages) waiting to be sent and their size.
+        self._buffer = collections.deque()
+        self._buffer_bytes = 0
+        self._buffer_changed = None
+
+    def run(self):
+        """ Override """
+        self.LOG = init_mp_logger("bmp_writer", self._log_queue)
+
+        self.LOG.info("Running asyncio bmp_writer")
+
+        try:
+            asyncio.run(self.__run())
+
+        except KeyboardInterrupt:
+            pass
+
+        self.LOG.info("rewrite stopped")
+
+    async def __run(self):
+        self._loop = asyncio.get_running_loop()
+        self._buffer_changed = asyncio.Condition()
+
+        reader = threading.Thread(target=self.__readQueue, daemon=True)
+        reader.start()
+
+        backoff = RECONNECT_BACKOFF_MIN
+
+        while not self.stopped():
+
+            if self._writer is None:
+                start = time.monotonic()
+
+                if not await self.__connect():
+                    # Back off, but notice a stop within a second.
+                    deadline = time.monotonic() + backoff
+                    while not self.stopped() and time.monotonic() < deadline:
+                        await asyncio.sleep(min(1, deadline - time.monotonic()))
+
+                    backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+
+                    # Only failed connects and their back off are stalled, not the wait after the peer UPs.
+                    METRICS.inc('writer_stalled_seconds_total', time.monotonic() - start)
+
+                METRICS.flush()
+                continue
+
+            backoff = RECONNECT_BACKOFF_MIN
+
+            async with self._buffer_changed:
+                try:
+                    await asyncio.wait_for(self._buffer_changed.wait_for(lambda: self._buffer), 1)
+
+                except asyncio.TimeoutError:
+                    METRICS.flush()
+                    continue
+
+                # The batch stays in the buffer until it is sent, it is sent again after a reconnect.
+                data, messages, checkpoints = self._buffer[0]
+
+            if data:
+                start = time.monotonic()
+
+                if not await self.send(data):
+                    METRICS.inc('writer_stalled_seconds_total', time.monotonic() - start)
+                    continue
+
+                METRICS.observe('writer_send_seconds', time.monotonic() - start)
+                METRICS.inc('writer_messages_sent_total', messages)
+                METRICS.inc('writer_bytes_sent_total', len(data))
+
+            if checkpoints:
+                self.saveCheckpoints(checkpoints)
+
+            async with self._buffer_changed:
+                self._buffer.popleft()
+                self._buffer_bytes -= len(data)
+                self._buffer_changed.notify_all()
+
+            METRICS.set('writer_buffer_bytes', self._buffer_bytes)
+            METRICS.flush()
+
+        self.disconnect()
+
+        reader.join()
+
+    def __readQueue(self):
+        """ Read batches from the forward queue into the send buffer, runs in a thread """
+        try:
+            while not self.stopped():
+                batch = self.readBatch()
+
+                if batch:
+                    # Checkpoint messages are not sent, they are saved once the messages before are sent.
+                    checkpoints = [qm for qm in batch if isCheckpointMessage(qm)]
+                    if checkpoints:
+                        batch = [qm for qm in batch if not isCheckpointMessage(qm)]
+
+                    future = asyncio.run_coroutine_threadsafe(
+                        self.__bufferBatch(b"".join(batch), len(batch), checkpoints), self._loop)
+
+                    # Blocks while the buffer is full, wakes up every second to notice a stop.
+                    while not self.stopped():
+                        try:
+                            future.result(1)
+                            break
+
+                        except concurrent.futures.TimeoutError:
+                            continue
+
+                    future.cancel()
+
+        except (KeyboardInterrupt, IOError, EOFError, RuntimeError):
+            pass
+
+    async def __bufferBatch(self, data, messages, checkpoints):
+        async with self._buffer_changed:
+            await self._buffer_changed.wait_for(lambda: self._buffer_bytes < self._max_buffer_bytes)
+
+            self._buffer.append((data, messages, checkpoints))
+            self._buffer_bytes += len(data)
+            self._buffer_changed.notify_all()
+
+    async def __connect(self):
+        """ Connect to remote collector and send the INIT and PEER UP messages
+
+            :return: True if connected, False otherwise/error
+        """
+        host = self._cfg['collector']['host']
+        port = self._cfg['collector']['port']
+
+        self.loadInitialMessages()
+
+        try:
+            reader, self._writer = await asyncio.wait_for(asyncio.open_connection(host, port),
+                                                          self._connect_timeout)
+
+        except (OSError, asyncio.TimeoutError) as msg:
+            self.LOG.error("Failed to connect to remote collector: %r", msg)
+            METRICS.inc('writer_reconnects_total')
+            self._writer = None
+            return False
+
+        self._writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._isConnected = True
+        self.LOG.info("Connected to remote collector: %s:%d", host, port)
+
+        self.LOG.debug('BMP Send INIT and %d Peer-UP Messages', len(self.peer_up_messages))
+        if not await self.send(self.init_message + b"".join(self.peer_up_messages)):
+            return False
+
+        # Waits for specified time in config after INIT and PEER UP messages, the buffer keeps filling.
+        await asyncio.sleep(float(self._delay_after_peer_ups))
+
+        return True
+
+    async def send(self, msg):
+        """ Write to the collector and wait until the data is below the write buffer limit of the transport
+
+            :param msg:     Data to send/write
+
+            :return: True if sent, False if not sent within the write timeout or on error
+        """
+        try:
+            self._writer.write(msg)
+            await asyncio.wait_for(self._writer.drain(), self._write_timeout)
+
+            return True
+
+        except asyncio.TimeoutError:
+            self.LOG.error("Write to collector timed out after %d seconds", self._write_timeout)
+            METRICS.inc('writer_write_timeouts_total')
+
+        except OSError as msg:
+            self.LOG.error("Failed to send message to collector: %r", msg)
+
+        self.disconnect()
+        METRICS.inc('writer_reconnects_total')
+
+        return False
+
+    def disconnect(self):
+        """ Disconnect from remote collector """
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+            self.LOG.info("Connection is disconnected to remote collector: %s:%d", self._cfg['collector']['host'],
+                          self._cfg['collector']['port'])
+
+        self._isConnected = False
+
+
+def createBMPWriter(cfg, forward_queue, log_queue):
+    """ Create the BMP writer selected in the collector config
+
+        :param cfg:             Configuration dictionary, collector writer_mode is 'sync' or 'asyncio'
+        :param forward_queue:   Output for BMP raw message forwarding
+        :param log_queue:       Logging queue - sync logging
+
+        :return: BMPWriter or AsyncBMPWriter
+    """
+    if cfg['collector'].get('writer_mode', 'sync') == 'asyncio':
+        return AsyncBMPWriter(cfg, forward_queue, log_queue)
+
+    return BMPWriter(cfg, forward_queue, log_queue)
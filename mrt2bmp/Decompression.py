@@ -0,0 +1,284 @@
+""" Decompression of MRT files
+
+  Compressed MRT files are detected by their magic bytes and opened with the fastest available backend:
+
+    gzip    isal (python-isal) or zlib-ng (zlib-ng) if installed, else the gzip module
+    bz2     indexed_bzip2 (parallel) if installed, else the bz2 module
+    xz      lzma module
+    zstd    zstandard if installed, else compression.zstd of Python 3.14
+
+  Decompression runs in a background thread reading large chunks, the zlib/bz2/lzma C code releases the GIL
+  so inflating overlaps with parsing.
+"""
+import bz2
+import gzip
+import io
+import lzma
+import os
+import queue
+import threading
+
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+
+try:
+    from zlib_ng import gzip_ng
+except ImportError:
+    gzip_ng = None
+
+try:
+    import indexed_bzip2
+except ImportError:
+    indexed_bzip2 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+GZIP_HEADER = b'\x1f\x8b'
+BZ2_HEADER = b'\x42\x5a\x68'
+XZ_HEADER = b'\xfd\x37\x7a\x58\x5a\x00'
+ZSTD_HEADER = b'\x28\xb5\x2f\xfd'
+
+# Size of the chunks read from the decompressor and number of chunks decompressed ahead of the parser.
+PREFETCH_CHUNK_SIZE = 1048576
+PREFETCH_CHUNKS = 8
+
+
+def getCompression(file_path):
+    """ Compression of the file by its magic bytes
+
+        :return: 'gzip', 'bz2', 'xz', 'zstd' or None for an uncompressed file
+    """
+    with open(file_path, 'rb') as f:
+        file_header = f.read(max(len(GZIP_HEADER), len(BZ2_HEADER), len(XZ_HEADER), len(ZSTD_HEADER)))
+
+    if file_header.startswith(GZIP_HEADER):
+        return 'gzip'
+    elif file_header.startswith(BZ2_HEADER):
+        return 'bz2'
+    elif file_header.startswith(XZ_HEADER):
+        return 'xz'
+    elif file_header.startswith(ZSTD_HEADER):
+        return 'zstd'
+
+    return None
+
+
+def openDecompressor(file_path, compression, compressed_offset=0):
+    """ Open a decompressed stream of the file with the fastest available backend
+
+        :param file_path:           Compressed file
+        :param compression:         Compression returned by getCompression()
+        :param compressed_offset:   Offset of a gzip member to start decompressing at
+
+        :return: Binary file object of the decompressed data
+    """
+    if compressed_offset:
+        if compression != 'gzip':
+            raise ValueError("Only gzip files can be decompressed from an offset")
+
+        f = open(file_path, 'rb')
+        f.seek(compressed_offset)
+
+        if igzip is not None:
+            g = igzip.IGzipFile(fileobj=f, mode='rb')
+        elif gzip_ng is not None:
+            g = gzip_ng.GzipNGFile(fileobj=f, mode='rb')
+        else:
+            g = gzip.GzipFile(fileobj=f, mode='rb')
+
+        # GzipFile only closes the file object it opened itself, myfileobj.
+        g.myfileobj = f
+
+        return g
+
+    if compression == 'gzip':
+        if igzip is not None:
+            return igzip.open(file_path, 'rb')
+        elif gzip_ng is not None:
+            return gzip_ng.open(file_path, 'rb')
+
+        return gzip.GzipFile(file_path, 'rb')
+
+    elif compression == 'bz2':
+        if indexed_bzip2 is not None:
+            return indexed_bzip2.open(file_path, parallelization=os.cpu_count())
+
+        return bz2.BZ2File(file_path, 'rb')
+
+    elif compression == 'xz':
+        return lzma.LZMAFile(file_path, 'rb')
+
+    elif compression == 'zstd':
+        if zstandard is not None:
+            return zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True)
+        elif zstd is not None:
+            return zstd.ZstdFile(file_path, 'rb')
+
+        raise OSError("zstd compressed file %s needs the zstandard package" % file_path)
+
+    raise ValueError("Unknown compression %r" % compression)
+
+
+def openMrtFile(file_path, prefetch=None, compressed_offset=0):
+    """ Open an MRT file, plain or compressed
+
+        :param file_path:           MRT file
+        :param prefetch:            Decompress in a background thread; None to prefetch if there is more than
+                                    one CPU, on a single CPU the thread only adds switching overhead
+        :param compressed_offset:   Offset of a gzip member to start at, offsets of the returned file object
+                                    are relative to the start of the member
+
+        :return: Buffered binary file object of the uncompressed MRT records
+    """
+    compression = getCompression(file_path)
+
+    if compression is None:
+        return open(file_path, 'rb', buffering=PREFETCH_CHUNK_SIZE)
+
+    f = openDecompressor(file_path, compression, compressed_offset)
+
+    if prefetch is None:
+        prefetch = (os.cpu_count() or 1) > 1
+
+    if prefetch:
+        f = PrefetchReader(f)
+
+    return io.BufferedReader(f, PREFETCH_CHUNK_SIZE)
+
+
+class PrefetchReader(io.RawIOBase):
+    """ Raw reader of a decompressed stream filled by a background thread
+
+        The thread reads PREFETCH_CHUNK_SIZE chunks from the decompressor and queues up to PREFETCH_CHUNKS of
+        them, reads are served from the queued chunks. Only forward seeks are supported, they decompress up
+        to the offset.
+    """
+
+    def __init__(self, f, chunk_size=PREFETCH_CHUNK_SIZE, max_chunks=PREFETCH_CHUNKS):
+        """ Constructor
+
+            :param f:               Binary file object of the decompressed data
+            :param chunk_size:      Size of the chunks read from f
+            :param max_chunks:      Max number of chunks read ahead
+        """
+        io.RawIOBase.__init__(self)
+
+        self._f = f
+        self._chunk_size = chunk_size
+
+        self._chunks = queue.Queue(max_chunks)
+        self._stop = threading.Event()
+
+        # Current chunk, read position in it and offset in the stream.
+        self._chunk = memoryview(b"")
+        self._chunk_pos = 0
+        self._offset = 0
+        self._eof = False
+
+        self._thread = threading.Thread(target=self.__decompress, daemon=True)
+        self._thread.start()
+
+    def __decompress(self):
+        try:
+            while not self._stop.is_set():
+                data = self._f.read(self._chunk_size)
+
+                self.__queueChunk(data)
+
+                if not data:
+                    break
+
+        except Exception as e:
+            self.__queueChunk(e)
+
+    def __queueChunk(self, item):
+        while not self._stop.is_set():
+            try:
+                self._chunks.put(item, True, 0.1)
+                return
+
+            except queue.Full:
+                continue
+
+    def __nextChunk(self):
+        """ Make the next chunk current
+
+            :return: False at the end of the stream
+        """
+        if self._eof:
+            return False
+
+        item = self._chunks.get()
+
+        if isinstance(item, Exception):
+            self._eof = True
+            raise item
+
+        if not item:
+            self._eof = True
+            return False
+
+        self._chunk = memoryview(item)
+        self._chunk_pos = 0
+
+        return True
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        """ Read into the buffer from the current chunk
+
+            :return: Number of bytes read, less than len(b) at a chunk boundary, 0 at the end of the stream
+        """
+        if self._chunk_pos >= len(self._chunk) and not self.__nextChunk():
+            return 0
+
+        n = min(len(b), len(self._chunk) - self._chunk_pos)
+        b[:n] = self._chunk[self._chunk_pos:self._chunk_pos + n]
+
+        self._chunk_pos += n
+        self._offset += n
+
+        return n
+
+    def tell(self):
+        return self._offset
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._offset
+
+        if whence == io.SEEK_END or offset < self._offset:
+            raise io.UnsupportedOperation("Only forward seeks are supported on a decompressed stream")
+
+        while self._offset < offset:
+            if self._chunk_pos >= len(self._chunk) and not self.__nextChunk():
+                break
+
+            n = min(offset - self._offset, len(self._chunk) - self._chunk_pos)
+            self._chunk_pos += n
+            self._offset += n
+
+        return self._offset
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._f.close()
+
+        io.RawIOBase.close(self)
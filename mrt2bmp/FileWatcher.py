@@ -0,0 +1,211 @@
+""" MRT file watchers
+
+  Wake the route views processor when MRT files are written to the router data directories, instead
+  of rescanning them at a fixed interval.
+"""
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import select
+import struct
+import time
+
+from mrt2bmp.MrtIndex import INDEX_FILE_SUFFIX
+
+# inotify event masks and init flags, see inotify(7).
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event without the name: wd, mask, cookie, len.
+INOTIFY_EVENT_STRUCT = struct.Struct('iIII')
+
+# Names of MRT files, plain or compressed, e.g. rib.20161128.0800.bz2 or updates.2020-04-17.10:00:00.mrt.
+MRT_FILE_PATTERNS = ('*.mrt*', 'rib.*', 'bview.*', 'updates.*')
+
+# Interval in seconds between two directory listings of the polling watcher.
+POLL_INTERVAL = 1
+
+# Suffixes of files written next to the MRT files: indexes and temporary files of atomic writes.
+IGNORED_FILE_SUFFIXES = (INDEX_FILE_SUFFIX, '.tmp')
+
+
+def isMrtFile(name):
+    if name.endswith(IGNORED_FILE_SUFFIXES):
+        return False
+
+    return any(fnmatch.fnmatch(name, pattern) for pattern in MRT_FILE_PATTERNS)
+
+
+class PollingFileWatcher():
+    """ Watcher listing the directories every POLL_INTERVAL seconds
+
+        Used where inotify is not available, e.g. on network file systems or other platforms than Linux. A
+        file is only reported once its modification time and size are the same in two listings, so files
+        still being written are not picked up.
+    """
+
+    def __init__(self, directories):
+        """ Constructor
+
+            :param directories:     List of directories to watch
+        """
+        self._directories = directories
+        self._files = self.__listFiles()
+
+        # Modification time and size of the files when they were reported, files present at start are known.
+        self._reported = dict(self._files)
+
+    def __listFiles(self):
+        """ Modification time and size of the MRT files in the directories """
+        files = {}
+
+        for d in self._directories:
+            try:
+                for entry in os.scandir(d):
+                    if isMrtFile(entry.name):
+                        st = entry.stat()
+                        files[entry.path] = (st.st_mtime, st.st_size)
+            except OSError:
+                pass
+
+        return files
+
+    def wait(self, timeout):
+        """ Wait until an MRT file is added or changed
+
+            Changes since the previous call are reported once the file is unchanged in the next listing, so
+            files written while the caller was processing are not missed.
+
+            :param timeout:     Max time to wait in seconds
+
+            :return: True if an MRT file is added or changed, False if timed out
+        """
+        deadline = time.monotonic() + timeout
+
+        while True:
+            files = self.__listFiles()
+
+            # Files unchanged since the previous listing and not reported in this state yet.
+            stable = [path for path, stat in files.items()
+                      if self._files.get(path) == stat and self._reported.get(path) != stat]
+
+            self._reported = {path: files[path] if path in stable else stat
+                              for path, stat in self._reported.items() if path in files}
+            self._reported.update((path, files[path]) for path in stable)
+
+            self._files = files
+            changed = bool(stable)
+
+            remaining = deadline - time.monotonic()
+            if changed or remaining <= 0:
+                return changed
+
+            time.sleep(min(POLL_INTERVAL, remaining))
+
+    def close(self):
+        pass
+
+
+class InotifyFileWatcher():
+    """ Watcher woken by inotify IN_CLOSE_WRITE/IN_MOVED_TO events on MRT files
+
+        Events are queued by the kernel while the caller is processing, so the next wait() returns
+        immediately for files written in the meantime.
+    """
+
+    def __init__(self, directories):
+        """ Constructor
+
+            :param directories:     List of directories to watch
+
+            :raises OSError: inotify is not available
+        """
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError("libc not found")
+
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError("inotify is not supported")
+
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        for d in directories:
+            if self._libc.inotify_add_watch(self._fd, os.fsencode(d), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+                errno = ctypes.get_errno()
+                os.close(self._fd)
+                raise OSError(errno, "inotify_add_watch failed for %s" % d)
+
+    def __readEvents(self):
+        """ Read the queued events
+
+            :return: True if an event is for an MRT file
+        """
+        found = False
+
+        while True:
+            try:
+                buf = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return found
+
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, name_len = INOTIFY_EVENT_STRUCT.unpack_from(buf, pos)
+                pos += INOTIFY_EVENT_STRUCT.size
+
+                name = buf[pos:pos + name_len].rstrip(b'\0').decode(errors='replace')
+                pos += name_len
+
+                if isMrtFile(name):
+                    found = True
+
+    def wait(self, timeout):
+        """ Wait until an MRT file is written or moved into a directory
+
+            :param timeout:     Max time to wait in seconds
+
+            :return: True if an MRT file is written, False if timed out
+        """
+        deadline = time.monotonic() + timeout
+
+        while True:
+            remaining = deadline - time.monotonic()
+
+            readable, _, _ = select.select([self._fd], [], [], max(remaining, 0))
+
+            if readable and self.__readEvents():
+                return True
+
+            if remaining <= 0 or not readable:
+                return False
+
+    def close(self):
+        os.close(self._fd)
+
+
+def createFileWatcher(directories, watcher_type='auto'):
+    """ Create the file watcher selected in the router data config
+
+        :param directories:     List of directories to watch
+        :param watcher_type:    'inotify', 'poll' or 'auto' (inotify with polling as fallback)
+
+        :return: File watcher instance
+    """
+    if watcher_type == 'poll':
+        return PollingFileWatcher(directories)
+
+    try:
+        return InotifyFileWatcher(directories)
+
+    except OSError:
+        if watcher_type == 'inotify':
+            raise
+
+        return PollingFileWatcher(directories)
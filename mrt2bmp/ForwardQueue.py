@@ -0,0 +1,159 @@
+""" Forward queue transports
+
+  Queues carrying raw BMP messages from the MRT processors to the BMP writer.
+"""
+import multiprocessing
+import queue
+import struct
+
+from multiprocessing import shared_memory
+
+# Ring header at the start of the shared memory block: head and tail byte counters and number of frames.
+RING_HEADER_STRUCT = struct.Struct('!Q Q Q')
+
+# Length prefix of every frame in the ring.
+FRAME_LENGTH_STRUCT = struct.Struct('!I')
+
+
+class SharedMemoryQueue():
+    """ Byte ring buffer in shared memory
+
+        Messages are stored as length prefixed frames in a multiprocessing.shared_memory block. Producers
+        and consumers only copy the message in and out of the ring, there is no pickling and no round trip
+        to a manager process. Back-pressure is in bytes: put() blocks while the ring has no room for the
+        message.
+
+        The queue has to be created before the processes using it are forked.
+    """
+
+    def __init__(self, size):
+        """ Constructor
+
+            :param size:        Size of the ring in bytes
+        """
+        self._size = size
+        self._shm = shared_memory.SharedMemory(create=True, size=RING_HEADER_STRUCT.size + size)
+        self._cond = multiprocessing.Condition()
+
+        RING_HEADER_STRUCT.pack_into(self._shm.buf, 0, 0, 0, 0)
+
+    def __readHeader(self):
+        return RING_HEADER_STRUCT.unpack_from(self._shm.buf, 0)
+
+    def __write(self, pos, data):
+        """ Copy data into the ring at byte counter pos, wraps around the end of the ring """
+        start = RING_HEADER_STRUCT.size + pos % self._size
+        first = min(len(data), RING_HEADER_STRUCT.size + self._size - start)
+
+        self._shm.buf[start:start + first] = data[:first]
+
+        if first < len(data):
+            self._shm.buf[RING_HEADER_STRUCT.size:RING_HEADER_STRUCT.size + len(data) - first] = data[first:]
+
+    def __read(self, pos, length):
+        """ Copy length bytes out of the ring at byte counter pos, wraps around the end of the ring """
+        start = RING_HEADER_STRUCT.size + pos % self._size
+        first = min(length, RING_HEADER_STRUCT.size + self._size - start)
+
+        data = bytes(self._shm.buf[start:start + first])
+
+        if first < length:
+            data += bytes(self._shm.buf[RING_HEADER_STRUCT.size:RING_HEADER_STRUCT.size + length - first])
+
+        return data
+
+    def __wait(self, predicate, block, timeout):
+        """ Wait on the condition (lock held) until predicate is true
+
+            :return: True if predicate is true, False if timed out or not blocking
+        """
+        if predicate():
+            return True
+
+        if not block:
+            return False
+
+        return self._cond.wait_for(predicate, timeout)
+
+    def put(self, msg, block=True, timeout=None):
+        frame_length = FRAME_LENGTH_STRUCT.size + len(msg)
+
+        if frame_length > self._size:
+            raise ValueError("Message of %d bytes does not fit into forward queue of %d bytes" % (len(msg), self._size))
+
+        with self._cond:
+
+            def hasRoom():
+                head, tail, count = self.__readHeader()
+                return self._size - (tail - head) >= frame_length
+
+            if not self.__wait(hasRoom, block, timeout):
+                raise queue.Full
+
+            head, tail, count = self.__readHeader()
+
+            self.__write(tail, FRAME_LENGTH_STRUCT.pack(len(msg)))
+            self.__write(tail + FRAME_LENGTH_STRUCT.size, msg)
+
+            RING_HEADER_STRUCT.pack_into(self._shm.buf, 0, head, tail + frame_length, count + 1)
+
+            self._cond.notify_all()
+
+    def put_nowait(self, msg):
+        self.put(msg, False)
+
+    def get(self, block=True, timeout=None):
+
+        with self._cond:
+
+            def hasFrame():
+                return self.__readHeader()[2] > 0
+
+            if not self.__wait(hasFrame, block, timeout):
+                raise queue.Empty
+
+            head, tail, count = self.__readHeader()
+
+            length = FRAME_LENGTH_STRUCT.unpack(self.__read(head, FRAME_LENGTH_STRUCT.size))[0]
+            msg = self.__read(head + FRAME_LENGTH_STRUCT.size, length)
+
+            RING_HEADER_STRUCT.pack_into(self._shm.buf, 0, head + FRAME_LENGTH_STRUCT.size + length, tail, count - 1)
+
+            self._cond.notify_all()
+
+        return msg
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        """ Number of queued messages """
+        return self.__readHeader()[2]
+
+    def bytesUsed(self):
+        """ Number of bytes used in the ring, including frame headers """
+        head, tail, count = self.__readHeader()
+        return tail - head
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def unlink(self):
+        """ Release the shared memory block, to be called once by the process which created the queue """
+        self._shm.close()
+        self._shm.unlink()
+
+
+def createForwardQueue(cfg_router, manager):
+    """ Create the forward queue selected in the router data config
+
+        :param cfg_router:      Router data configuration dictionary
+        :param manager:         multiprocessing.Manager used for the 'manager' queue type
+
+        :return: Queue instance
+    """
+    if cfg_router.get('forward_queue_type', 'manager') == 'shm':
+        return SharedMemoryQueue(cfg_router['forward_queue_bytes'])
+
+    # Use manager queue to ensure no duplicates
+    return manager.Queue(cfg_router['max_queue_size'])
@@ -3,64 +3,304 @@ import os
 import socket
 import struct
 import glob
+from collections import OrderedDict
+
+from mrt2bmp.Metrics import METRICS
+
+# Max BGP message size (RFC 4271) and with the extended message capability (RFC 8654).
+BGP_MAX_MESSAGE_SIZE = 4096
+BGP_MAX_EXTENDED_MESSAGE_SIZE = 65535
+
+# BGP header, withdrawn routes length, total path attribute length and MP_REACH_NLRI attribute header
+# (extended length) of an UPDATE carrying the prefixes in MP_REACH_NLRI.
+BGP_UPDATE_OVERHEAD = 19 + 2 + 2 + 4
+
+# Timestamp fields at the end of the BMP per-peer header, the preceding 34 bytes are fixed per peer.
+BMP_PEER_HEADER_TIMESTAMP_STRUCT = struct.Struct('!I I')
+BMP_PEER_HEADER_FIXED_SIZE = 34
+BMP_PEER_HEADER_SIZE = 42
+
+# BMP common header, BGP header with the UPDATE length fields and MP_REACH_NLRI attribute header (extended
+# length) of a route monitoring message.
+BMP_COMMON_HEADER_STRUCT = struct.Struct('!B I B')
+BGP_UPDATE_HEADER_STRUCT = struct.Struct('!16s H B H H')
+MP_REACH_NLRI_HEADER_STRUCT = struct.Struct('!B B H')
+
+# AFI and SAFI of the MP_UNREACH_NLRI attribute value.
+MP_UNREACH_NLRI_AFI_SAFI_STRUCT = struct.Struct('!H B')
+
+# BGP header, withdrawn routes length, total path attribute length, MP_UNREACH_NLRI attribute header (extended
+# length), AFI and SAFI of an UPDATE withdrawing prefixes in MP_UNREACH_NLRI.
+BGP_WITHDRAW_OVERHEAD = 19 + 2 + 2 + 4 + 3
+
+BGP_MARKER = b'\xFF' * 16
+
+# Max number of distinct path attribute sets in the attribute table, the table is cleared when it is full.
+ATTRIBUTE_TABLE_MAX_SIZE = 1000000
 
 
 class MessageBucket():
 
-    def __init__(self, peer, raw_path_attribute, raw_prefix_nlri, mp_reach_attribute, forward_queue):
+    def __init__(self, peer, raw_path_attribute, raw_prefix_nlri, mp_reach_attribute, forward_queue,
+                 max_message_size=BGP_MAX_MESSAGE_SIZE):
         self.peer = peer
         self.raw_path_attribute = raw_path_attribute
-        self.raw_prefixes = raw_prefix_nlri
+        self.raw_prefixes = bytearray(raw_prefix_nlri)
         self.mp_reach_attribute = mp_reach_attribute
 
         self._forward_queue = forward_queue
 
+        # Room left for prefixes in a BGP UPDATE of max_message_size.
+        self._max_prefixes_size = max_message_size - BGP_UPDATE_OVERHEAD - len(raw_path_attribute) - \
+            len(mp_reach_attribute)
+
     def addPrefix(self, raw_prefix):
 
-        if len(self.raw_prefixes) >= 4000:
+        # Send the prefixes collected so far if the UPDATE would exceed the max message size.
+        if self.raw_prefixes and len(self.raw_prefixes) + len(raw_prefix) > self._max_prefixes_size:
             self.__sendMessage()
 
         self.raw_prefixes += raw_prefix
 
-
-    def getMpReachNlriAttributeHeader(self, attr_length):
-        # Crate attribute flag.
-        # b'10010000' as big endian = 144
-        attr_flag = 144
-
-        # Create attribute type code.
-        attr_type_code = 14
-
-        return struct.pack("!B B H", attr_flag, attr_type_code, attr_length)
+    def getSize(self):
+        """ Estimated memory used by the bucket in bytes """
+        return len(self.raw_path_attribute) + len(self.mp_reach_attribute) + len(self.raw_prefixes) + \
+            MessageBucketCache.BUCKET_OVERHEAD
 
     def finalizeBucket(self):
 
-        if self.raw_prefixes != b"":
+        if self.raw_prefixes:
             self.__sendMessage()
 
     def __sendMessage(self):
 
-        # 1-) Create BGP Update message
-        mp_reach_length = len(self.mp_reach_attribute + self.raw_prefixes)
-        bgp_update_message = BGP_Helper.createBgpUpdateMessage(b"", self.raw_path_attribute + self.getMpReachNlriAttributeHeader(mp_reach_length) + self.mp_reach_attribute + self.raw_prefixes, b"")
+        # Put the message in the queue.
+        qm = BMP_Helper.createRouteMonitoringMessage(self.peer, self.raw_path_attribute, self.mp_reach_attribute,
+                                                     self.raw_prefixes)
+
+        self._forward_queue.put(qm)
 
-        # 2-) Create BGP Common header
-        bgp_common_header = BGP_Helper.createBgpHeader(len(bgp_update_message), 2)
+        METRICS.inc('rib_bucket_flushes_total')
 
-        # 3-) Create BMP Per Peer header
-        bmp_per_peer_header = BMP_Helper.createBmpPerPeerHeader(0, 0, self.peer, 0, 0)
+        # Clear the prefixes.
+        self.raw_prefixes = bytearray()
 
-        # 4-) Create BMP Common header
-        bmp_common_header = BMP_Helper.createBmpCommonHeader(3, len(bgp_update_message) +
-                                                       len(bgp_common_header) + len(bmp_per_peer_header) + 6, 0)
+class MessageBucketCache():
+    """ Bounded cache of MessageBucket objects
 
-        # Put the message in the queue.
-        qm = bmp_common_header + bmp_per_peer_header + bgp_common_header + bgp_update_message
+        When the number of buckets or their estimated memory exceeds the limits, the least recently
+        used buckets are finalized (sent to the forward queue) and dropped. A later prefix for the same
+        key starts a new bucket, so memory stays flat at the cost of some prefix packing.
+    """
 
-        self._forward_queue.put(qm)
+    # Estimated fixed cost of a bucket (object, key and cache entry) in bytes.
+    BUCKET_OVERHEAD = 400
+
+    def __init__(self, max_buckets=0, max_memory=0):
+        """ Constructor
+
+            :param max_buckets:     Max number of open buckets, 0 for no limit
+            :param max_memory:      Max estimated memory of open buckets in bytes, 0 for no limit
+        """
+        self._buckets = OrderedDict()
+        self._max_buckets = max_buckets
+        self._max_memory = max_memory
+        self._is_bounded = max_buckets > 0 or max_memory > 0
+        self._memory = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def getMemory(self):
+        return self._memory
+
+    def addPrefix(self, key, raw_prefix):
+        """ Add the prefix to the bucket of the key
+
+            :return: True if added, False if there is no bucket for the key
+        """
+        bucket = self._buckets.get(key)
+
+        if bucket is None:
+            return False
+
+        if self._is_bounded:
+            self._buckets.move_to_end(key)
+
+            size = bucket.getSize()
+            bucket.addPrefix(raw_prefix)
+            self._memory += bucket.getSize() - size
+
+            self.__evict()
+
+        else:
+            bucket.addPrefix(raw_prefix)
+
+        return True
+
+    def addBucket(self, key, bucket):
+        self._buckets[key] = bucket
+
+        if self._is_bounded:
+            self._memory += bucket.getSize()
+            self.__evict()
+
+        METRICS.set('rib_buckets_open', len(self._buckets))
+        METRICS.set('rib_bucket_memory_bytes', self._memory)
+
+    def finalize(self):
+        """ Send and drop all open buckets """
+        for bucket in self._buckets.values():
+            bucket.finalizeBucket()
+
+        self._buckets.clear()
+        self._memory = 0
+
+        METRICS.set('rib_buckets_open', 0)
+        METRICS.set('rib_bucket_memory_bytes', 0)
+
+    def __evict(self):
+
+        while self._buckets and ((self._max_buckets and len(self._buckets) > self._max_buckets) or
+                                 (self._max_memory and self._memory > self._max_memory)):
+
+            key, bucket = self._buckets.popitem(last=False)
+            self._memory -= bucket.getSize()
+            bucket.finalizeBucket()
+
+            METRICS.inc('rib_bucket_evictions_total')
+
+class AttributeTable():
+    """ Interning table of path attribute sets
+
+        Every distinct pair of raw path attributes and MP_REACH_NLRI gets a small integer id and a single
+        stored copy, shared by the buckets of all peers announcing it. A table belongs to one RIB conversion
+        or update compactor and is cleared once their routes are sent. Ids are never reused, so a bucket
+        keyed by an id from before the table was cleared can not be mistaken for another attribute set.
+    """
+
+    def __init__(self, max_size=ATTRIBUTE_TABLE_MAX_SIZE):
+        """ Constructor
+
+            :param max_size:        Max number of attribute sets, 0 for no limit
+        """
+        self._entries = {}
+        self._max_size = max_size
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def intern(self, raw_path_attributes, mp_reach_attribute):
+        """ Id and stored copy of an attribute set
+
+            :param raw_path_attributes:     Raw path attributes without NEXT_HOP/MP_REACH_NLRI
+            :param mp_reach_attribute:      Raw MP_REACH_NLRI attribute with the next hop
+
+            :return: Tuple of (id, raw path attributes, MP_REACH_NLRI attribute)
+        """
+        key = (raw_path_attributes, mp_reach_attribute)
+        entry = self._entries.get(key)
+
+        if entry is None:
+            if self._max_size and len(self._entries) >= self._max_size:
+                self._entries.clear()
+
+            entry = (self._next_id, raw_path_attributes, mp_reach_attribute)
+            self._entries[key] = entry
+            self._next_id += 1
+
+        return entry
+
+    def clear(self):
+        """ Drop the stored attribute sets, ids keep counting up """
+        self._entries = {}
+
+class BmpPeerHeaderCache():
+    """ Cache of encoded BMP per-peer headers of global instance peers
+
+        The first 34 bytes of a per-peer header only depend on the peer and are encoded once. Each
+        peer's header is kept in a preallocated bytearray of which only the timestamp fields are
+        patched for a message.
+    """
+
+    def __init__(self):
+        self._headers = {}
+
+    def __len__(self):
+        return len(self._headers)
+
+    def getPerPeerHeader(self, peer, ts_s=0, ts_ms=0, as_number_size=None):
+        """ BMP per-peer header of a global instance peer
+
+            :param peer:            Peer dictionary of the peer index table
+            :param ts_s:            Timestamp seconds
+            :param ts_ms:           Timestamp microseconds
+            :param as_number_size:  AS number size, 2 sets the A flag; None for the size of the peer
+
+            :return: Header bytearray, valid until the next call for the same peer
+        """
+        if as_number_size is None:
+            as_number_size = peer['as_number_size']
+
+        key = (peer['ip_address'], peer['asn'], peer['bgp_id'], as_number_size)
+        header = self._headers.get(key)
+
+        if header is None:
+            header = bytearray(BMP_Helper.createBmpPerPeerHeader(0, 0, dict(peer, as_number_size=as_number_size),
+                                                                 0, 0))
+            self._headers[key] = header
+
+        BMP_PEER_HEADER_TIMESTAMP_STRUCT.pack_into(header, BMP_PEER_HEADER_FIXED_SIZE, ts_s, ts_ms)
+
+        return header
+
+
+# Per-peer headers shared by the message encoders of the process.
+PEER_HEADER_CACHE = BmpPeerHeaderCache()
+
+
+class PeerIndex():
+    """ Lookup of peer index table entries for BGP4MP messages
+
+        Peers are indexed by packed peer address and by (packed peer address, peer AS), the latter
+        tells apart peers sharing an address.
+    """
+
+    def __init__(self, peer_list):
+        """ Constructor
+
+            :param peer_list:       Peer list of the peer index table
+        """
+        self._by_address = {}
+        self._by_address_asn = {}
+
+        for peer in peer_list:
+            family = socket.AF_INET6 if peer['ip_address_family'] == "IPv6" else socket.AF_INET
+            raw_address = socket.inet_pton(family, peer['ip_address'])
+
+            # First peer in the table wins, as with a scan of the list.
+            self._by_address.setdefault(raw_address, peer)
+            self._by_address_asn.setdefault((raw_address, int(peer['asn'])), peer)
+
+    def __len__(self):
+        return len(self._by_address)
+
+    def getPeer(self, raw_peer_ip, peer_as=None):
+        """ Peer of the address and AS
+
+            :param raw_peer_ip:     Packed peer address (4 or 16 bytes)
+            :param peer_as:         Peer AS, a peer with the address only is returned if no peer matches both
+
+            :return: Peer dictionary or None
+        """
+        peer = self._by_address_asn.get((raw_peer_ip, peer_as))
+
+        if peer is None:
+            peer = self._by_address.get(raw_peer_ip)
+
+        return peer
 
-        # Clear the prefixes.
-        self.raw_prefixes = b""
 
 class BGP_Helper:
 
@@ -103,7 +343,7 @@ class BGP_Helper:
         return marker + length + type
 
     @staticmethod
-    def createBgpOpenMessage(as_number, hold_time, bgp_iden, remote_asn):
+    def createBgpOpenMessage(as_number, hold_time, bgp_iden, remote_asn, extended_message=False):
 
         """
         Open Message Format:
@@ -153,9 +393,16 @@ class BGP_Helper:
         # Add AFI, SAFI values to caps.
         mp_ipv4_unicast_cap = struct.pack("!B B", 2, 5) + struct.pack("!B B H B", 1, 4, 1, 1)
         mp_ipv6_unicast_cap = struct.pack("!B B", 2, 5) + struct.pack("!B B H B", 1, 4, 2, 1)
+        mp_ipv4_multicast_cap = struct.pack("!B B", 2, 5) + struct.pack("!B B H B", 1, 4, 1, 2)
+        mp_ipv6_multicast_cap = struct.pack("!B B", 2, 5) + struct.pack("!B B H B", 1, 4, 2, 2)
 
-        # Optional_parameters = octet_4_as_cap + mp_ipv4_unicast_cap + mp_ipv6_unicast_cap
-        optional_parameters = octet_4_as_cap + mp_ipv4_unicast_cap + mp_ipv6_unicast_cap
+        # Optional_parameters = octet_4_as_cap + unicast and multicast caps of both address families
+        optional_parameters = octet_4_as_cap + mp_ipv4_unicast_cap + mp_ipv6_unicast_cap + \
+            mp_ipv4_multicast_cap + mp_ipv6_multicast_cap
+
+        # Extended message capability (RFC 8654), UPDATEs may be up to 65535 bytes.
+        if extended_message:
+            optional_parameters += struct.pack("!B B", 2, 2) + struct.pack("!B B", 6, 0)
 
         # Optional Parameters Length
         optional_parameters_length = struct.pack("!B", len(optional_parameters))
@@ -290,12 +537,95 @@ class BMP_Helper:
             + bgp_id + struct.pack("!I I", ts_s, ts_ms)
 
     @staticmethod
-    def createPeerUpMessage(peer, collector_id):
+    def createRouteMonitoringMessage(peer, raw_path_attribute, mp_reach_attribute, raw_prefixes):
+        """ Encode a route monitoring message advertising prefixes in MP_REACH_NLRI
+
+            All lengths are computed up front and the message is written into a single buffer:
+            BMP common header + per-peer header + BGP header + UPDATE (no withdrawn routes, path
+            attributes, MP_REACH_NLRI with the prefixes, no NLRI).
+
+            :param peer:                Peer dictionary of the peer index table
+            :param raw_path_attribute:  Path attributes without NEXT_HOP and MP_REACH_NLRI
+            :param mp_reach_attribute:  MP_REACH_NLRI value up to the NLRI (AFI, SAFI, next hop, reserved)
+            :param raw_prefixes:        Encoded prefixes
+
+            :return: Message bytearray
+        """
+        mp_reach_length = len(mp_reach_attribute) + len(raw_prefixes)
+        path_attributes_length = len(raw_path_attribute) + MP_REACH_NLRI_HEADER_STRUCT.size + mp_reach_length
+        bgp_length = BGP_UPDATE_HEADER_STRUCT.size + path_attributes_length
+        bmp_length = BMP_COMMON_HEADER_STRUCT.size + BMP_PEER_HEADER_SIZE + bgp_length
+
+        buf = bytearray(bmp_length)
+
+        BMP_COMMON_HEADER_STRUCT.pack_into(buf, 0, 3, bmp_length, 0)
+        p = BMP_COMMON_HEADER_STRUCT.size
+
+        buf[p:p + BMP_PEER_HEADER_SIZE] = PEER_HEADER_CACHE.getPerPeerHeader(peer)
+        p += BMP_PEER_HEADER_SIZE
+
+        BGP_UPDATE_HEADER_STRUCT.pack_into(buf, p, BGP_MARKER, bgp_length, 2, 0, path_attributes_length)
+        p += BGP_UPDATE_HEADER_STRUCT.size
+
+        buf[p:p + len(raw_path_attribute)] = raw_path_attribute
+        p += len(raw_path_attribute)
+
+        # b'10010000' as big endian = 144, optional and extended length.
+        MP_REACH_NLRI_HEADER_STRUCT.pack_into(buf, p, 144, 14, mp_reach_length)
+        p += MP_REACH_NLRI_HEADER_STRUCT.size
+
+        buf[p:p + len(mp_reach_attribute)] = mp_reach_attribute
+        p += len(mp_reach_attribute)
+
+        buf[p:] = raw_prefixes
+
+        return buf
+
+    @staticmethod
+    def createRouteWithdrawMessage(peer, afi, safi, raw_prefixes):
+        """ Encode a route monitoring message withdrawing prefixes in MP_UNREACH_NLRI
+
+            :param peer:                Peer dictionary of the peer index table
+            :param afi:                 AFI of the prefixes
+            :param safi:                SAFI of the prefixes
+            :param raw_prefixes:        Encoded prefixes
+
+            :return: Message bytearray
+        """
+        mp_unreach_length = MP_UNREACH_NLRI_AFI_SAFI_STRUCT.size + len(raw_prefixes)
+        path_attributes_length = MP_REACH_NLRI_HEADER_STRUCT.size + mp_unreach_length
+        bgp_length = BGP_UPDATE_HEADER_STRUCT.size + path_attributes_length
+        bmp_length = BMP_COMMON_HEADER_STRUCT.size + BMP_PEER_HEADER_SIZE + bgp_length
+
+        buf = bytearray(bmp_length)
+
+        BMP_COMMON_HEADER_STRUCT.pack_into(buf, 0, 3, bmp_length, 0)
+        p = BMP_COMMON_HEADER_STRUCT.size
+
+        buf[p:p + BMP_PEER_HEADER_SIZE] = PEER_HEADER_CACHE.getPerPeerHeader(peer)
+        p += BMP_PEER_HEADER_SIZE
+
+        BGP_UPDATE_HEADER_STRUCT.pack_into(buf, p, BGP_MARKER, bgp_length, 2, 0, path_attributes_length)
+        p += BGP_UPDATE_HEADER_STRUCT.size
+
+        # Optional and extended length, type 15.
+        MP_REACH_NLRI_HEADER_STRUCT.pack_into(buf, p, 144, 15, mp_unreach_length)
+        p += MP_REACH_NLRI_HEADER_STRUCT.size
+
+        MP_UNREACH_NLRI_AFI_SAFI_STRUCT.pack_into(buf, p, afi, safi)
+        p += MP_UNREACH_NLRI_AFI_SAFI_STRUCT.size
+
+        buf[p:] = raw_prefixes
+
+        return buf
+
+    @staticmethod
+    def createPeerUpMessage(peer, collector_id, extended_message=False):
 
         # peer up message = Common header + per-peer header + peer up notification
-        peer_up_notification = BMP_Helper.createPeerUpNotification(peer, collector_id)
+        peer_up_notification = BMP_Helper.createPeerUpNotification(peer, collector_id, extended_message)
 
-        per_peer_header = BMP_Helper.createBmpPerPeerHeader(0, 0, peer, 0, 0)
+        per_peer_header = PEER_HEADER_CACHE.getPerPeerHeader(peer)
 
         common_header = BMP_Helper.createBmpCommonHeader(3, len(per_peer_header) + len(peer_up_notification) + 6, 3)
 
@@ -307,14 +637,14 @@ class BMP_Helper:
         # peer up message = Common header + per-peer header + peer up notification
         peer_down_notification = BMP_Helper.createPeerDownNotification()
 
-        per_peer_header = BMP_Helper.createBmpPerPeerHeader(0, 0, peer, 0, 0)
+        per_peer_header = PEER_HEADER_CACHE.getPerPeerHeader(peer)
 
         common_header = BMP_Helper.createBmpCommonHeader(3, len(per_peer_header) + len(peer_down_notification) + 6, 2)
 
         return common_header + per_peer_header + peer_down_notification
 
     @staticmethod
-    def createPeerUpNotification(peer, collector_id):
+    def createPeerUpNotification(peer, collector_id, extended_message=False):
 
         """
           Peer Up Notification:
@@ -355,10 +685,10 @@ class BMP_Helper:
         remote_port = struct.pack('!H', 0)
 
         # Sent OPEN Message
-        sent_open_message = BGP_Helper.createBgpOpenMessage(0, 0, collector_id, peer['asn'])
+        sent_open_message = BGP_Helper.createBgpOpenMessage(0, 0, collector_id, peer['asn'], extended_message)
 
         # Received OPEN Message
-        received_open_message = BGP_Helper.createBgpOpenMessage(peer['asn'], 0, peer['bgp_id'], 0)
+        received_open_message = BGP_Helper.createBgpOpenMessage(peer['asn'], 0, peer['bgp_id'], 0, extended_message)
 
         return local_address + local_port + remote_port + sent_open_message + received_open_message
 
@@ -0,0 +1,221 @@
+""" Pipeline metrics
+
+  Every process counts into its own ProcessMetrics instance (METRICS) without locking or I/O. The counts
+  are sent to the main process through a multiprocessing queue at most every FLUSH_INTERVAL seconds, where
+  MetricsThread aggregates them and serves them in the Prometheus text format on /metrics.
+"""
+import collections
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty
+
+# Prefix of the exported metric names.
+METRICS_PREFIX = 'mrt2bmp_'
+
+# Min interval in seconds between two flushes of a process to the metrics queue.
+FLUSH_INTERVAL = 1.0
+
+# Type and help of the exported metrics.
+METRIC_TYPES = {
+    'mrt_records_total': ('counter', 'MRT records parsed'),
+    'mrt_bytes_total': ('counter', 'Bytes of MRT records parsed'),
+    'mrt_prefixes_total': ('counter', 'Prefixes of RIB records parsed'),
+    'rib_bucket_flushes_total': ('counter', 'BGP UPDATEs sent from RIB message buckets'),
+    'rib_bucket_evictions_total': ('counter', 'RIB message buckets sent early to stay within the bucket limits'),
+    'rib_buckets_open': ('gauge', 'Open RIB message buckets'),
+    'rib_bucket_memory_bytes': ('gauge', 'Estimated memory of open RIB message buckets'),
+    'rib_delta_unchanged_routes_total': ('counter', 'RIB entries not sent in delta mode, unchanged since the last RIB'),
+    'rib_delta_withdrawals_total': ('counter', 'Routes of the last RIB withdrawn in delta mode'),
+    'update_compaction_superseded_routes_total': ('counter', 'Routes of updates replaced by a later update of the '
+                                                  'same peer and prefix within the compaction window'),
+    'replay_lag_seconds': ('gauge', 'Time the paced replay of updates is behind the MRT timestamps'),
+    'rib_interleave_superseded_routes_total': ('counter', 'RIB entries not sent, superseded by an update sent while '
+                                               'the RIB was interleaved'),
+    'forward_queue_depth': ('gauge', 'BMP messages in the forward queue'),
+    'forward_queue_bytes': ('gauge', 'Bytes used in the shared memory forward queue'),
+    'writer_messages_sent_total': ('counter', 'BMP messages sent to the collector'),
+    'writer_bytes_sent_total': ('counter', 'Bytes sent to the collector'),
+    'writer_send_seconds': ('summary', 'Time of socket writes to the collector'),
+    'writer_reconnects_total': ('counter', 'Reconnects to the collector'),
+    'writer_write_timeouts_total': ('counter', 'Writes to the collector not drained within the write timeout'),
+    'writer_stalled_seconds_total': ('counter', 'Time the asyncio writer was disconnected or failing to write'),
+    'writer_buffer_bytes': ('gauge', 'Bytes in the send buffer of the asyncio writer'),
+    'file_processing_seconds': ('summary', 'Processing time of MRT files'),
+}
+
+
+class ProcessMetrics():
+    """ Counters and gauges of a process
+
+        Counters hold the increments since the last flush, the aggregator adds them up.
+    """
+
+    def __init__(self):
+        self._queue = None
+        self._counters = collections.Counter()
+        self._gauges = {}
+        self._last_flush = time.monotonic()
+
+    def setQueue(self, metrics_queue):
+        self._queue = metrics_queue
+
+    def getQueue(self):
+        return self._queue
+
+    def inc(self, name, value=1, labels=()):
+        """ Increment a counter
+
+            :param name:        Metric name without prefix
+            :param value:       Increment
+            :param labels:      Tuple of (label name, value) pairs
+        """
+        self._counters[(name, labels)] += value
+
+    def set(self, name, value, labels=()):
+        """ Set a gauge """
+        self._gauges[(name, labels)] = value
+
+    def observe(self, name, value, labels=()):
+        """ Add an observation to a summary """
+        self._counters[(name + '_sum', labels)] += value
+        self._counters[(name + '_count', labels)] += 1
+
+    def flush(self, force=False):
+        """ Send the counts to the metrics queue if FLUSH_INTERVAL has passed since the last flush
+
+            :param force:       Flush regardless of the interval
+        """
+        now = time.monotonic()
+
+        if self._queue is None or (not force and now - self._last_flush < FLUSH_INTERVAL):
+            return
+
+        self._last_flush = now
+
+        if self._counters or self._gauges:
+            self._queue.put((dict(self._counters), self._gauges))
+            self._counters.clear()
+            self._gauges = {}
+
+
+# Metrics of the process, processes forked after initMetrics() flush to the same queue.
+METRICS = ProcessMetrics()
+
+
+def initMetrics(metrics_queue):
+    """ Set the queue metrics are flushed to, to be called in the main process before forking
+
+        :param metrics_queue:   multiprocessing.Queue read by MetricsThread, of the RIB pool context as it is
+                                passed to the pool workers
+    """
+    METRICS.setQueue(metrics_queue)
+
+
+class MetricsThread(threading.Thread):
+    """ Aggregates the metrics of all processes and serves them on http://<host>:<port>/metrics """
+
+    def __init__(self, metrics_queue, port, gauge_callbacks=None):
+        """ Constructor
+
+            :param metrics_queue:   multiprocessing.Queue the processes flush to
+            :param port:            HTTP port
+            :param gauge_callbacks: Dictionary of gauge name to function sampled on every scrape
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self._queue = metrics_queue
+        self._port = port
+        self._gauge_callbacks = gauge_callbacks or {}
+        self._stopme = threading.Event()
+
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._gauges = {}
+        self._server = None
+
+    def run(self):
+        """ Override """
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = metrics.render().encode()
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('', self._port), MetricsHandler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+        while not self.stopped():
+            try:
+                counters, gauges = self._queue.get(True, 0.2)
+
+                with self._lock:
+                    self._counters.update(counters)
+                    self._gauges.update(gauges)
+
+            except Empty:
+                continue
+
+            except (KeyboardInterrupt, EOFError, OSError):
+                break
+
+        self._server.shutdown()
+        self._server.server_close()
+
+    def render(self):
+        """ Metrics in the Prometheus text format """
+        with self._lock:
+            values = dict(self._counters)
+            values.update(self._gauges)
+
+        for name, callback in self._gauge_callbacks.items():
+            try:
+                values[(name, ())] = callback()
+            except Exception:
+                pass
+
+        # Group samples by metric, summaries have _sum and _count samples.
+        samples = collections.defaultdict(list)
+
+        for (name, labels), value in sorted(values.items(), key=lambda v: (v[0][0], v[0][1])):
+            base = name
+            if name not in METRIC_TYPES and name.rsplit('_', 1)[0] in METRIC_TYPES:
+                base = name.rsplit('_', 1)[0]
+
+            label_str = ','.join('%s="%s"' % (k, v) for k, v in labels)
+            if label_str:
+                label_str = '{' + label_str + '}'
+
+            samples[base].append('%s%s%s %s' % (METRICS_PREFIX, name, label_str, value))
+
+        lines = []
+        for base in sorted(samples):
+            metric_type, metric_help = METRIC_TYPES.get(base, ('untyped', base))
+            lines.append('# HELP %s%s %s' % (METRICS_PREFIX, base, metric_help))
+            lines.append('# TYPE %s%s %s' % (METRICS_PREFIX, base, metric_type))
+            lines.extend(samples[base])
+
+        return '\n'.join(lines) + '\n'
+
+    def stop(self):
+        self._stopme.set()
+
+    def stopped(self):
+        return self._stopme.is_set()
@@ -0,0 +1,435 @@
+""" Random access index of MRT files
+
+  The index is a sidecar file <MRT file>.idx holding the offset of every record in the uncompressed file,
+  the location of the PEER_INDEX_TABLE and per chunk of records the timestamp and RIB prefix ranges:
+
+    magic (8 bytes), version (1 byte), metadata length (4 bytes), JSON metadata, record offsets (8 bytes each)
+
+  Compressed streams can only be decompressed from the start, except for gzip files with several members
+  (e.g. concatenated or bgzip files). The start of every gzip member is recorded, so seeks decompress from
+  the closest member instead of the start of the file. Building the index of a compressed file decompresses
+  it in full, so processing only uses existing index files and an index is built when a record number is
+  seeked, see MrtParser.seekRecord(). Uncompressed files are seeked by offset without an index.
+"""
+import array
+import bisect
+import io
+import json
+import os
+import socket
+import struct
+import sys
+import zlib
+
+from mrt2bmp.Decompression import getCompression, openMrtFile, PREFETCH_CHUNK_SIZE
+
+# Suffix of the index file appended to the MRT file name.
+INDEX_FILE_SUFFIX = '.idx'
+
+INDEX_MAGIC = b'MRT2BIDX'
+INDEX_VERSION = 1
+INDEX_HEADER_STRUCT = struct.Struct('!8s B I')
+
+# Number of records of a chunk in the index.
+INDEX_CHUNK_RECORDS = 10000
+
+MRT_HEADER_STRUCT = struct.Struct('!I H H I')
+RIB_HEADER_STRUCT = struct.Struct('!I B')
+
+# Address family of the AFI/SAFI-specific RIB subtypes.
+RIB_SUBTYPE_FAMILY = {
+    2: socket.AF_INET,      # RIB_IPV4_UNICAST
+    3: socket.AF_INET,      # RIB_IPV4_MULTICAST
+    4: socket.AF_INET6,     # RIB_IPV6_UNICAST
+    5: socket.AF_INET6,     # RIB_IPV6_MULTICAST
+}
+
+# zlib window bits of a gzip stream.
+GZIP_WBITS = 31
+
+# Header of the first member of a BGZF (bgzip) file: gzip magic, deflate, FEXTRA flag and the BC extra subfield.
+BGZF_HEADER_STRUCT = struct.Struct('<4s I B B H 2s')
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+BGZF_SUBFIELD_ID = b'BC'
+
+
+class GzipMemberReader(io.RawIOBase):
+    """ Raw reader of a gzip file recording the compressed and uncompressed offset of every member """
+
+    def __init__(self, file_path):
+        io.RawIOBase.__init__(self)
+
+        self._f = open(file_path, 'rb')
+        self._decompressor = None
+
+        # Compressed input not fed to the decompressor yet and its offset in the file.
+        self._input = b''
+        self._input_offset = 0
+
+        # Decompressed data not returned yet and number of bytes decompressed.
+        self._output = memoryview(b'')
+        self._decompressed = 0
+
+        # List of (compressed offset, uncompressed offset) of the members.
+        self.members = []
+
+    def readable(self):
+        return True
+
+    def __decompress(self):
+        """ Decompress the next chunk
+
+            :return: False at the end of the file
+        """
+        if not self._input:
+            self._input_offset = self._f.tell()
+            self._input = self._f.read(PREFETCH_CHUNK_SIZE)
+
+            if not self._input:
+                return False
+
+        if self._decompressor is None:
+            # Members may be followed by zero padding.
+            data = self._input.lstrip(b'\0')
+            self._input_offset += len(self._input) - len(data)
+            self._input = data
+
+            if not data:
+                return True
+
+            self._decompressor = zlib.decompressobj(GZIP_WBITS)
+            self.members.append((self._input_offset, self._decompressed))
+
+        output = self._decompressor.decompress(self._input)
+
+        if self._decompressor.eof:
+            unused_data = self._decompressor.unused_data
+            self._input_offset += len(self._input) - len(unused_data)
+            self._input = unused_data
+            self._decompressor = None
+
+        else:
+            self._input_offset += len(self._input)
+            self._input = b''
+
+        self._output = memoryview(output)
+        self._decompressed += len(output)
+
+        return True
+
+    def readinto(self, b):
+        while not self._output:
+            if not self.__decompress():
+                if self._decompressor is not None:
+                    raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+
+                return 0
+
+        n = min(len(b), len(self._output))
+        b[:n] = self._output[:n]
+        self._output = self._output[n:]
+
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._f.close()
+
+        io.RawIOBase.close(self)
+
+
+class MrtIndex():
+    """ Record offsets, PEER_INDEX_TABLE location and chunks of an MRT file """
+
+    def __init__(self, metadata, offsets):
+        """ Constructor
+
+            :param metadata:    Dictionary with file_size, file_mtime_ns, compression, record_count, peer_index_table,
+                                chunks and gzip_members
+            :param offsets:     array('Q') of the record offsets in the uncompressed file
+        """
+        self.metadata = metadata
+        self.offsets = offsets
+
+        self.compression = metadata['compression']
+
+        # Offset, record number and length of the first PEER_INDEX_TABLE, None if there is none.
+        self.peer_index_table = metadata['peer_index_table']
+
+        # List of dictionaries with record, offset, records, first/last timestamp and for RIB records
+        # first/last sequence number and prefix.
+        self.chunks = metadata['chunks']
+
+        self.gzip_members = [tuple(member) for member in metadata['gzip_members']]
+        self._gzip_member_offsets = [member[1] for member in self.gzip_members]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def getRecordOffset(self, record):
+        """ Offset of the record in the uncompressed file
+
+            :param record:      Record number, counting from 0
+
+            :return: Offset, the size of the uncompressed file for the record past the last one
+        """
+        if record == len(self.offsets):
+            return self.metadata['uncompressed_size']
+
+        return self.offsets[record]
+
+    def getRecordAt(self, offset):
+        """ Number of the first record at or after the offset """
+        return bisect.bisect_left(self.offsets, offset)
+
+    def getGzipMember(self, offset):
+        """ Gzip member holding the offset
+
+            :param offset:      Offset in the uncompressed file
+
+            :return: Tuple of (compressed offset, uncompressed offset) of the member, None if the file is not
+                     a gzip file with several members
+        """
+        if len(self.gzip_members) < 2:
+            return None
+
+        return self.gzip_members[bisect.bisect_right(self._gzip_member_offsets, offset) - 1]
+
+    def isValidFor(self, file_path):
+        """ True if the index was built for the current content of the file """
+        try:
+            st = os.stat(file_path)
+
+        except OSError:
+            return False
+
+        return st.st_size == self.metadata['file_size'] and st.st_mtime_ns == self.metadata['file_mtime_ns']
+
+    def save(self, index_path):
+        """ Write the index file
+
+            The index is written to a temporary file which replaces the index file.
+        """
+        metadata = json.dumps(self.metadata).encode()
+
+        offsets = array.array('Q', self.offsets)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+
+        tmp_path = index_path + '.tmp'
+
+        with open(tmp_path, 'wb') as f:
+            f.write(INDEX_HEADER_STRUCT.pack(INDEX_MAGIC, INDEX_VERSION, len(metadata)))
+            f.write(metadata)
+            f.write(offsets.tobytes())
+
+        os.replace(tmp_path, index_path)
+
+    @classmethod
+    def load(cls, index_path):
+        """ Read an index file
+
+            :return: MrtIndex, None if the file does not exist or is not a valid index
+        """
+        try:
+            with open(index_path, 'rb') as f:
+                magic, version, metadata_length = INDEX_HEADER_STRUCT.unpack(f.read(INDEX_HEADER_STRUCT.size))
+
+                if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                    return None
+
+                metadata = json.loads(f.read(metadata_length).decode())
+
+                offsets = array.array('Q')
+                offsets.frombytes(f.read())
+
+            if sys.byteorder != 'little':
+                offsets.byteswap()
+
+            if len(offsets) != metadata['record_count']:
+                return None
+
+            return cls(metadata, offsets)
+
+        except (OSError, ValueError, KeyError, struct.error):
+            return None
+
+
+def buildIndex(file_path, chunk_records=INDEX_CHUNK_RECORDS):
+    """ Build the index of an MRT file by reading the MRT headers of all records
+
+        :param file_path:       MRT file, plain or compressed
+        :param chunk_records:   Number of records of a chunk
+
+        :return: MrtIndex
+    """
+    st = os.stat(file_path)
+    compression = getCompression(file_path)
+
+    if compression == 'gzip':
+        gzip_reader = GzipMemberReader(file_path)
+        f = io.BufferedReader(gzip_reader, PREFETCH_CHUNK_SIZE)
+    else:
+        gzip_reader = None
+        f = openMrtFile(file_path)
+
+    offsets = array.array('Q')
+    peer_index_table = None
+    chunks = []
+    chunk = None
+    offset = 0
+
+    with f:
+        while True:
+            header = f.read(MRT_HEADER_STRUCT.size)
+
+            if len(header) < MRT_HEADER_STRUCT.size:
+                break
+
+            timestamp, msg_type, msg_subtype, msg_len = MRT_HEADER_STRUCT.unpack(header)
+
+            if len(offsets) % chunk_records == 0:
+                chunk = {'record': len(offsets), 'offset': offset, 'records': 0, 'first_timestamp': timestamp}
+                chunks.append(chunk)
+
+            chunk['records'] += 1
+            chunk['last_timestamp'] = timestamp
+
+            offsets.append(offset)
+            skip = msg_len
+
+            if msg_type == 13 and msg_subtype == 1 and peer_index_table is None:
+                peer_index_table = {'record': len(offsets) - 1, 'offset': offset, 'length': msg_len}
+
+            elif msg_type == 13 and msg_subtype in RIB_SUBTYPE_FAMILY:
+                # Sequence number, prefix length and prefix of the RIB record.
+                family = RIB_SUBTYPE_FAMILY[msg_subtype]
+                address_length = 4 if family == socket.AF_INET else 16
+
+                rib_header = f.read(min(msg_len, RIB_HEADER_STRUCT.size + address_length))
+                skip -= len(rib_header)
+
+                if len(rib_header) >= RIB_HEADER_STRUCT.size:
+                    seq_number, prefix_len = RIB_HEADER_STRUCT.unpack_from(rib_header)
+
+                    address = rib_header[RIB_HEADER_STRUCT.size:RIB_HEADER_STRUCT.size + (prefix_len + 7) // 8]
+                    prefix = '%s/%d' % (socket.inet_ntop(family, address.ljust(address_length, b'\0')), prefix_len)
+
+                    if 'first_sequence' not in chunk:
+                        chunk['first_sequence'] = seq_number
+                        chunk['first_prefix'] = prefix
+
+                    chunk['last_sequence'] = seq_number
+                    chunk['last_prefix'] = prefix
+
+            if compression is None:
+                f.seek(skip, io.SEEK_CUR)
+            else:
+                f.read(skip)
+
+            offset += MRT_HEADER_STRUCT.size + msg_len
+
+        gzip_members = gzip_reader.members if gzip_reader is not None else []
+
+    metadata = {
+        'file_size': st.st_size,
+        'file_mtime_ns': st.st_mtime_ns,
+        'compression': compression,
+        'uncompressed_size': offset,
+        'record_count': len(offsets),
+        'peer_index_table': peer_index_table,
+        'chunks': chunks,
+        'gzip_members': gzip_members,
+    }
+
+    return MrtIndex(metadata, offsets)
+
+
+def iterRecordRanges(file_path, start_offset, chunk_records):
+    """ Byte ranges of chunks of records of an uncompressed MRT file, only the MRT headers are read
+
+        :param file_path:       Uncompressed MRT file
+        :param start_offset:    Offset of the first record
+        :param chunk_records:   Number of records of a chunk
+
+        :return: Generator of (offset of the first record, offset after the last record)
+    """
+    with open(file_path, 'rb') as f:
+        offset = start_offset
+        f.seek(offset)
+
+        while True:
+            chunk_offset = offset
+
+            for _ in range(chunk_records):
+                header = f.read(MRT_HEADER_STRUCT.size)
+
+                if len(header) < MRT_HEADER_STRUCT.size:
+                    break
+
+                offset += MRT_HEADER_STRUCT.size + MRT_HEADER_STRUCT.unpack(header)[3]
+                f.seek(offset)
+
+            if offset == chunk_offset:
+                return
+
+            yield chunk_offset, offset
+
+
+def getIndexPath(file_path):
+    return file_path + INDEX_FILE_SUFFIX
+
+
+def isSeekable(file_path):
+    """ True if records of the file can be seeked without decompressing it from the start
+
+        Only uncompressed files and BGZF files, which are gzip files made of small members, are seekable.
+        Other multi-member gzip files can not be told apart without decompressing them.
+
+        :param file_path:       MRT file
+    """
+    compression = getCompression(file_path)
+
+    if compression is None:
+        return True
+
+    if compression != 'gzip':
+        return False
+
+    with open(file_path, 'rb') as f:
+        header = f.read(BGZF_HEADER_STRUCT.size)
+
+    if len(header) < BGZF_HEADER_STRUCT.size:
+        return False
+
+    magic, mtime, xfl, os_type, xlen, subfield_id = BGZF_HEADER_STRUCT.unpack(header)
+
+    return magic == BGZF_MAGIC and subfield_id == BGZF_SUBFIELD_ID
+
+
+def getIndex(file_path, build=True):
+    """ Index of an MRT file from its index file, built and saved if it is missing or outdated
+
+        :param file_path:       MRT file
+        :param build:           Build the index if there is no valid index file
+
+        :return: MrtIndex, None if there is no valid index file and build is False
+    """
+    index_path = getIndexPath(file_path)
+
+    index = MrtIndex.load(index_path)
+    if index is not None and index.isValidFor(file_path):
+        return index
+
+    if not build:
+        return None
+
+    index = buildIndex(file_path)
+
+    try:
+        index.save(index_path)
+    except OSError:
+        # Read only directory, the index is used in memory.
+        pass
+
+    return index
@@ -1,14 +1,34 @@
 
-import gzip
-import bz2
+import collections
+import io
 import struct
-from struct import unpack
 import mrt2bmp.HelperClasses
 import binascii
 import socket
 
-GZIP_HEADER = b'\x1f\x8b'
-BZ2_HEADER = b'\x42\x5a\x68'
+from mrt2bmp.Decompression import openMrtFile
+from mrt2bmp.MrtIndex import getIndex
+from mrt2bmp.Metrics import METRICS
+
+# Initial size of the reusable record buffer, grows on demand for larger records.
+READ_BUFFER_SIZE = 65536
+
+# Number of records between two updates of the process metrics.
+METRICS_PUBLISH_RECORDS = 4096
+
+# Precompiled decoders, unpack_from() is used on the record buffer to avoid slicing.
+MRT_HEADER_STRUCT = struct.Struct('!I H H I')
+RIB_HEADER_STRUCT = struct.Struct('!I B')
+RIB_ENTRY_STRUCT = struct.Struct('!H I H')
+ATTRIBUTE_HEADER_STRUCT = struct.Struct('!B B')
+BGP4MP_AS2_STRUCT = struct.Struct('!H H')
+BGP4MP_AS4_STRUCT = struct.Struct('!I I')
+BGP4MP_INTERFACE_STRUCT = struct.Struct('!H H')
+MP_REACH_HEADER_STRUCT = struct.Struct('!B B H')
+MP_REACH_AFI_SAFI_STRUCT = struct.Struct('!H B')
+UINT8_STRUCT = struct.Struct('!B')
+UINT16_STRUCT = struct.Struct('!H')
+UINT32_STRUCT = struct.Struct('!I')
 
 MRT_TYPES = {
     11:'OSPFv2',
@@ -75,6 +95,17 @@ BGP_ATTRIBUTES = {
     128:'ATTR_SET',            # Defined in RFC6368
 }
 
+# AFI and SAFI of the AFI/SAFI-specific RIB subtypes.
+RIB_AFI_SAFI = {
+    2:(1, 1),   # RIB_IPV4_UNICAST
+    3:(1, 2),   # RIB_IPV4_MULTICAST
+    4:(2, 1),   # RIB_IPV6_UNICAST
+    5:(2, 2),   # RIB_IPV6_MULTICAST
+}
+
+BGP_ATTRIBUTE_NEXT_HOP = 3
+BGP_ATTRIBUTE_MP_REACH_NLRI = 14
+
 class MrtFileException(Exception):
 
     def __init__(self, value):
@@ -83,54 +114,289 @@ class MrtFileException(Exception):
     def __str__(self):
         return repr(self.value)
 
+class MrtRecord():
+    """ Base class of the parsed MRT records
+
+        Records only hold the fields listed in __slots__ to keep the per-entry allocation small.
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__,
+                           ", ".join("%s=%r" % (k, getattr(self, k, None)) for k in self.__slots__))
+
+class MrtEntry(MrtRecord):
+    """ MRT header and the decoded message, mrt_entry is None for unsupported types """
+    __slots__ = ('mrt_header', 'mrt_entry')
+
+    def __init__(self, mrt_header, mrt_entry):
+        self.mrt_header = mrt_header
+        self.mrt_entry = mrt_entry
+
+class MrtHeader(MrtRecord):
+    __slots__ = ('timestamp', 'type', 'subtype', 'length')
+
+    def __init__(self, timestamp, type, subtype, length):
+        self.timestamp = timestamp
+        self.type = type
+        self.subtype = subtype
+        self.length = length
+
+class PeerIndexTable(MrtRecord):
+    """ PEER_INDEX_TABLE, peer_list is a list of dicts as stored in router_pit.json """
+    __slots__ = ('collector_id', 'view_length', 'view_name', 'peer_count', 'peer_list')
+
+    def __init__(self, collector_id, view_length, view_name, peer_count, peer_list):
+        self.collector_id = collector_id
+        self.view_length = view_length
+        self.view_name = view_name
+        self.peer_count = peer_count
+        self.peer_list = peer_list
+
+class RibRecord(MrtRecord):
+    """ AFI/SAFI-specific RIB record, raw_prefix_nlri is the prefix encoded as BGP NLRI """
+    __slots__ = ('seq_number', 'prefix_len', 'prefix', 'entry_count', 'raw_prefix_nlri', 'rib_entries')
+
+    def __init__(self, seq_number, prefix_len, prefix, entry_count, raw_prefix_nlri, rib_entries):
+        self.seq_number = seq_number
+        self.prefix_len = prefix_len
+        self.prefix = prefix
+        self.entry_count = entry_count
+        self.raw_prefix_nlri = raw_prefix_nlri
+        self.rib_entries = rib_entries
+
+class RibEntry(MrtRecord):
+    """ RIB entry of a peer
+
+        raw_bgp_attributes are the path attributes without NEXT_HOP/MP_REACH_NLRI, which is
+        re-encoded in raw_mp_reach_nlri (None if the entry has no next hop). bgp_attribute_list
+        is None when the parser runs in raw only mode.
+    """
+    __slots__ = ('peer_index', 'originated_time', 'attribute_length', 'raw_bgp_attributes',
+                 'raw_mp_reach_nlri', 'bgp_attribute_list')
+
+    def __init__(self, peer_index, originated_time, attribute_length, raw_bgp_attributes, raw_mp_reach_nlri,
+                 bgp_attribute_list):
+        self.peer_index = peer_index
+        self.originated_time = originated_time
+        self.attribute_length = attribute_length
+        self.raw_bgp_attributes = raw_bgp_attributes
+        self.raw_mp_reach_nlri = raw_mp_reach_nlri
+        self.bgp_attribute_list = bgp_attribute_list
+
+class BgpAttribute(MrtRecord):
+    __slots__ = ('flag', 'type', 'len')
+
+    def __init__(self, flag, type, len):
+        self.flag = flag
+        self.type = type
+        self.len = len
+
+class Bgp4mpMessage(MrtRecord):
+    __slots__ = ('peer_as', 'local_as', 'interface_index', 'address_family', 'peer_ip', 'local_ip',
+                 'raw_peer_ip', 'raw_bgp_message')
+
+    def __init__(self, peer_as, local_as, interface_index, address_family, peer_ip, local_ip, raw_peer_ip,
+                 raw_bgp_message):
+        self.peer_as = peer_as
+        self.local_as = local_as
+        self.interface_index = interface_index
+        self.address_family = address_family
+        self.peer_ip = peer_ip
+        self.local_ip = local_ip
+        self.raw_peer_ip = raw_peer_ip
+        self.raw_bgp_message = raw_bgp_message
+
 class MrtParser():
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, raw_only=False, index=None):
+        """ Constructor
 
-        f = open(file_path, 'rb')
+            :param file_path:       MRT file, plain or gzip/bz2/xz/zstd compressed, or a binary file object
+                                    of uncompressed records
+            :param raw_only:        Skip decoding of the per attribute list (bgp_attribute_list) in RIB entries
+            :param index:           MrtIndex of the file, loaded or built on the first seekRecord() if None
+        """
+        self._raw_only = raw_only
+        self._index = index
 
-        file_header = f.read(max(len(GZIP_HEADER), len(BZ2_HEADER)))
+        # Records and bytes parsed by (type, subtype), published to the process metrics every
+        # METRICS_PUBLISH_RECORDS records.
+        self._record_counts = collections.Counter()
+        self._record_bytes = collections.Counter()
+        self._unpublished_records = 0
 
-        if file_header.startswith(BZ2_HEADER):
-            self.f = bz2.BZ2File(file_path, 'rb')
+        # Offset of the start of self.f in the uncompressed file, not 0 if opened at a gzip member.
+        self._base_offset = 0
 
-        elif file_header.startswith(GZIP_HEADER):
-            self.f = gzip.GzipFile(file_path, 'rb')
+        if hasattr(file_path, 'readinto'):
+            self._file_path = None
+            self.f = file_path
 
         else:
-            self.f = open(file_path, 'rb')
+            self._file_path = file_path
+            self.f = openMrtFile(file_path)
+
+        # Reusable buffers, every record is read into them and decoded through memoryview offsets.
+        self._header_buf = bytearray(MRT_HEADER_STRUCT.size)
+        self._header_view = memoryview(self._header_buf)
+        self.__allocateBuffer(READ_BUFFER_SIZE)
+
+    def __allocateBuffer(self, size):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+
+    def __readInto(self, view):
+        """ Fill the view from the file, returns the number of bytes read (less than len(view) at EOF) """
+
+        read = 0
+        size = len(view)
+
+        while read < size:
+            n = self.f.readinto(view[read:])
+
+            if not n:
+                break
+
+            read += n
+
+        return read
 
     def __iter__(self):
         return self
 
-    def __next__(self):
+    def tell(self):
+        """ Offset of the next record in the uncompressed file """
+        return self._base_offset + self.f.tell()
+
+    def __reopen(self, compressed_offset, offset):
+        """ Reopen the file at a gzip member or at the start of the file (0, 0) """
+        self.f.close()
+        self.f = openMrtFile(self._file_path, compressed_offset=compressed_offset)
+        self._base_offset = offset
+
+    def seek(self, offset):
+        """ Continue with the record at offset of the uncompressed file
+
+            Compressed files are decompressed up to the offset, from the closest gzip member in the index or
+            else from the current position or the start of the file.
+
+            :param offset:      Offset of a record, as returned by tell()
+        """
+        # The file is closed at its end, seeking back reopens it.
+        if self.f.closed and self._file_path is not None:
+            self.__reopen(0, 0)
+
+        position = self.tell()
+
+        if offset == position:
+            return
 
-        entry = dict()
+        member = self._index.getGzipMember(offset) if self._index is not None else None
+
+        if member is not None and (offset < position or member[1] > position):
+            self.__reopen(*member)
+
+        elif offset < self._base_offset:
+            self.__reopen(0, 0)
+
+        try:
+            self.f.seek(offset - self._base_offset)
+
+        except io.UnsupportedOperation:
+            # Decompressed streams read ahead in a background thread only seek forward.
+            if self._file_path is None:
+                raise
+
+            self.__reopen(0, 0)
+            self.f.seek(offset)
+
+    def getIndex(self):
+        """ Index of the file, loaded from or saved to the index file next to it if not passed to the constructor
+
+            :return: MrtIndex
+        """
+        if self._index is None:
+            if self._file_path is None:
+                raise MrtFileException("Index of a file object must be passed to the constructor")
+
+            self._index = getIndex(self._file_path)
+
+        return self._index
+
+    def seekRecord(self, record):
+        """ Continue with the record with the given number
+
+            :param record:      Record number, counting from 0
+        """
+        self.seek(self.getIndex().getRecordOffset(record))
+
+    def iterRecordRange(self, start, stop=None):
+        """ Iterate through a range of records
+
+            :param start:       Number of the first record
+            :param stop:        Number of the record after the last one, None for the end of the file
+        """
+        self.seekRecord(start)
+
+        if stop is None:
+            stop = len(self.getIndex())
+
+        for i in range(start, stop):
+            try:
+                yield next(self)
+            except StopIteration:
+                return
+
+    def readRawRecords(self, max_records):
+        """ Read up to max_records records without decoding them
+
+            :param max_records:     Max number of records to read
+
+            :return: MRT header and message of the records, empty at the end of the file
+        """
+        chunk = bytearray()
+
+        for i in range(max_records):
+
+            if self.__readInto(self._header_view) < MRT_HEADER_STRUCT.size:
+                break
+
+            msg_len = MRT_HEADER_STRUCT.unpack_from(self._header_buf)[3]
+
+            chunk += self._header_buf
+            chunk += self.f.read(msg_len)
+
+        return chunk
+
+    def __next__(self):
 
         # Parse mrt header.
-        entry['mrt_header'] = {}
-        self.parseMrtHeader(entry['mrt_header'])
+        mrt_header = self.parseMrtHeader()
 
         # Parse mrt entry.
-        entry['mrt_entry'] = {}
-        msg_len = entry['mrt_header']['length']
-        msg_type = entry['mrt_header']['type']
-        msg_subtype = entry['mrt_header']['subtype']
+        mrt_entry = self.parseMrtEntry(mrt_header.length, mrt_header.type, mrt_header.subtype)
+
+        key = (mrt_header.type, mrt_header.subtype)
+        self._record_counts[key] += 1
+        self._record_bytes[key] += mrt_header.length
 
-        self.parseMrtEntry( entry['mrt_entry'], msg_len, msg_type, msg_subtype)
+        self._unpublished_records += 1
+        if self._unpublished_records >= METRICS_PUBLISH_RECORDS:
+            self.publishMetrics()
 
-        return entry
+        return MrtEntry(mrt_header, mrt_entry)
 
-    def parseMrtHeader(self, mrt_header):
+    def parseMrtHeader(self):
 
         try:
-            buf = self.f.read(12)
+            n = self.__readInto(self._header_view)
 
-            if len(buf) == 0:
+            if n == 0:
                 self.close()
 
-            elif len(buf) < 12:
-                raise MrtFileException("Mrt Header length is %i < 12" % len(buf))
+            elif n < MRT_HEADER_STRUCT.size:
+                raise MrtFileException("Mrt Header length is %i < 12" % n)
 
             """
             MRT HEADER:
@@ -149,52 +415,44 @@ class MrtParser():
 
             """
 
-            mrt_header['timestamp'], mrt_header['type'], mrt_header['subtype'], mrt_header['length'] = unpack('!I H H I', buf)
+            return MrtHeader(*MRT_HEADER_STRUCT.unpack_from(self._header_buf))
 
         except MrtFileException as e:
             print ('Mrt File exception occurred: ', e.value)
             self.close()
 
-    def parseMrtEntry(self, mrt_message, msg_len, msg_type, msg_subtype):
+    def parseMrtEntry(self, msg_len, msg_type, msg_subtype):
 
         try:
-            buf = self.f.read(msg_len)
+            if msg_len > len(self._buf):
+                self.__allocateBuffer(msg_len)
 
-            if len(buf) < msg_len:
-                raise MrtFileException(("Mrt message (data) length is %d < %d (message length)", len(buf), msg_len))
+            # Record is only valid until the next read, decoders must copy out what they keep.
+            buf = self._view[:msg_len]
+            n = self.__readInto(buf)
+
+            if n < msg_len:
+                raise MrtFileException("Mrt message (data) length is %d < %d (message length)" % (n, msg_len))
 
             if MRT_TYPES[msg_type] == 'TABLE_DUMP_V2':
-                self.parseTableDumpV2(buf, mrt_message, msg_len, msg_type, msg_subtype)
+                return self.parseTableDumpV2(buf, msg_len, msg_type, msg_subtype)
 
             elif MRT_TYPES[msg_type] == 'BGP4MP':
-                self.parseBGP4MP(buf, mrt_message, msg_len, msg_type, msg_subtype)
+                return self.parseBGP4MP(buf, msg_len, msg_type, msg_subtype)
 
         except MrtFileException as e:
             print ('Mrt File exception occurred: ', e.value)
             self.close()
 
-    def parseTableDumpV2(self, buf, mrt_message, msg_len, msg_type, msg_subtype):
+    def parseTableDumpV2(self, buf, msg_len, msg_type, msg_subtype):
 
         # AFI/SAFI-Specific RIB Subtypes
-        if TABLE_DUMP_V2_SUBTYPES[msg_subtype] == "RIB_IPV4_UNICAST" or \
-                        TABLE_DUMP_V2_SUBTYPES[msg_subtype] == "RIB_IPV6_UNICAST":
+        if msg_subtype in RIB_AFI_SAFI:
 
             p = 0
 
-            address_family = None
-            safi = 1
-            raw_nlri = b""
-            m = None
-
-            if TABLE_DUMP_V2_SUBTYPES[msg_subtype] == "RIB_IPV4_UNICAST":
-                # Address family is IPv4.
-                address_family = 1
-                m = 4
-
-            elif TABLE_DUMP_V2_SUBTYPES[msg_subtype] == "RIB_IPV6_UNICAST":
-                # Address family is IPv6.
-                address_family = 2
-                m = 16
+            address_family, safi = RIB_AFI_SAFI[msg_subtype]
+            m = 4 if ADDRESS_FAMILY[address_family] == "IPv4" else 16
 
             """
             RIB Entry Header:
@@ -212,38 +470,34 @@ class MrtParser():
            +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
             """
 
-            raw_nlri += buf[p+4:p+5]
-
-            mrt_message['seq_number'], mrt_message['prefix_len'] = \
-                unpack('!I B', buf[p:p + 5])
-            p += 5
+            seq_number, prefix_len = RIB_HEADER_STRUCT.unpack_from(buf, p)
 
             # Parse prefix.
-            n = mrt_message['prefix_len']
-            prefix_length_in_bytes = int(mrt_message['prefix_len'] / 8) + (mrt_message['prefix_len'] % 8 > 0)
-            raw_nlri += buf[p:p + prefix_length_in_bytes]
+            prefix_length_in_bytes = (prefix_len + 7) // 8
 
-            n = m if n < 0 else (n + 7) // 8
+            # Raw NLRI is the prefix length octet followed by the prefix, both are contiguous in the record.
+            raw_nlri = bytes(buf[p + 4:p + 5 + prefix_length_in_bytes])
+            p += 5
 
             if ADDRESS_FAMILY[address_family] == "IPv4":
                 # Address family is IPv4.
-                mrt_message['prefix'] = socket.inet_ntop(socket.AF_INET, buf[p:p+n] + b'\x00' * (m - n))
+                prefix = socket.inet_ntop(socket.AF_INET, raw_nlri[1:] + b'\x00' * (m - prefix_length_in_bytes))
 
             elif ADDRESS_FAMILY[address_family] == "IPv6":
                 # Address family is IPv6.
-                mrt_message['prefix'] = socket.inet_ntop(socket.AF_INET6, buf[p:p+n] + b'\x00' * (m - n))
+                prefix = socket.inet_ntop(socket.AF_INET6, raw_nlri[1:] + b'\x00' * (m - prefix_length_in_bytes))
 
             p += prefix_length_in_bytes
 
-            mrt_message['entry_count'] = unpack('!H', buf[p:p + 2])[0]
+            entry_count = UINT16_STRUCT.unpack_from(buf, p)[0]
             p += 2
 
-            mrt_message['raw_prefix_nlri'] = raw_nlri
+            rib_entries = []
 
-            mrt_message['rib_entries'] = []
+            if entry_count > 0:
+                self.parseRibEntries(buf[p:], rib_entries, address_family, safi, raw_nlri)
 
-            if mrt_message['entry_count'] > 0:
-                self.parseRibEntries(buf[p:], mrt_message['rib_entries'], address_family, safi, raw_nlri)
+            return RibRecord(seq_number, prefix_len, prefix, entry_count, raw_nlri, rib_entries)
 
         elif TABLE_DUMP_V2_SUBTYPES[msg_subtype] == "PEER_INDEX_TABLE":
             p = 0
@@ -263,21 +517,23 @@ class MrtParser():
 
             """
 
-            mrt_message['collector_id'] = socket.inet_ntop(socket.AF_INET, buf[p:p+4])
+            collector_id = socket.inet_ntop(socket.AF_INET, buf[p:p+4])
             p += 4
 
-            mrt_message['view_length'] = struct.unpack("!H", buf[p:p+2])[0]
+            view_length = UINT16_STRUCT.unpack_from(buf, p)[0]
             p += 2
 
-            mrt_message['view_name'] = buf[p:p+mrt_message['view_length']]
-            p += mrt_message['view_length']
+            view_name = bytes(buf[p:p+view_length])
+            p += view_length
 
-            mrt_message['peer_count'] = struct.unpack("!H", buf[p:p+2])[0]
+            peer_count = UINT16_STRUCT.unpack_from(buf, p)[0]
             p += 2
 
-            mrt_message['peer_list'] = []
+            peer_list = []
 
-            self.parsePeerEntries(buf[p:], mrt_message['peer_list'], mrt_message['peer_count'])
+            self.parsePeerEntries(buf[p:], peer_list, peer_count)
+
+            return PeerIndexTable(collector_id, view_length, view_name, peer_count, peer_list)
 
     def parsePeerEntries(self, buf, peer_list, peer_count):
 
@@ -304,7 +560,7 @@ class MrtParser():
 
             peer_entry = dict()
 
-            peer_entry['type'] = struct.unpack("!B", buf[p:p+1])[0]
+            peer_entry['type'] = UINT8_STRUCT.unpack_from(buf, p)[0]
             p += 1
 
             peer_entry['bgp_id'] = socket.inet_ntop(socket.AF_INET, buf[p:p+4])
@@ -320,7 +576,7 @@ class MrtParser():
 
                 afi = socket.AF_INET
                 ip_length = 4
-                asn = "!H"
+                asn = UINT16_STRUCT
 
             elif peer_entry['type'] == 1:
                 peer_entry['as_number_size'] = 2
@@ -328,7 +584,7 @@ class MrtParser():
 
                 afi = socket.AF_INET6
                 ip_length = 16
-                asn = "!H"
+                asn = UINT16_STRUCT
 
             elif peer_entry['type'] == 2:
                 peer_entry['as_number_size'] = 4
@@ -336,19 +592,19 @@ class MrtParser():
 
                 afi = socket.AF_INET
                 ip_length = 4
-                asn = "!I"
+                asn = UINT32_STRUCT
 
             elif peer_entry['type'] == 3:
                 peer_entry['as_number_size'] = 4
                 peer_entry['ip_address_family'] = 'IPv6'
                 afi = socket.AF_INET6
                 ip_length = 16
-                asn = "!I"
+                asn = UINT32_STRUCT
 
             peer_entry['ip_address'] = socket.inet_ntop(afi, buf[p:p+ip_length])
             p += ip_length
 
-            peer_entry['asn'] = struct.unpack(asn, buf[p:p+peer_entry['as_number_size']])[0]
+            peer_entry['asn'] = asn.unpack_from(buf, p)[0]
             p += peer_entry['as_number_size']
 
             peer_list.append(peer_entry)
@@ -373,76 +629,81 @@ class MrtParser():
        +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
         """
 
-        while p < len(buf):
+        buf_len = len(buf)
+        unpack_rib_entry = RIB_ENTRY_STRUCT.unpack_from
 
-            rib_entry = dict()
+        while p < buf_len:
 
-            rib_entry['peer_index'], rib_entry['originated_time'], rib_entry['attribute_length'] = \
-                unpack('!H I H', buf[p:p+8])
+            peer_index, originated_time, attribute_length = unpack_rib_entry(buf, p)
             p += 8
 
             # Parse BGP attributes.
-            rib_entry['bgp_attribute_list'] = []
-            rib_entry['raw_bgp_attributes'] = []
-            rib_entry['raw_mp_reach_nlri'] = dict()
+            bgp_attribute_list = None if self._raw_only else []
 
-            self.parseBgpAttributes(buf[p:p+rib_entry['attribute_length']], rib_entry['bgp_attribute_list'],
-                                   rib_entry['raw_bgp_attributes'], rib_entry['attribute_length'], address_family, safi, raw_nlri, rib_entry['raw_mp_reach_nlri'])
+            raw_bgp_attributes, raw_mp_reach_nlri = self.parseBgpAttributes(buf[p:p+attribute_length], bgp_attribute_list,
+                                                                            attribute_length, address_family, safi)
 
-            p += rib_entry['attribute_length']
+            p += attribute_length
 
-            # Set NEW bgp path attributes length.
-            rib_entry['raw_attribute_length'] = len(rib_entry['raw_bgp_attributes'])
+            rib_entries.append(RibEntry(peer_index, originated_time, attribute_length, raw_bgp_attributes,
+                                        raw_mp_reach_nlri, bgp_attribute_list))
 
-            rib_entries.append(rib_entry)
+    def parseBgpAttributes(self, buf, bgp_attribute_list, attr_length, address_family, safi):
+        """ Parse path attributes of a RIB entry
 
-    def parseBgpAttributes(self, buf, bgp_attribute_list, raw_bgp_attributes, attr_length, address_family, safi, raw_nlri, raw_mp_reach_nlri):
+            :param bgp_attribute_list:  List to add a BgpAttribute per attribute to, None to skip it
+
+            :return: Tuple of raw path attributes without NEXT_HOP/MP_REACH_NLRI and the MP_REACH_NLRI
+                     attribute value (None if there is no next hop)
+        """
 
         p = 0
+        raw_bgp_attributes = []
+        raw_mp_reach_nlri = None
+        unpack_attribute_header = ATTRIBUTE_HEADER_STRUCT.unpack_from
+        unpack_uint16 = UINT16_STRUCT.unpack_from
+
+        # Start of the current run of attributes copied as-is, runs are only broken by NEXT_HOP/MP_REACH_NLRI.
+        run_start = 0
 
         while p < attr_length:
 
             start = p
 
-            bgp_path_attribute = dict()
-
-            bgp_path_attribute['flag'], bgp_path_attribute['type'] = unpack('!B B', buf[p:p+2])
+            attr_flag, attr_type = unpack_attribute_header(buf, p)
             p += 2
 
-            if bgp_path_attribute['flag'] & 0x01 << 4:
+            if attr_flag & 0x01 << 4:
 
-                bgp_path_attribute['len'] = unpack('!H', buf[p:p+2])[0]
+                attr_len = unpack_uint16(buf, p)[0]
                 p += 2
 
             else:
-                bgp_path_attribute['len'] = unpack('!B', buf[p:p+1])[0]
+                attr_len = buf[p]
                 p += 1
 
-            end = p + bgp_path_attribute['len']
-
             """
                 Only NEXT_HOP or MP_REACH_NLRI exists, both of them cannot co-exist in path attributes.
             """
             # Parse out NEXT_HOP attribute
-            if BGP_ATTRIBUTES[bgp_path_attribute['type']] == 'NEXT_HOP':
+            if attr_type == BGP_ATTRIBUTE_NEXT_HOP:
+
+                if start > run_start:
+                    raw_bgp_attributes.append(bytes(buf[run_start:start]))
 
-                if ADDRESS_FAMILY[address_family] == "IPv4":
-                    # Address family is IPv4.
-                    raw_next_hop = buf[p:p + 4]
-                    raw_next_hop_length = struct.pack("!B", 4)
-                    p += 4
+                # NEXT_HOP is an IPv4 address, use the attribute length rather than the address family of
+                # the RIB subtype so the record is not overrun.
+                raw_next_hop = buf[p:p + attr_len]
+                raw_next_hop_length = UINT8_STRUCT.pack(attr_len)
+                p += attr_len
 
-                elif ADDRESS_FAMILY[address_family] == "IPv6":
-                    # Address family is IPv6.
-                    raw_next_hop = buf[p:p + 16]
-                    raw_next_hop_length = struct.pack("!B", 16)
-                    p += 16
+                run_start = p
 
                 # Add MP_REACH_NLRI attribute to raw attribute value.
-                raw_mp_reach_nlri['value'] = self.crateMpReachNlriAttributeRaw(address_family, safi, (raw_next_hop_length + raw_next_hop), b"")
+                raw_mp_reach_nlri = self.crateMpReachNlriAttributeRaw(address_family, safi, (raw_next_hop_length + raw_next_hop), b"")
 
             # Parse out MP_REACH attribute
-            elif BGP_ATTRIBUTES[bgp_path_attribute['type']] == 'MP_REACH_NLRI':
+            elif attr_type == BGP_ATTRIBUTE_MP_REACH_NLRI:
 
                 """
                 There is one exception to the encoding of BGP attributes for the BGP
@@ -452,17 +713,30 @@ class MrtParser():
                 Next Hop Address fields are included.
                 """
 
-                raw_next_hop_attr = buf[p:p+bgp_path_attribute['len']]
+                if start > run_start:
+                    raw_bgp_attributes.append(bytes(buf[run_start:start]))
 
-                p += bgp_path_attribute['len']
-                raw_mp_reach_nlri['value'] = self.crateMpReachNlriAttributeRaw(address_family, safi, raw_next_hop_attr, b"")
+                raw_next_hop_attr = buf[p:p+attr_len]
+
+                p += attr_len
+                run_start = p
+
+                raw_mp_reach_nlri = self.crateMpReachNlriAttributeRaw(address_family, safi, raw_next_hop_attr, b"")
 
             # No parsing for other attributes.
             else:
-                p += bgp_path_attribute['len']
-                raw_bgp_attributes.append(buf[start:end])
+                p += attr_len
+
+            if bgp_attribute_list is not None:
+                bgp_attribute_list.append(BgpAttribute(attr_flag, attr_type, attr_len))
 
-            bgp_attribute_list.append(bgp_path_attribute)
+        if attr_length > run_start:
+            raw_bgp_attributes.append(bytes(buf[run_start:attr_length]))
+
+        if len(raw_bgp_attributes) == 1:
+            return raw_bgp_attributes[0], raw_mp_reach_nlri
+
+        return b"".join(raw_bgp_attributes), raw_mp_reach_nlri
 
 
     def getMpReachNlriAttributeHeader(self, attr_length):
@@ -474,7 +748,7 @@ class MrtParser():
         # Create attribute type code.
         attr_type_code = 14
 
-        return struct.pack("!B B H", attr_flag, attr_type_code, attr_length)
+        return MP_REACH_HEADER_STRUCT.pack(attr_flag, attr_type_code, attr_length)
 
     def crateMpReachNlriAttributeRaw(self, afi, safi, raw_next_hop, raw_nlri):
 
@@ -497,13 +771,9 @@ class MrtParser():
 
         """
 
-        reserved_raw = struct.pack("!B", 0)
-
-        attr_body = struct.pack("!H B", afi, safi) + raw_next_hop + reserved_raw + raw_nlri
+        return b"".join((MP_REACH_AFI_SAFI_STRUCT.pack(afi, safi), raw_next_hop, b'\x00', raw_nlri))
 
-        return attr_body
-
-    def parseBGP4MP(self, buf, mrt_message, msg_len, msg_type, msg_subtype):
+    def parseBGP4MP(self, buf, msg_len, msg_type, msg_subtype):
 
         if (BGP4MP_SUBTYPES[msg_subtype] == "BGP4MP_MESSAGE_AS4"
             or BGP4MP_SUBTYPES[msg_subtype] == "BGP4MP_MESSAGE"):
@@ -550,36 +820,70 @@ class MrtParser():
 
             if BGP4MP_SUBTYPES[msg_subtype] == "BGP4MP_MESSAGE_AS4":
                 offset = 8
-                mrt_message['peer_as'], mrt_message['local_as'] = unpack("!II", buf[p: p + offset])
+                peer_as, local_as = BGP4MP_AS4_STRUCT.unpack_from(buf, p)
 
             else:
                 offset = 4
-                mrt_message['peer_as'], mrt_message['local_as'] = unpack("!HH", buf[p: p + offset])
+                peer_as, local_as = BGP4MP_AS2_STRUCT.unpack_from(buf, p)
 
             p += offset
 
-            mrt_message['interface_index'], mrt_message['address_family'] = unpack('!HH', buf[p:p+4])
+            interface_index, address_family = BGP4MP_INTERFACE_STRUCT.unpack_from(buf, p)
             p += 4
 
+            peer_ip = None
+            local_ip = None
+            raw_peer_ip = None
+
             # IPv4
-            if ADDRESS_FAMILY[mrt_message['address_family']] == "IPv4":
-                mrt_message['peer_ip'] = socket.inet_ntop(socket.AF_INET, buf[p:p+4])
+            if ADDRESS_FAMILY[address_family] == "IPv4":
+                raw_peer_ip = bytes(buf[p:p+4])
+                peer_ip = socket.inet_ntop(socket.AF_INET, raw_peer_ip)
                 p += 4
 
-                mrt_message['local_ip'] = socket.inet_ntop(socket.AF_INET, buf[p:p+4])
+                local_ip = socket.inet_ntop(socket.AF_INET, buf[p:p+4])
                 p += 4
 
 
             # IPv6
-            elif ADDRESS_FAMILY[mrt_message['address_family']] == "IPv6":
-                mrt_message['peer_ip'] = socket.inet_ntop(socket.AF_INET6, buf[p:p+16])
+            elif ADDRESS_FAMILY[address_family] == "IPv6":
+                raw_peer_ip = bytes(buf[p:p+16])
+                peer_ip = socket.inet_ntop(socket.AF_INET6, raw_peer_ip)
                 p += 16
 
-                mrt_message['local_ip'] = socket.inet_ntop(socket.AF_INET6, buf[p:p+16])
+                local_ip = socket.inet_ntop(socket.AF_INET6, buf[p:p+16])
                 p += 16
 
-            mrt_message['raw_bgp_message'] = buf[p:]
+            return Bgp4mpMessage(peer_as, local_as, interface_index, address_family, peer_ip, local_ip, raw_peer_ip,
+                                 bytes(buf[p:]))
+
+    def publishMetrics(self):
+        """ Add the records parsed since the last call to the process metrics """
+        for (msg_type, msg_subtype), count in self._record_counts.items():
+
+            if msg_type == 13:
+                subtype = TABLE_DUMP_V2_SUBTYPES.get(msg_subtype, str(msg_subtype))
+            elif msg_type == 16 or msg_type == 17:
+                subtype = BGP4MP_SUBTYPES.get(msg_subtype, str(msg_subtype))
+            else:
+                subtype = "%d_%d" % (msg_type, msg_subtype)
+
+            labels = (('subtype', subtype),)
+
+            METRICS.inc('mrt_records_total', count, labels)
+            METRICS.inc('mrt_bytes_total', self._record_bytes[(msg_type, msg_subtype)], labels)
+
+            # A RIB record holds one prefix.
+            if msg_type == 13 and msg_subtype in RIB_AFI_SAFI:
+                METRICS.inc('mrt_prefixes_total', count, labels)
+
+        self._record_counts.clear()
+        self._record_bytes.clear()
+        self._unpublished_records = 0
+
+        METRICS.flush()
 
     def close(self):
+        self.publishMetrics()
         self.f.close()
         raise StopIteration
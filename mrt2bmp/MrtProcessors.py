@@ -1,6 +1,9 @@
+import collections
+import io
 import json
 import multiprocessing
 import os
+import queue
 import time
 import sys
 import struct
@@ -10,9 +13,20 @@ import datetime
 import traceback
 import struct
 from struct import calcsize, pack
-from mrt2bmp.HelperClasses import MessageBucket, deleteMrtFile, BMP_Helper, BGP_Helper, cleanupMrtDir
+from mrt2bmp.HelperClasses import MessageBucket, MessageBucketCache, PeerIndex, PEER_HEADER_CACHE, AttributeTable, \
+    deleteMrtFile, BGP_MAX_MESSAGE_SIZE, BGP_MAX_EXTENDED_MESSAGE_SIZE, BMP_Helper, BGP_Helper, cleanupMrtDir
 from mrt2bmp.MrtParser import MrtParser
-from mrt2bmp.CollectorSender import BMPWriter
+from mrt2bmp.MrtIndex import getIndex, getIndexPath, iterRecordRanges
+from mrt2bmp.Decompression import getCompression
+from mrt2bmp.CollectorSender import createBMPWriter
+from mrt2bmp.ForwardQueue import createForwardQueue
+from mrt2bmp.FileWatcher import createFileWatcher, IGNORED_FILE_SUFFIXES
+from mrt2bmp.Metrics import METRICS, initMetrics
+from mrt2bmp.Checkpoint import CheckpointJournal, JOURNAL_FILE_NAME, createCheckpointMessage, createPromoteMessage
+from mrt2bmp.RibDelta import RibDelta, FINGERPRINT_FILE_NAME, RIB_SUBTYPE_AFI_SAFI, getPeerKey, \
+    discardPendingFingerprints
+from mrt2bmp.UpdateCompactor import UpdateCompactor, parseUpdate
+from mrt2bmp.ReplayScheduler import ReplayScheduler
 from mrt2bmp.logger import init_mp_logger
 
 MRT_TYPES = {
@@ -36,9 +50,187 @@ TABLE_DUMP_V2_SUBTYPES = {
     6: 'RIB_GENERIC',
 }
 
+# AFI/SAFI-specific RIB subtypes converted to route monitoring messages.
+RIB_SUBTYPES = ('RIB_IPV4_UNICAST', 'RIB_IPV4_MULTICAST', 'RIB_IPV6_UNICAST', 'RIB_IPV6_MULTICAST')
+
+# Number of update records between two slices of an interleaved RIB.
+INTERLEAVE_UPDATE_RECORDS = 1000
+
+class RibFileReader():
+    """ Single pass reader of a RIB file
+
+        The PEER_INDEX_TABLE is read when the file is opened and kept, iterating the reader continues with
+        the RIB records of the same stream so the file is decompressed only once.
+    """
+
+    def __init__(self, file_path, index=None):
+        """ Constructor
+
+            :param file_path:       RIB file
+            :param index:           MrtIndex of the file, the PEER_INDEX_TABLE is read at its offset
+        """
+        self._mp = MrtParser(file_path, raw_only=True, index=index)
+        self.file_path = file_path
+        self.index = index
+        self.peer_index_table = None
+
+        if index is not None and index.peer_index_table is not None:
+            self._mp.seek(index.peer_index_table['offset'])
+
+        for m in self._mp:
+
+            if m.mrt_header.type == 13 and m.mrt_header.subtype == 1:
+                self.peer_index_table = m.mrt_entry
+                break
+
+    def __iter__(self):
+        return self._mp
+
+    def readRawRecords(self, max_records):
+        return self._mp.readRawRecords(max_records)
+
+    def tell(self):
+        return self._mp.tell()
+
+    def seek(self, offset):
+        self._mp.seek(offset)
+
+    def close(self):
+        """ Close the file, stops the decompression thread of compressed files """
+        self._mp.f.close()
+
+
+class MessageList(list):
+    """ List collecting BMP messages, used in place of the forward queue by RIB pool workers """
+
+    def put(self, qm):
+        self.append(qm)
+
+
+class RibBucketBuilder():
+    """ Packs the prefixes of RIB records into MessageBucket objects by peer and path attributes """
+
+    def __init__(self, peer_index_table, forward_queue, cfg):
+        self._peer_index_table = peer_index_table
+        self._forward_queue = forward_queue
+
+        self._max_message_size = BGP_MAX_EXTENDED_MESSAGE_SIZE if cfg.get('extended_messages', False) \
+            else BGP_MAX_MESSAGE_SIZE
+
+        # Bounded cache of MessageBucket objects.
+        self.message_bucket_cache = MessageBucketCache(cfg.get('rib_max_buckets', 0),
+                                                       cfg.get('rib_max_bucket_memory', 0))
+
+        # Path attribute sets of the open buckets, dropped with them.
+        self._attribute_table = AttributeTable()
+
+    def addRibRecord(self, m):
+
+        if MRT_TYPES[m.mrt_header.type] == 'TABLE_DUMP_V2' and \
+                TABLE_DUMP_V2_SUBTYPES[m.mrt_header.subtype] in RIB_SUBTYPES:
+
+            raw_prefix_nlri = m.mrt_entry.raw_prefix_nlri
+
+            for e in m.mrt_entry.rib_entries:
+
+                # Key consists of peer index and id of the raw path attributes and MP_REACH_NLRI. The latter
+                # holds AFI/SAFI and next hop, so every address family is packed in its own buckets.
+                attribute_id, raw_path_attributes, mp_reach_attribute = \
+                    self._attribute_table.intern(e.raw_bgp_attributes, e.raw_mp_reach_nlri)
+
+                bucket_key = (e.peer_index, attribute_id)
+
+                # Add the prefix to the corresponding MessageBucket.
+                if not self.message_bucket_cache.addPrefix(bucket_key, raw_prefix_nlri):
+                    try:
+                        if mp_reach_attribute is None:
+                            raise KeyError('raw_mp_reach_nlri')
+
+                        # Create message bucket for the key.
+                        peer = self._peer_index_table[e.peer_index]
+
+                        self.message_bucket_cache.addBucket(bucket_key, MessageBucket(peer, raw_path_attributes,
+                                                            raw_prefix_nlri, mp_reach_attribute, self._forward_queue,
+                                                            self._max_message_size))
+
+                    except KeyError as ex:
+                        print("traceback caught when reading ribFile: %r (%r)" % (ex, e))
+                    except:
+                        pass
+
+    def finalize(self):
+
+        # Send existing bucket messages.
+        self.message_bucket_cache.finalize()
+        self._attribute_table.clear()
+
+
+# Start method of the RIB pool. Workers are not forked from the router process, which runs the decompression
+# thread of the RIB reader, as a fork copies locks held by other threads.
+RIB_POOL_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def getRibPoolContext():
+    """ Multiprocessing context of the RIB pool
+
+        Queues and locks passed to the pool workers, like the metrics queue, must be created from this context.
+    """
+    return multiprocessing.get_context(RIB_POOL_START_METHOD)
+
+
+# Peer index table and config of a RIB pool worker, set by initRibWorker.
+_rib_worker_state = None
+
+def initRibWorker(peer_index_table, cfg, metrics_queue=None):
+    global _rib_worker_state
+    _rib_worker_state = (peer_index_table, cfg)
+
+    # Workers are not forked, the metrics queue of the parent is passed on.
+    if metrics_queue is not None:
+        initMetrics(metrics_queue)
+
+def convertRibChunk(chunk):
+    """ Convert a chunk of raw RIB records to BMP route monitoring messages in a pool worker
+
+        :param chunk:       MRT records as read by MrtParser.readRawRecords()
+
+        :return: List of BMP messages
+    """
+    peer_index_table, cfg = _rib_worker_state
+
+    messages = MessageList()
+    builder = RibBucketBuilder(peer_index_table, messages, cfg)
+
+    for m in MrtParser(io.BytesIO(chunk), raw_only=True):
+        builder.addRibRecord(m)
+
+    builder.finalize()
+
+    # The pool is terminated when the file is done, counts must not wait for the flush interval.
+    METRICS.flush(True)
+
+    return messages
+
+def convertRibFileRange(file_path, start_offset, end_offset):
+    """ Convert the RIB records in a byte range of an uncompressed RIB file in a pool worker
+
+        :param file_path:       Uncompressed RIB file
+        :param start_offset:    Offset of the first record
+        :param end_offset:      Offset after the last record
+
+        :return: List of BMP messages
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(start_offset)
+        chunk = f.read(end_offset - start_offset)
+
+    return convertRibChunk(chunk)
+
+
 class RibProcessor():
 
-    def __init__(self, file_path, directory_path, router_name, collector_id, forward_queue, log_queue):
+    def __init__(self, file_path, directory_path, router_name, collector_id, forward_queue, log_queue, rib_reader=None,
+                 cfg=None, start_offset=0):
         self._file_path = file_path
         self._directory_path = directory_path
         self._router_name = router_name
@@ -51,74 +243,222 @@ class RibProcessor():
         if os.path.exists(os.path.join(self._directory_path, self._router_name, 'bgpdata')):
             self.working_dir = os.path.join(self._directory_path, self._router_name, 'bgpdata')
 
+        # Reader shared with RouterProcessor, PIT and RIB entries come from the same pass over the file.
+        self._rib_reader = rib_reader
+        if self._rib_reader is None:
+            self._rib_reader = RibFileReader(os.path.join(self.working_dir, self._file_path))
+
+        self._cfg = cfg or {}
+        self._extended_messages = self._cfg.get('extended_messages', False)
+
+        # Number of worker processes converting chunks of RIB records, 1 converts in this process.
+        self._rib_workers = self._cfg.get('rib_workers', 1)
+        self._rib_chunk_records = self._cfg.get('rib_chunk_records', 10000)
+
+        # Number of records between two checkpoints, 0 disables checkpoints.
+        self._checkpoint_interval = self._cfg.get('checkpoint_interval', 0)
+        self._journal_path = os.path.join(self.working_dir, JOURNAL_FILE_NAME)
+        self._start_offset = start_offset
+
+        # Only send the changes against the last RIB, see RibDelta.
+        self._rib_delta_mode = self._cfg.get('rib_delta_mode', False)
+
+        # Peers sent up or down for this RIB.
+        self._changed_peers = []
+
         # Peer index table is array of dictionaries.
         self._peer_index_table = []
         self.__setPeerIndexTable()
         self.__savePeerIndexTable()
 
-        # Dictionary of MessageBucket objects.
-        self.message_bucket_dict = {}
+    # Main process function to be called.
+    def processRibFile(self):
 
+        if self._rib_delta_mode:
+            self.__processRibFileDelta()
+            return
 
+        # Continue after the last checkpoint written to the collector.
+        if self._start_offset > self._rib_reader.tell():
+            self._rib_reader.seek(self._start_offset)
 
-    # Main process function to be called.
-    def processRibFile(self):
+        if self._rib_workers > 1:
+            self.__processRibFileParallel()
+            return
 
-        # Iterate through update file.
-        mp = MrtParser(os.path.join(self.working_dir, self._file_path))
+        builder = RibBucketBuilder(self._peer_index_table, self._forward_queue, self._cfg)
+        records = 0
 
-        for m in mp:
+        # Iterate through the RIB records following the peer index table.
+        for m in self._rib_reader:
+            builder.addRibRecord(m)
+            records += 1
 
-            if MRT_TYPES[m['mrt_header']['type']] == 'TABLE_DUMP_V2' and \
-                    (TABLE_DUMP_V2_SUBTYPES[m['mrt_header']['subtype']] == 'RIB_IPV4_UNICAST'):
+            # Send all open buckets, the checkpoint covers every record read so far.
+            if self._checkpoint_interval and records % self._checkpoint_interval == 0:
+                builder.finalize()
+                self._forward_queue.put(createCheckpointMessage(self._journal_path, self._file_path,
+                                                                self._rib_reader.tell()))
 
-                raw_prefix_nlri = m['mrt_entry']['raw_prefix_nlri']
+        builder.finalize()
 
-                for e in m['mrt_entry']['rib_entries']:
+    def processRibSlices(self, slice_records, route_filter=None):
+        """ Convert the RIB records in this process in slices, yielding after every slice
 
-                    # Key consists of peer index and hash of raw path attributes.
-                    raw_path_attributes = b"".join(e['raw_bgp_attributes'])
-                    bucket_key = str(e['peer_index']) + str(hash(raw_path_attributes))
+            The open buckets are sent at the end of a slice, so the messages of all records converted so far are
+            in the forward queue whenever the generator yields.
 
-                    if bucket_key in self.message_bucket_dict:
+            :param slice_records:   Number of RIB records of a slice
+            :param route_filter:    Function of an AFI/SAFI-specific RIB record returning its RIB entries to convert
+        """
+        # Continue after the last checkpoint written to the collector.
+        if self._start_offset > self._rib_reader.tell():
+            self._rib_reader.seek(self._start_offset)
 
-                        # Add the prefix to the corresponding MessageBucket.
-                        print(raw_prefix_nlri)
-                        self.message_bucket_dict[bucket_key].addPrefix(raw_prefix_nlri)
+        builder = RibBucketBuilder(self._peer_index_table, self._forward_queue, self._cfg)
+        records = 0
 
-                    else:
-                        try:
-                            mp_reach_attribute = e['raw_mp_reach_nlri']['value']
-                            # Create message bucket for the key.
-                            peer = self._peer_index_table[e['peer_index']]
+        for m in self._rib_reader:
 
-                            self.message_bucket_dict[bucket_key] = MessageBucket(peer, raw_path_attributes,
-                                                                                 raw_prefix_nlri, mp_reach_attribute, self._forward_queue)
+            if route_filter is not None and MRT_TYPES[m.mrt_header.type] == 'TABLE_DUMP_V2' and \
+                    TABLE_DUMP_V2_SUBTYPES.get(m.mrt_header.subtype) in RIB_SUBTYPES:
+                m.mrt_entry.rib_entries = route_filter(m)
 
-                        except KeyError as ex:
-                            print("traceback caught when reading ribFile: %r (%r)" % (ex, e))
-                        except:
-                            pass
+            builder.addRibRecord(m)
+            records += 1
 
-        # Send existing bucket messages.
-        for k in self.message_bucket_dict:
-            self.message_bucket_dict[k].finalizeBucket()
+            if self._checkpoint_interval and records % self._checkpoint_interval == 0:
+                builder.finalize()
+                self._forward_queue.put(createCheckpointMessage(self._journal_path, self._file_path,
+                                                                self._rib_reader.tell()))
 
-    # Peer Index Table functions.
-    def __setPeerIndexTable(self):
+            if records % slice_records == 0:
+                builder.finalize()
+                yield
 
-        mp = MrtParser(os.path.join(os.path.join(self.working_dir, self._file_path)))
+        builder.finalize()
 
-        for m in mp:
+    def getPeerIndexTable(self):
+        return self._peer_index_table
 
-            if m['mrt_header']['type'] == 13 and m['mrt_header']['subtype'] == 1:
+    def __processRibFileDelta(self):
+        """ Convert the RIB entries changed since the last RIB and withdraw the routes missing in this one
 
-                # Create list of dicts.
-                peer_list = m['mrt_entry']['peer_list']
+            Records are converted in this process. The fingerprint needs every record, so a resumed file is
+            read from the start and only the records after the checkpoint are converted.
+        """
+        fingerprint_path = os.path.join(self.working_dir, FINGERPRINT_FILE_NAME)
+        delta = RibDelta(fingerprint_path, self._peer_index_table, self._changed_peers)
 
-                self._peer_index_table = peer_list
+        builder = RibBucketBuilder(self._peer_index_table, self._forward_queue, self._cfg)
+        records = 0
+        unchanged = 0
 
-                break
+        for m in self._rib_reader:
+
+            if MRT_TYPES[m.mrt_header.type] != 'TABLE_DUMP_V2' or \
+                    TABLE_DUMP_V2_SUBTYPES.get(m.mrt_header.subtype) not in RIB_SUBTYPES:
+                continue
+
+            entry_count = len(m.mrt_entry.rib_entries)
+            m.mrt_entry.rib_entries = delta.filterRibRecord(m)
+            unchanged += entry_count - len(m.mrt_entry.rib_entries)
+
+            # Records up to the checkpoint were sent before the restart.
+            if self._rib_reader.tell() <= self._start_offset:
+                continue
+
+            if m.mrt_entry.rib_entries:
+                builder.addRibRecord(m)
+
+            records += 1
+
+            if self._checkpoint_interval and records % self._checkpoint_interval == 0:
+                builder.finalize()
+                self._forward_queue.put(createCheckpointMessage(self._journal_path, self._file_path,
+                                                                self._rib_reader.tell()))
+
+        builder.finalize()
+
+        withdrawn = delta.sendWithdrawals(self._forward_queue, BGP_MAX_EXTENDED_MESSAGE_SIZE if self._extended_messages
+                                          else BGP_MAX_MESSAGE_SIZE)
+
+        # The fingerprint replaces the last one once the messages of the dump are written to the collector.
+        self._forward_queue.put(createPromoteMessage(delta.save(), fingerprint_path))
+
+        METRICS.inc('rib_delta_unchanged_routes_total', unchanged)
+        METRICS.inc('rib_delta_withdrawals_total', withdrawn)
+
+    def __processRibFileParallel(self):
+        """ Convert chunks of RIB records in a process pool
+
+            Messages are put into the forward queue in file order. Buckets are finalized at the end of
+            every chunk, so prefixes are packed per chunk instead of per file. Checkpoints are only written
+            after the messages of a chunk, with the offset after that chunk, never for chunks in flight.
+        """
+        pending = collections.deque()
+        records = 0
+        chunks = self.__getRibChunks()
+
+        with getRibPoolContext().Pool(self._rib_workers, initRibWorker,
+                      (self._peer_index_table, self._cfg, METRICS.getQueue())) as pool:
+
+            while True:
+                chunk = next(chunks, None)
+
+                if chunk is not None:
+                    func, args, end_offset = chunk
+                    pending.append((pool.apply_async(func, args), end_offset))
+
+                # Forward converted chunks in order, at most two chunks per worker are in flight.
+                while pending and (chunk is None or pending[0][0].ready() or len(pending) >= 2 * self._rib_workers):
+
+                    result, forwarded_offset = pending.popleft()
+
+                    for qm in result.get():
+                        self._forward_queue.put(qm)
+
+                    # Chunks are converted with their buckets finalized, a checkpoint can follow any chunk.
+                    records += self._rib_chunk_records
+                    if self._checkpoint_interval and records >= self._checkpoint_interval:
+                        self._forward_queue.put(createCheckpointMessage(self._journal_path, self._file_path,
+                                                                        forwarded_offset))
+                        records = 0
+
+                if chunk is None:
+                    break
+
+    def __getRibChunks(self):
+        """ Chunks of RIB records to convert in the pool
+
+            Workers read the records of uncompressed files themselves, the chunks are found from the MRT
+            headers. Records of compressed files are read here and passed to the workers.
+
+            :return: Generator of (function, arguments, offset after the chunk)
+        """
+        if getCompression(self._rib_reader.file_path) is None:
+            for start_offset, end_offset in iterRecordRanges(self._rib_reader.file_path, self._rib_reader.tell(),
+                                                             self._rib_chunk_records):
+
+                yield convertRibFileRange, (self._rib_reader.file_path, start_offset, end_offset), end_offset
+
+            return
+
+        while True:
+            chunk = self._rib_reader.readRawRecords(self._rib_chunk_records)
+
+            if not chunk:
+                return
+
+            yield convertRibChunk, (chunk,), self._rib_reader.tell()
+
+    # Peer Index Table functions.
+    def __setPeerIndexTable(self):
+
+        if self._rib_reader.peer_index_table is not None:
+
+            # Create list of dicts.
+            self._peer_index_table = self._rib_reader.peer_index_table.peer_list
 
     def __savePeerIndexTable(self):
 
@@ -155,12 +495,14 @@ class RibProcessor():
         new_peers = [x for x in new_peer_list if x not in old_peer_list]
         old_peers = [x for x in old_peer_list if x not in new_peer_list]
 
+        self._changed_peers = new_peers + old_peers
+
         # Create and send peer up message for each new peer.
         for peer in new_peers:
 
             if peer['bgp_id'] != "0.0.0.0":
 
-                qm = BMP_Helper.createPeerUpMessage(peer, self._collector_id)
+                qm = BMP_Helper.createPeerUpMessage(peer, self._collector_id, self._extended_messages)
 
             else:
 
@@ -175,9 +517,111 @@ class RibProcessor():
             self._forward_queue.put(qm)
 
 
+class RibInterleaver():
+    """ Converts a RIB in slices between the records of update files
+
+        A slice of RIB records is converted every update_records update records, and while a paced replay
+        waits for the next update. The (peer, prefix) of every route in the updates sent before the RIB is
+        done is recorded, RIB entries of these routes are older than the update and not converted. The final
+        routes are the same as if the RIB was converted first.
+    """
+
+    def __init__(self, rib_processor, slice_records, update_records=INTERLEAVE_UPDATE_RECORDS):
+        """ Constructor
+
+            :param rib_processor:   RibProcessor of the RIB file
+            :param slice_records:   Number of RIB records converted at once
+            :param update_records:  Number of update records between two slices
+        """
+        self._peer_keys = [getPeerKey(peer) for peer in rib_processor.getPeerIndexTable()]
+        self._slices = rib_processor.processRibSlices(slice_records, self.__filterRibRecord)
+        self._update_records = update_records
+        self._update_count = 0
+        self._done = False
+
+        # (Peer key, AFI, SAFI, prefix) of the routes in the updates sent so far.
+        self._touched_routes = set()
+
+    def isDone(self):
+        return self._done
+
+    def touchUpdate(self, peer, raw_bgp_message):
+        """ Record the routes of a BGP message before it is sent
+
+            The prefixes of a malformed UPDATE or one of another address family are not known, the rest of the
+            RIB is converted before it as without interleaving.
+
+            :param peer:                Peer dictionary of the peer index table
+            :param raw_bgp_message:     BGP message with header
+        """
+        if self._done:
+            return
+
+        try:
+            routes = parseUpdate(raw_bgp_message)
+
+        except ValueError:
+            self.finish()
+            return
+
+        if routes:
+            peer_key = getPeerKey(peer)
+            self._touched_routes.update((peer_key, afi, safi, raw_prefix) for afi, safi, raw_prefix, _ in routes)
+
+    def countUpdateRecord(self):
+        """ Count an update record, converts the next slice every update_records records """
+        if self._done:
+            return
+
+        self._update_count += 1
+
+        if self._update_count >= self._update_records:
+            self._update_count = 0
+            self.convertSlice()
+
+    def convertSlice(self):
+        """ Convert the next slice of RIB records
+
+            :return: False once the RIB is done
+        """
+        if not self._done and next(self._slices, StopIteration) is StopIteration:
+            self.__setDone()
+
+        return not self._done
+
+    def finish(self):
+        """ Convert the rest of the RIB """
+        if not self._done:
+            for _ in self._slices:
+                pass
+
+            self.__setDone()
+
+    def __setDone(self):
+        self._done = True
+        self._touched_routes = set()
+
+    def __filterRibRecord(self, m):
+
+        if not self._touched_routes:
+            return m.mrt_entry.rib_entries
+
+        afi, safi = RIB_SUBTYPE_AFI_SAFI[m.mrt_header.subtype]
+        raw_prefix_nlri = m.mrt_entry.raw_prefix_nlri
+
+        rib_entries = [e for e in m.mrt_entry.rib_entries if e.peer_index >= len(self._peer_keys) or
+                       (self._peer_keys[e.peer_index], afi, safi, raw_prefix_nlri) not in self._touched_routes]
+
+        if len(rib_entries) != len(m.mrt_entry.rib_entries):
+            METRICS.inc('rib_interleave_superseded_routes_total', len(m.mrt_entry.rib_entries) - len(rib_entries))
+
+        return rib_entries
+
+
 class UpdateProcessor():
 
-    def __init__(self, file_path, directory_path, router_name, collector_id, forward_queue, log_queue):
+    def __init__(self, file_path, directory_path, router_name, collector_id, forward_queue, log_queue, cfg=None,
+                 start_offset=0, rib_interleaver=None):
         self._isProcessable = True
         self._peer_index_table = None
         self._file_path = file_path
@@ -187,71 +631,140 @@ class UpdateProcessor():
         self._forward_queue = forward_queue
         self._log_queue = log_queue
         self._peer_index_table= None
+        self._peer_index = None
         self.LOG = init_mp_logger("updates_processor", self._log_queue)
 
+        # Number of records between two checkpoints, 0 disables checkpoints.
+        self._checkpoint_interval = (cfg or {}).get('checkpoint_interval', 0)
+        self._start_offset = start_offset
+
+        # Use the existing index file of the update file for seeks.
+        self._mrt_index = (cfg or {}).get('mrt_index', False)
+
+        # Keep only the last state of every (peer, prefix) of a window of updates, see UpdateCompactor. The
+        # window is the file or a number of seconds of MRT timestamps.
+        self._update_compaction = (cfg or {}).get('update_compaction', False)
+        self._update_compaction_window = (cfg or {}).get('update_compaction_window', 0)
+        self._max_message_size = BGP_MAX_EXTENDED_MESSAGE_SIZE if (cfg or {}).get('extended_messages', False) \
+            else BGP_MAX_MESSAGE_SIZE
+
+        # Pace the updates by their MRT timestamps at this speed factor, 0 sends them as fast as possible.
+        self._replay_speed = (cfg or {}).get('replay_speed', 0)
+
+        # RibInterleaver of a RIB converted between the update records.
+        self._rib_interleaver = rib_interleaver
+
         #self.working_dir = os.path.join(self._directory_path, self._router_name)
         self.working_dir = self._directory_path
         if os.path.exists(os.path.join(self._directory_path, self._router_name, 'bgpdata')):
             self.working_dir = os.path.join(self._directory_path, self._router_name, 'bgpdata')
 
+        self._journal_path = os.path.join(self.working_dir, JOURNAL_FILE_NAME)
+
         # Load peer index table from router_pit.json in router directory.
         self.__loadPeerIndexTable()
 
-    def __searchInPeerIndexTable(self, peer_ip):
+    def processUpdateFile(self):
 
-        peer = None
+        if self._isProcessable:
 
-        for e in self._peer_index_table['peer_list']:
+            # Iterate through update file.
+            file_path = os.path.join(self.working_dir, self._file_path)
+            mp = MrtParser(file_path, index=getIndex(file_path, build=False) if self._mrt_index else None)
 
-            if e['ip_address'] == peer_ip:
-                peer = e
-                break
+            # Continue after the last checkpoint written to the collector.
+            if self._start_offset:
+                mp.seek(self._start_offset)
 
-        return peer
+            records = 0
 
-    def processUpdateFile(self):
+            compactor = UpdateCompactor(self._forward_queue, self._max_message_size) \
+                if self._update_compaction else None
+            window_end = None
 
-        if self._isProcessable:
+            # The RIB is converted while waiting for updates that are not due yet.
+            idle = self._rib_interleaver.convertSlice if self._rib_interleaver is not None else None
+            scheduler = ReplayScheduler(self._replay_speed, idle) if self._replay_speed else None
 
-            # Iterate through update file.
-            mp = MrtParser(os.path.join(self.working_dir, self._file_path))
+            # Offset after the last record, checkpoints of compacted updates are put at the end of a window.
+            offset = mp.tell()
 
             for m in mp:
 
-                time_stamp_seconds = m['mrt_header']['timestamp']
+                time_stamp_seconds = m.mrt_header.timestamp
+
+                if scheduler is not None:
+                    scheduler.waitFor(time_stamp_seconds)
+
+                if compactor is not None and self._update_compaction_window:
+                    if window_end is None:
+                        window_end = time_stamp_seconds + self._update_compaction_window
+
+                    elif time_stamp_seconds >= window_end:
+                        compactor.flush()
+                        window_end = time_stamp_seconds + self._update_compaction_window
+
+                        if self._checkpoint_interval:
+                            self._forward_queue.put(createCheckpointMessage(self._journal_path, self._file_path,
+                                                                            offset))
 
                 # Lookup peer in peer index table for peer bgp id
-                if m['mrt_header']['type'] == 16 and (m['mrt_header']['subtype'] == 1 or m['mrt_header']['subtype'] == 4):
+                if m.mrt_header.type == 16 and (m.mrt_header.subtype == 1 or m.mrt_header.subtype == 4):
 
                     try:
-                        peer = self.__searchInPeerIndexTable(m['mrt_entry']['peer_ip'])
+                        peer = self._peer_index.getPeer(m.mrt_entry.raw_peer_ip, m.mrt_entry.peer_as)
 
                         if peer is not None:
 
-                            if m['mrt_header']['subtype'] == 1:
-                                peer['as_number_size'] = 2
+                            # BGP4MP_MESSAGE carries 2 byte AS numbers.
+                            as_number_size = 2 if m.mrt_header.subtype == 1 else peer['as_number_size']
 
                             # Encode BMP ROUTE-MONITOR message using BMP common header + per peer header + BGP message
-                            raw_bgp_message = m['mrt_entry']['raw_bgp_message']
-
-                            per_peer_header = BMP_Helper.createBmpPerPeerHeader(0, 0, peer, time_stamp_seconds, 0)
+                            raw_bgp_message = m.mrt_entry.raw_bgp_message
 
-                            common_header = BMP_Helper.createBmpCommonHeader(3, len(per_peer_header) + len(raw_bgp_message) + 6, 0)
+                            if self._rib_interleaver is not None:
+                                self._rib_interleaver.touchUpdate(peer, raw_bgp_message)
 
-                            # Put the message in the queue.
-                            qm = common_header + per_peer_header + raw_bgp_message
+                            if compactor is None:
+                                self.__forwardBgpMessage(peer, as_number_size, time_stamp_seconds, raw_bgp_message)
 
-                            self._forward_queue.put(qm)
+                            elif not compactor.addUpdate(peer, as_number_size, time_stamp_seconds, raw_bgp_message):
+                                self.__forwardBgpMessage(peer, as_number_size, time_stamp_seconds, raw_bgp_message)
 
                     except KeyError as e:
                         self.LOG.warn("traceback caught when reading update: %r mh=(%r) mp=(%r)" % (e,
-                                                                                                    m['mrt_header'],
-                                                                                                    m['mrt_entry']))
+                                                                                                    m.mrt_header,
+                                                                                                    m.mrt_entry))
                     except:
                         self.LOG.warn("traceback caught when reading update: %r" % sys.exc_info()[0])
 
                 else:
-                    self.LOG.info("Ignoring unsupported update type: %d subtype: %d" %(m['mrt_header']['type'], m['mrt_header']['subtype']))
+                    self.LOG.info("Ignoring unsupported update type: %d subtype: %d" %(m.mrt_header.type, m.mrt_header.subtype))
+
+                if self._rib_interleaver is not None:
+                    self._rib_interleaver.countUpdateRecord()
+
+                records += 1
+                if compactor is not None:
+                    offset = mp.tell()
+
+                elif self._checkpoint_interval and records % self._checkpoint_interval == 0:
+                    self._forward_queue.put(createCheckpointMessage(self._journal_path, self._file_path,
+                                                                    mp.tell()))
+
+            if compactor is not None:
+                compactor.flush()
+
+    def __forwardBgpMessage(self, peer, as_number_size, time_stamp_seconds, raw_bgp_message):
+
+        per_peer_header = PEER_HEADER_CACHE.getPerPeerHeader(peer, time_stamp_seconds, 0, as_number_size)
+
+        common_header = BMP_Helper.createBmpCommonHeader(3, len(per_peer_header) + len(raw_bgp_message) + 6, 0)
+
+        # Put the message in the queue.
+        qm = common_header + per_peer_header + raw_bgp_message
+
+        self._forward_queue.put(qm)
 
     def __loadPeerIndexTable(self):
 
@@ -262,6 +775,8 @@ class UpdateProcessor():
             with open(path) as data_file:
                 self._peer_index_table = json.load(data_file)
 
+            self._peer_index = PeerIndex(self._peer_index_table['peer_list'])
+
         # Else, does not process the update file because there is no peer index table.
         else:
             self._isProcessable = False
@@ -271,7 +786,11 @@ class UpdateProcessor():
 
 class RouterProcessor:
 
-    def __init__(self, router_name, directory_path, forward_queue, log_queue, cfg):
+    def __init__(self, router_name, directory_path, forward_queue, log_queue, cfg, list_only=False):
+        """ Constructor
+
+            :param list_only:       Only list the files to process, the collector id is not read
+        """
 
         # Regex for directory pattern to look for (YYYY-MM)
         self._date_dir_regex = re.compile(r'[0-9]{4,4}\.[0-9]{2,2}')
@@ -290,6 +809,10 @@ class RouterProcessor:
         self._collector_id = None
         self._listOfRibAndUpdateFiles = []
 
+        # Open RIB file readers by file name, the PEER_INDEX_TABLE read for the collector id and peer
+        # messages is reused by the RibProcessor.
+        self._rib_readers = {}
+
         #self.working_dir = os.path.join(self._directory_path, self._router_name)
         self.working_dir = self._directory_path
         self.LOG.debug('Workdir set to %s', self.working_dir)
@@ -297,12 +820,27 @@ class RouterProcessor:
             self.working_dir = os.path.join(self._directory_path, self._router_name, 'bgpdata')
 
         self.__collectListOfRibandUpdateFiles()
-        self.__readCollectorId()
+
+        if not list_only:
+            self.__readCollectorId()
 
 
     def isToProcess(self):
         return self._isToProcess
 
+    def __isRibFile(self, file_name):
+        return file_name.find("rib.") != -1 or file_name.find("bview.") != -1
+
+    def __getRibFileReader(self, file_name):
+
+        if file_name not in self._rib_readers:
+            file_path = os.path.join(self.working_dir, file_name)
+
+            index = getIndex(file_path, build=False) if self._cfg.get('mrt_index') else None
+            self._rib_readers[file_name] = RibFileReader(file_path, index)
+
+        return self._rib_readers[file_name]
+
     def __collectListOfRibandUpdateFiles(self):
         self.LOG.debug("Using working dir %s" % self.working_dir)
         listOfUpdates = []
@@ -343,6 +881,9 @@ class RouterProcessor:
         sorting_list = []
 
         for i, f in enumerate(self._listOfRibAndUpdateFiles):
+            if f.endswith(IGNORED_FILE_SUFFIXES):
+                continue
+
             if "rib" in f or "bview" in f or "updates" in f:
                 # Parse date of the file.
                 tokens = f.split('.')
@@ -410,12 +951,11 @@ class RouterProcessor:
                 # If not, then read collector_id from the first rib file.
                 firstRIB = self._listOfRibAndUpdateFiles[0][1]
 
-                mp = MrtParser(os.path.join(self.working_dir, firstRIB))
-                for m in mp:
+                if self.__isRibFile(firstRIB):
+                    peer_index_table = self.__getRibFileReader(firstRIB).peer_index_table
 
-                    if m['mrt_header']['type'] == 13 and m['mrt_header']['subtype'] == 1:
-                        self._collector_id = m['mrt_entry']['collector_id']
-                        break
+                    if peer_index_table is not None:
+                        self._collector_id = peer_index_table.collector_id
 
     def getPeerMessages(self):
 
@@ -425,14 +965,12 @@ class RouterProcessor:
         path = os.path.join(self.working_dir, 'router_pit.json')
 
         first_file = self._listOfRibAndUpdateFiles[0][1]
-        if first_file.find("rib.") != -1 or first_file.find("bview.") != -1:
-            # If not, then read collector_id from the first rib file.
-            mp = MrtParser(os.path.join(self.working_dir, first_file))
-            for m in mp:
+        if self.__isRibFile(first_file):
+            # If not, then read peer list from the first rib file.
+            peer_index_table = self.__getRibFileReader(first_file).peer_index_table
 
-                if m['mrt_header']['type'] == 13 and m['mrt_header']['subtype'] == 1:
-                    peer_list = m['mrt_entry']['peer_list']
-                    break
+            if peer_index_table is not None:
+                peer_list = peer_index_table.peer_list
 
         elif os.path.isfile(path):
             with open(path) as data_file:
@@ -446,7 +984,7 @@ class RouterProcessor:
 
             if peer["bgp_id"] != "0.0.0.0":
 
-                qm = BMP_Helper.createPeerUpMessage(peer, self._collector_id)
+                qm = BMP_Helper.createPeerUpMessage(peer, self._collector_id, self._cfg.get('extended_messages', False))
 
                 return_list.append(qm)
 
@@ -530,38 +1068,168 @@ class RouterProcessor:
 
         return qm
 
-    def processRouteView(self, is_first_run):
+    def getListOfFiles(self):
+        """ Names of the RIB and update files to process, in order """
+        return [f[1] for f in self._listOfRibAndUpdateFiles] if self._isToProcess else []
 
-        if self._isToProcess:
+    def close(self):
+        """ Close the RIB files opened for their PEER_INDEX_TABLE and not processed """
+        for reader in self._rib_readers.values():
+            reader.close()
 
-            for f in self._listOfRibAndUpdateFiles:
+        self._rib_readers.clear()
 
-                self.LOG.info("-- %s is started" % f[1])
+    def processFile(self, file_name):
+        """ Convert a RIB or update file to BMP messages and delete it
 
-                if "rib" in f[1] or "bview" in f[1]:
+            :param file_name:   Name of the file in the working directory
+        """
+        journal = CheckpointJournal(os.path.join(self.working_dir, JOURNAL_FILE_NAME))
 
-                    rp = RibProcessor(f[1], self._directory_path, self._router_name, self._collector_id, self._fwd_queue, self._log_queue)
+        self.LOG.info("-- %s is started" % file_name)
+        start_time = time.monotonic()
 
-                    #if is_first_run:
-                    rp.processRibFile()
+        # Offset of the last checkpoint written to the collector if the file was processed before a restart.
+        start_offset = journal.getOffset(file_name)
+        if start_offset:
+            self.LOG.info("-- %s is resumed at offset %d" % (file_name, start_offset))
 
-                    self.LOG.debug('Delete RIB file: %s', os.path.join(self.working_dir, f[1]))
-                    #moveFileToTempDirectory(os.path.join(self.working_dir, f[1]), os.path.join(self._processed_directory_path, self._router_name, "RIBS"))
-                    deleteMrtFile(os.path.join(self.working_dir, f[1]))
+        if "rib" in file_name or "bview" in file_name:
 
-                elif "updates" in f[1]:
+            reader = self.__getRibFileReader(file_name)
+            rp = RibProcessor(file_name, self._directory_path, self._router_name, self._collector_id, self._fwd_queue,
+                              self._log_queue, reader, self._cfg, start_offset)
+            del self._rib_readers[file_name]
 
-                    try:
-                        up = UpdateProcessor(f[1], self._directory_path, self._router_name, self._collector_id, self._fwd_queue, self._log_queue)
-                        up.processUpdateFile()
-                    except:
-                        traceback.print_exc()
+            #if is_first_run:
+            rp.processRibFile()
+            reader.close()
 
-                    self.LOG.debug('Delete UPDATES file: %s', os.path.join(self.working_dir, f[1]))
-                    #moveFileToTempDirectory(os.path.join(self.working_dir, f[1]), os.path.join(self._processed_directory_path, self._router_name, "UPDATES"))
-                    deleteMrtFile(os.path.join(self.working_dir, f[1]))
+            self.LOG.debug('Delete RIB file: %s', os.path.join(self.working_dir, file_name))
+            #moveFileToTempDirectory(os.path.join(self.working_dir, file_name), os.path.join(self._processed_directory_path, self._router_name, "RIBS"))
+            deleteMrtFile(os.path.join(self.working_dir, file_name))
+            deleteMrtFile(getIndexPath(os.path.join(self.working_dir, file_name)))
 
-                self.LOG.info("-- %s is ended" % f[1])
+            METRICS.observe('file_processing_seconds', time.monotonic() - start_time, (('type', 'rib'),))
+
+        elif "updates" in file_name:
+
+            try:
+                up = UpdateProcessor(file_name, self._directory_path, self._router_name, self._collector_id, self._fwd_queue,
+                                     self._log_queue, self._cfg, start_offset)
+                up.processUpdateFile()
+            except:
+                traceback.print_exc()
+
+            self.LOG.debug('Delete UPDATES file: %s', os.path.join(self.working_dir, file_name))
+            #moveFileToTempDirectory(os.path.join(self.working_dir, file_name), os.path.join(self._processed_directory_path, self._router_name, "UPDATES"))
+            deleteMrtFile(os.path.join(self.working_dir, file_name))
+            deleteMrtFile(getIndexPath(os.path.join(self.working_dir, file_name)))
+
+            METRICS.observe('file_processing_seconds', time.monotonic() - start_time, (('type', 'updates'),))
+
+        METRICS.flush(True)
+
+        self.LOG.info("-- %s is ended" % file_name)
+
+    def __processInterleaved(self, rib_file_name):
+        """ Convert the RIB in slices between the records of the update files following it
+
+            Update files written while the RIB is converted are picked up between slices. Checkpoints are not
+            written and the update files are deleted with the RIB, a restart converts them again after the RIB.
+
+            :param rib_file_name:   Name of the RIB file, the first file of the list
+        """
+        self.LOG.info("-- %s is started, interleaved with update files" % rib_file_name)
+        start_time = time.monotonic()
+
+        cfg = dict(self._cfg, checkpoint_interval=0)
+
+        reader = self.__getRibFileReader(rib_file_name)
+        rp = RibProcessor(rib_file_name, self._directory_path, self._router_name, self._collector_id,
+                          self._fwd_queue, self._log_queue, reader, cfg)
+        del self._rib_readers[rib_file_name]
+
+        interleaver = RibInterleaver(rp, self._cfg.get('interleave_rib_records', 1000),
+                                     self._cfg.get('interleave_update_records', INTERLEAVE_UPDATE_RECORDS))
+        processed_files = []
+
+        while not interleaver.isDone():
+
+            self.__collectListOfRibandUpdateFiles()
+            update_files = [f for f in self.getListOfFiles() if not self.__isRibFile(f) and f not in processed_files]
+
+            # Continue with the RIB until update files are written.
+            if not update_files:
+                interleaver.convertSlice()
+                continue
+
+            for file_name in update_files:
+                if interleaver.isDone():
+                    break
+
+                self.LOG.info("-- %s is started" % file_name)
+                update_start_time = time.monotonic()
+
+                try:
+                    up = UpdateProcessor(file_name, self._directory_path, self._router_name, self._collector_id,
+                                         self._fwd_queue, self._log_queue, cfg, rib_interleaver=interleaver)
+                    up.processUpdateFile()
+                except:
+                    traceback.print_exc()
+
+                processed_files.append(file_name)
+
+                METRICS.observe('file_processing_seconds', time.monotonic() - update_start_time,
+                                (('type', 'updates'),))
+
+                self.LOG.info("-- %s is ended" % file_name)
+
+        reader.close()
+
+        for file_name in [rib_file_name] + processed_files:
+            self.LOG.debug('Delete file: %s', os.path.join(self.working_dir, file_name))
+            deleteMrtFile(os.path.join(self.working_dir, file_name))
+            deleteMrtFile(getIndexPath(os.path.join(self.working_dir, file_name)))
+
+        METRICS.observe('file_processing_seconds', time.monotonic() - start_time, (('type', 'rib'),))
+        METRICS.flush(True)
+
+        self.LOG.info("-- %s is ended" % rib_file_name)
+
+        # Update files written after the RIB was done, the next RIB is left to the next run.
+        self.__collectListOfRibandUpdateFiles()
+
+    def __isToInterleave(self, file_names):
+        """ True if the RIB at the start of the file list is interleaved with the update files following it
+
+            Delta mode RIBs and resumed RIBs are converted first.
+        """
+        if not self._cfg.get('interleave_rib', False) or self._cfg.get('rib_delta_mode', False):
+            return False
+
+        if not file_names or not self.__isRibFile(file_names[0]):
+            return False
+
+        journal = CheckpointJournal(os.path.join(self.working_dir, JOURNAL_FILE_NAME))
+
+        return journal.getOffset(file_names[0]) == 0
+
+    def processRouteView(self, is_first_run):
+
+        if self._isToProcess:
+
+            file_names = self.getListOfFiles()
+
+            if self.__isToInterleave(file_names):
+                self.__processInterleaved(file_names[0])
+                file_names = self.getListOfFiles()
+
+                if file_names and self.__isRibFile(file_names[0]):
+                    file_names = []
+
+            for file_name in file_names:
+                self.processFile(file_name)
 
         else:
             self.LOG.error("Data of %s cannot be processed..." % self._router_name)
@@ -613,6 +1281,19 @@ class RouteViewsProcessor(multiprocessing.Process):
 
             is_first_run = True
 
+            # RIB and update files are in the router data directory or in its bgpdata sub directory.
+            watch_dirs = [self._dir_path]
+            bgpdata_dir = os.path.join(self._dir_path, str(self.router_name), 'bgpdata')
+            if os.path.isdir(bgpdata_dir):
+                watch_dirs.append(bgpdata_dir)
+
+            # Pending RIB delta fingerprints of an earlier run whose messages may not have been written.
+            for watch_dir in watch_dirs:
+                discardPendingFingerprints(watch_dir)
+
+            watcher = createFileWatcher(watch_dirs, self._cfg_router.get('file_watcher', 'auto'))
+            self.LOG.debug("Watching %s with %s" % (watch_dirs, type(watcher).__name__))
+
             while not self.stopped():
 
                 if disabled:
@@ -625,7 +1306,7 @@ class RouteViewsProcessor(multiprocessing.Process):
                     rp = RouterProcessor(str(self.router_name), self._dir_path, self._fwd_queue, self._log_queue, self._cfg_router)
 
                     if self._collector_writer is None and rp.isToProcess():
-                        self._collector_writer = BMPWriter(self.cfg, self._fwd_queue, self._log_queue)
+                        self._collector_writer = createBMPWriter(self.cfg, self._fwd_queue, self._log_queue)
                         self._collector_writer.setInitialMessages(rp.getInitMessage(), rp.getPeerMessages(),
                                                                 rp.getTerminationMessage())
 
@@ -638,11 +1319,13 @@ class RouteViewsProcessor(multiprocessing.Process):
 
                         is_first_run = False
 
+                    rp.close()
+
                     self._sync_mutex.release()
 
-                # Waits for 30 seconds and runs the route views processor again.
-                self.LOG.debug('Nothing to do... Sleeping for 30 seconds... zZzZz')
-                time.sleep(30)
+                # Waits up to 30 seconds for new MRT files and runs the route views processor again.
+                self.LOG.debug('Nothing to do... Waiting up to 30 seconds for MRT files... zZzZz')
+                watcher.wait(30)
 
         except KeyboardInterrupt:
             self.LOG.info("- %s is ended" % str(self.router_name))
@@ -658,4 +1341,371 @@ class RouteViewsProcessor(multiprocessing.Process):
         self._stop.set()
 
     def stopped(self):
-        return self._stop.is_set()
\ No newline at end of file
+        return self._stop.is_set()
+
+
+class RouterWorker(multiprocessing.Process):
+    """ Worker process of MultiRouterProcessor converting one file of a router at a time
+
+        The forward queues are inherited when the worker is started, so it only converts files of the routers
+        known by then. Jobs are passed in the job queue of the worker and results in the result queue shared by
+        all workers: ('started', pid, router name, initial messages) once the job has read the PEER_INDEX_TABLE
+        or router_pit.json, and ('ended', pid, router name, None) once the file is converted.
+    """
+
+    def __init__(self, forward_queues, log_queue, cfg_router, result_queue):
+        """ Constructor
+
+            :param forward_queues:  Dictionary of router name to forward queue
+            :param log_queue:       Logging queue - sync logging
+            :param cfg_router:      Router data configuration dictionary
+            :param result_queue:    Queue of the job results
+        """
+        multiprocessing.Process.__init__(self)
+
+        self.forward_queues = dict(forward_queues)
+        self._log_queue = log_queue
+        self._cfg_router = cfg_router
+        self._job_queue = multiprocessing.Queue()
+        self._result_queue = result_queue
+
+        # RouterSession of the running job, only used by MultiRouterProcessor.
+        self.session = None
+
+    def startJob(self, router_name, directory_path, file_name):
+        self._job_queue.put((router_name, directory_path, file_name))
+
+    def retire(self):
+        """ End the worker once it is idle """
+        self._job_queue.put(None)
+
+    def __processFile(self, router_name, directory_path, file_name):
+        rp = RouterProcessor(router_name, directory_path, self.forward_queues[router_name], self._log_queue,
+                             self._cfg_router)
+
+        try:
+            self._result_queue.put(('started', os.getpid(), router_name,
+                                    (rp.getInitMessage(), rp.getPeerMessages(), rp.getTerminationMessage())))
+            rp.processFile(file_name)
+
+        finally:
+            rp.close()
+
+    def run(self):
+        """ Override """
+        while True:
+            job = self._job_queue.get()
+            if job is None:
+                break
+
+            try:
+                self.__processFile(*job)
+
+            except Exception:
+                traceback.print_exc()
+
+            self._result_queue.put(('ended', os.getpid(), job[0], None))
+
+
+class RouterSession():
+    """ Forward queue, BMP writer and running job of a router in multi-router mode """
+
+    def __init__(self, router_name, directory_path, forward_queue):
+        self.router_name = router_name
+        self.directory_path = directory_path
+        self.fwd_queue = forward_queue
+        self.collector_writer = None
+
+        # RouterWorker converting a file of the router and if it is a RIB file.
+        self.job = None
+        self.job_is_rib = False
+
+        # The next file is a RIB file waiting for a worker slot of RIB files.
+        self.waiting_for_rib_slot = False
+
+
+class MultiRouterProcessor(multiprocessing.Process):
+    """ Processes the routers found as sub directories of the master directory
+
+        Every router has its own forward queue and BMP writer, i.e. its own BMP session to the collector.
+        Files of all routers are converted by a pool of router_workers RouterWorker processes, one file per job,
+        and the files of a router in order. Routers are scheduled round-robin, and RIB files are limited to
+        router_workers - 1 jobs so a large RIB of one router does not hold back the update files of others.
+        A worker started before a router was added is replaced by a new one when it is idle.
+    """
+
+    def __init__(self, cfg, log_queue, manager, sync_mutex):
+        """ Constructor
+
+            :param cfg:             Configuration dictionary
+            :param log_queue:       Logging queue - sync logging
+            :param manager:         multiprocessing.Manager for forward queues of type 'manager'
+            :param sync_mutex:      Mutex held while files are scheduled
+        """
+        multiprocessing.Process.__init__(self)
+        self._stop = multiprocessing.Event()
+
+        self.cfg = cfg
+        self._cfg_router = cfg['router_data']
+        self._log_queue = log_queue
+        self._manager = manager
+        self._dir_path = self._cfg_router['master_directory_path']
+        self._sync_mutex = sync_mutex
+        self.LOG = None
+
+        self._workers = max(1, self._cfg_router.get('router_workers', 2))
+        self._max_rib_jobs = max(1, self._workers - 1)
+
+        # RouterSession by router name and index of the router scheduled first in the next round.
+        self._sessions = {}
+        self._next_router = 0
+
+        # Running RouterWorker processes and the queue of their job results, created in run().
+        self._router_workers = []
+        self._result_queue = None
+
+    def __discoverRouters(self):
+        """ Names of the router sub directories of the master directory """
+        return sorted(d for d in os.listdir(self._dir_path)
+                      if not d.startswith('.') and os.path.isdir(os.path.join(self._dir_path, d)))
+
+    def __addSession(self, router_name):
+
+        # RouterProcessor finds the files in <directory>/<router>/bgpdata, else in the directory itself.
+        directory_path = os.path.join(self._dir_path, router_name)
+        if os.path.isdir(os.path.join(self._dir_path, router_name, 'bgpdata')):
+            directory_path = self._dir_path
+            discardPendingFingerprints(os.path.join(self._dir_path, router_name, 'bgpdata'))
+        else:
+            discardPendingFingerprints(directory_path)
+
+        self._sessions[router_name] = RouterSession(router_name, directory_path,
+                                                    createForwardQueue(self._cfg_router, self._manager))
+
+        self.LOG.info("- %s is added" % router_name)
+
+    def __getWatchDirectories(self):
+        watch_dirs = [self._dir_path]
+
+        for session in self._sessions.values():
+            working_dir = os.path.join(session.directory_path, session.router_name, 'bgpdata')
+            watch_dirs.append(working_dir if os.path.isdir(working_dir) else session.directory_path)
+
+        return watch_dirs
+
+    def __reapJobs(self):
+        """ Handle the job results and workers that died
+
+            :return: True if a RIB job finished
+        """
+        rib_finished = False
+        workers = {w.pid: w for w in self._router_workers}
+
+        while True:
+            try:
+                result, pid, router_name, initial_messages = self._result_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            session = self._sessions[router_name]
+
+            if result == 'started':
+                if session.collector_writer is None:
+                    session.collector_writer = createBMPWriter(self.cfg, session.fwd_queue, self._log_queue)
+                    session.collector_writer.setInitialMessages(*initial_messages)
+                    session.collector_writer.start()
+
+                elif session.job_is_rib:
+                    # Peer UPs sent on a reconnect are from the RIB converted from now on.
+                    session.collector_writer.setInitialMessages(*initial_messages)
+
+            elif pid in workers and workers[pid].session is session:
+                rib_finished = rib_finished or session.job_is_rib
+                workers[pid].session = None
+                session.job = None
+
+        for worker in list(self._router_workers):
+            if not worker.is_alive():
+                worker.join()
+                self._router_workers.remove(worker)
+
+                if worker.session is not None:
+                    self.LOG.error("Worker converting a file of %s ended with exit code %d"
+                                   % (worker.session.router_name, worker.exitcode))
+
+                    rib_finished = rib_finished or worker.session.job_is_rib
+                    worker.session.job = None
+
+        return rib_finished
+
+    def __getWorker(self, router_name):
+        """ Idle worker for a job of the router, a new one is started if there is a free slot
+
+            :return: RouterWorker or None
+        """
+        idle_workers = [w for w in self._router_workers if w.session is None]
+
+        for worker in idle_workers:
+            if router_name in worker.forward_queues:
+                return worker
+
+        if idle_workers:
+            # Started before the router was added, it does not have its forward queue.
+            idle_workers[0].retire()
+            idle_workers[0].join()
+            self._router_workers.remove(idle_workers[0])
+
+        if len(self._router_workers) >= self._workers:
+            return None
+
+        worker = RouterWorker({s.router_name: s.fwd_queue for s in self._sessions.values()}, self._log_queue,
+                              self._cfg_router, self._result_queue)
+        worker.start()
+        self._router_workers.append(worker)
+
+        return worker
+
+    def __startJob(self, session, rib_slot_free):
+        """ Start a job for the next file of the router
+
+            :param session:         RouterSession of the router
+            :param rib_slot_free:   A RIB file may be started
+
+            :return: True if a job is started
+        """
+        # The PEER_INDEX_TABLE is read by the job, not here.
+        rp = RouterProcessor(session.router_name, session.directory_path, session.fwd_queue, self._log_queue,
+                             self._cfg_router, list_only=True)
+
+        files = rp.getListOfFiles()
+        if not files:
+            return False
+
+        file_name = files[0]
+        is_rib = "rib" in file_name or "bview" in file_name
+
+        if is_rib and not rib_slot_free:
+            session.waiting_for_rib_slot = True
+            return False
+
+        worker = self.__getWorker(session.router_name)
+        if worker is None:
+            return False
+
+        worker.session = session
+        worker.startJob(session.router_name, session.directory_path, file_name)
+
+        session.job = worker
+        session.job_is_rib = is_rib
+
+        return True
+
+    def __scheduleJobs(self):
+        """ Start jobs for idle routers in round-robin order while there are free workers """
+        sessions = list(self._sessions.values())
+        if not sessions:
+            return
+
+        self._next_router %= len(sessions)
+        sessions = sessions[self._next_router:] + sessions[:self._next_router]
+        self._next_router += 1
+
+        for session in sessions:
+            running = [s for s in self._sessions.values() if s.job is not None]
+
+            if len(running) >= self._workers:
+                break
+
+            rib_slot_free = sum(1 for s in running if s.job_is_rib) < self._max_rib_jobs
+
+            if session.job is None and (rib_slot_free or not session.waiting_for_rib_slot):
+                self.__startJob(session, rib_slot_free)
+
+    def run(self):
+        """ Override """
+        self.LOG = init_mp_logger("mrt_processors", self._log_queue)
+
+        if not os.path.isdir(self._dir_path):
+            self.LOG.error("%s is not a directory !" % self._dir_path)
+            sys.exit(2)
+
+        watcher = None
+        watch_dirs = None
+
+        try:
+            self.LOG.info("- Multi-router processing of %s is started" % self._dir_path)
+
+            self._result_queue = multiprocessing.Queue()
+
+            disabled = False
+            if 'DISABLED' in os.environ:
+                if os.environ.get('DISABLED').lower() == 'true':
+                    disabled = True
+
+            while not self.stopped():
+
+                self._sync_mutex.acquire()
+
+                for router_name in self.__discoverRouters():
+                    if router_name not in self._sessions:
+                        self.__addSession(router_name)
+
+                if self.__reapJobs():
+                    for session in self._sessions.values():
+                        session.waiting_for_rib_slot = False
+
+                if disabled:
+                    self.LOG.debug('MRT2BMP disabled. Cleaning up folders: %s', self.__getWatchDirectories())
+                    for d in self.__getWatchDirectories():
+                        cleanupMrtDir(d)
+                else:
+                    self.__scheduleJobs()
+
+                for session in self._sessions.values():
+                    METRICS.set('forward_queue_depth', session.fwd_queue.qsize(), (('router', session.router_name),))
+                METRICS.flush()
+
+                self._sync_mutex.release()
+
+                if watch_dirs != self.__getWatchDirectories():
+                    if watcher is not None:
+                        watcher.close()
+
+                    watch_dirs = self.__getWatchDirectories()
+                    watcher = createFileWatcher(watch_dirs, self._cfg_router.get('file_watcher', 'auto'))
+
+                # Check running jobs every second, else wait up to 30 seconds for MRT files or a stop.
+                timeout = 1 if any(s.job is not None for s in self._sessions.values()) else 30
+                while timeout > 0 and not self.stopped() and not watcher.wait(1):
+                    timeout -= 1
+
+        except KeyboardInterrupt:
+            pass
+
+        except:
+            print (sys.exc_info()[0])
+            traceback.print_exc()
+
+        # Jobs resume at their last checkpoint after a restart.
+        for worker in self._router_workers:
+            worker.terminate()
+            worker.join()
+
+        for session in self._sessions.values():
+            if session.collector_writer is not None:
+                session.collector_writer.stop()
+                session.collector_writer.join(5)
+
+            if hasattr(session.fwd_queue, 'unlink'):
+                session.fwd_queue.unlink()
+
+        if watcher is not None:
+            watcher.close()
+
+        self.LOG.info("- Multi-router processing of %s is ended" % self._dir_path)
+
+    def stop(self):
+        self._stop.set()
+
+    def stopped(self):
+        return self._stop.is_set()
@@ -0,0 +1,58 @@
+""" Replay pacing by MRT timestamps
+
+  Updates are emitted at the pace they were recorded, sped up by a factor. The emission time of a record is
+  computed from the first record of the replay and the monotonic clock, not from the previous record, so
+  sleep overshoots and processing time do not add up over a long file. The time until a record is due can
+  be used for other work, e.g. converting the RIB interleaved with the updates.
+"""
+import time
+
+from mrt2bmp.Metrics import METRICS
+
+
+class ReplayScheduler():
+    """ Waits until the MRT timestamp of a record is due """
+
+    def __init__(self, speed=1.0, idle=None):
+        """ Constructor
+
+            :param speed:       Replay speed factor, 1 for real time, 10 for ten times faster
+            :param idle:        Function called repeatedly while waiting for a record, returns False once it
+                                has nothing more to do
+        """
+        self._speed = float(speed)
+        self._idle = idle
+
+        # MRT timestamp and monotonic clock of the first record.
+        self._start_timestamp = None
+        self._start_time = None
+
+    def waitFor(self, timestamp):
+        """ Sleep until the record with the MRT timestamp is due
+
+            Records with a timestamp before the first one are due immediately.
+
+            :param timestamp:   MRT timestamp in seconds
+        """
+        now = time.monotonic()
+
+        if self._start_timestamp is None:
+            self._start_timestamp = timestamp
+            self._start_time = now
+            return
+
+        due_time = self._start_time + (timestamp - self._start_timestamp) / self._speed
+        delay = due_time - now
+
+        if delay > 0 and self._idle is not None:
+            while time.monotonic() < due_time and self._idle():
+                pass
+
+            delay = due_time - time.monotonic()
+
+        if delay > 0:
+            time.sleep(delay)
+            METRICS.set('replay_lag_seconds', 0)
+
+        else:
+            METRICS.set('replay_lag_seconds', -delay)
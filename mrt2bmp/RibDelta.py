@@ -0,0 +1,273 @@
+""" RIB delta mode
+
+  Keeps a fingerprint of the last converted RIB of a router: per (peer, RIB subtype) the hash of the path
+  attributes of every prefix. RIB entries of the next dump with the same hash are not converted, prefixes
+  of the last RIB missing in the next one are withdrawn in MP_UNREACH_NLRI. The first dump without a
+  fingerprint is converted in full.
+
+  Prefixes are numbered per RIB subtype, the routes of a peer are an array of 64 bit attribute hashes
+  indexed by prefix number with 0 for no route, so a route costs 8 bytes per peer.
+
+  The fingerprint of a dump is saved as a pending file and renamed to the fingerprint file by the BMP writer
+  once the messages of the dump are written, see createPromoteMessage(). The next dump of the same run is
+  compared to the latest pending fingerprint, as its messages are queued after the ones of that dump.
+  Pending fingerprints of an earlier run were not written and are discarded at start.
+"""
+import array
+import glob
+import hashlib
+import os
+import pickle
+import time
+
+from mrt2bmp.HelperClasses import BMP_Helper, BGP_MAX_MESSAGE_SIZE, BGP_WITHDRAW_OVERHEAD
+
+# Fingerprint file name in the router working directory, next to router_pit.json.
+FINGERPRINT_FILE_NAME = 'router_delta_fingerprint.pickle'
+
+# Suffix of pending fingerprint files, <fingerprint file>.<time in ns>.pending.
+PENDING_FINGERPRINT_SUFFIX = '.pending'
+FINGERPRINT_VERSION = 1
+
+# Max number of cached attribute hashes, the cache is cleared when it is full.
+ATTRIBUTE_HASH_CACHE_SIZE = 1000000
+
+# AFI/SAFI of the RIB subtypes.
+RIB_SUBTYPE_AFI_SAFI = {
+    2: (1, 1),      # RIB_IPV4_UNICAST
+    3: (1, 2),      # RIB_IPV4_MULTICAST
+    4: (2, 1),      # RIB_IPV6_UNICAST
+    5: (2, 2),      # RIB_IPV6_MULTICAST
+}
+
+
+def getPeerKey(peer):
+    """ Identity of a peer across peer index tables """
+    return peer['ip_address'], peer['asn'], peer['bgp_id']
+
+
+def getAttributeHash(raw_path_attributes, mp_reach_attribute):
+    """ Stable hash of the path attributes and MP_REACH_NLRI of a RIB entry, never 0 """
+    h = hashlib.blake2b(raw_path_attributes, digest_size=8)
+    h.update(mp_reach_attribute or b'')
+
+    return int.from_bytes(h.digest(), 'big') or 1
+
+
+def getPendingFingerprints(path):
+    """ Pending fingerprint files of the fingerprint file, oldest first """
+    return sorted(glob.glob(glob.escape(path) + '.*' + PENDING_FINGERPRINT_SUFFIX))
+
+
+def discardPendingFingerprints(directory):
+    """ Delete the pending fingerprints of an earlier run in the router working directory """
+    for pending_path in getPendingFingerprints(os.path.join(directory, FINGERPRINT_FILE_NAME)):
+        try:
+            os.remove(pending_path)
+        except OSError:
+            pass
+
+
+class RibDelta():
+    """ Filters the RIB entries of a dump to the changes against the fingerprint of the last dump """
+
+    def __init__(self, path, peer_index_table, reset_peers=()):
+        """ Constructor
+
+            :param path:                Fingerprint file
+            :param peer_index_table:    Peer list of the PEER_INDEX_TABLE of the dump
+            :param reset_peers:         Peers sent up or down before the dump, their routes are sent in full
+        """
+        self._path = path
+        self._peer_index_table = peer_index_table
+        self._peer_keys = [getPeerKey(peer) for peer in peer_index_table]
+        self._peers = dict(zip(self._peer_keys, peer_index_table))
+
+        # Prefixes by number and numbers by prefix per RIB subtype, shared by the last and the next dump.
+        self._prefixes = {}
+        self._prefix_ids = {}
+
+        # Attribute hashes by prefix number per (peer key, subtype) of the last and of the next dump.
+        self._old_routes = None
+        self._routes = {}
+
+        self._attribute_hashes = {}
+
+        self.__load()
+
+        if self._old_routes is not None:
+            for peer in reset_peers:
+                for subtype in RIB_SUBTYPE_AFI_SAFI:
+                    self._old_routes.pop((getPeerKey(peer), subtype), None)
+
+    def __load(self):
+        # The latest pending fingerprint is of the last dump, its messages are queued before the ones of this dump.
+        pending_paths = getPendingFingerprints(self._path)
+        path = pending_paths[-1] if pending_paths else self._path
+
+        try:
+            with open(path, 'rb') as f:
+                fingerprint = pickle.load(f)
+
+            if fingerprint.get('version') != FINGERPRINT_VERSION:
+                return
+
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+            return
+
+        self._prefixes = fingerprint['prefixes']
+        self._prefix_ids = {subtype: {prefix: i for i, prefix in enumerate(prefixes)}
+                            for subtype, prefixes in self._prefixes.items()}
+
+        self._old_routes = {}
+        for key, raw_routes in fingerprint['routes'].items():
+            routes = array.array('Q')
+            routes.frombytes(raw_routes)
+            self._old_routes[key] = routes
+
+    def isFirstDump(self):
+        """ True if there is no fingerprint, the dump is converted in full """
+        return self._old_routes is None
+
+    def filterRibRecord(self, m):
+        """ Record the routes of a RIB record in the fingerprint
+
+            :param m:       MrtEntry of an AFI/SAFI-specific RIB record
+
+            :return: List of RIB entries added or changed since the last dump
+        """
+        subtype = m.mrt_header.subtype
+        raw_prefix_nlri = m.mrt_entry.raw_prefix_nlri
+
+        prefix_ids = self._prefix_ids.setdefault(subtype, {})
+        prefix_id = prefix_ids.get(raw_prefix_nlri)
+
+        if prefix_id is None:
+            prefixes = self._prefixes.setdefault(subtype, [])
+            prefix_id = len(prefixes)
+            prefix_ids[raw_prefix_nlri] = prefix_id
+            prefixes.append(raw_prefix_nlri)
+
+        changed = []
+
+        for e in m.mrt_entry.rib_entries:
+
+            if e.peer_index >= len(self._peer_keys):
+                # Left to the bucket builder, which reports the unknown peer.
+                changed.append(e)
+                continue
+
+            key = (self._peer_keys[e.peer_index], subtype)
+
+            attributes = (e.raw_bgp_attributes, e.raw_mp_reach_nlri)
+            attribute_hash = self._attribute_hashes.get(attributes)
+
+            if attribute_hash is None:
+                if len(self._attribute_hashes) >= ATTRIBUTE_HASH_CACHE_SIZE:
+                    self._attribute_hashes.clear()
+
+                attribute_hash = getAttributeHash(*attributes)
+                self._attribute_hashes[attributes] = attribute_hash
+
+            routes = self._routes.get(key)
+            if routes is None:
+                routes = self._routes[key] = array.array('Q')
+
+            if len(routes) <= prefix_id:
+                routes.frombytes(bytes(routes.itemsize * (prefix_id + 1 - len(routes))))
+
+            # A prefix repeated in the dump is always sent, so the last route wins as in a full dump.
+            is_repeated = routes[prefix_id] != 0
+            routes[prefix_id] = attribute_hash
+
+            old_routes = self._old_routes.get(key) if self._old_routes is not None else None
+
+            if is_repeated or old_routes is None or prefix_id >= len(old_routes) or \
+                    old_routes[prefix_id] != attribute_hash:
+                changed.append(e)
+
+        return changed
+
+    def sendWithdrawals(self, forward_queue, max_message_size=BGP_MAX_MESSAGE_SIZE):
+        """ Put route monitoring messages withdrawing the routes of the last dump missing in the next one
+
+            Peers no longer in the peer index table are skipped, they were sent down.
+
+            :param forward_queue:       Output for BMP raw message forwarding
+            :param max_message_size:    Max BGP message size
+
+            :return: Number of withdrawn routes
+        """
+        if self._old_routes is None:
+            return 0
+
+        withdrawn = 0
+        max_prefixes_size = max_message_size - BGP_WITHDRAW_OVERHEAD
+
+        for (peer_key, subtype), old_routes in self._old_routes.items():
+
+            peer = self._peers.get(peer_key)
+            if peer is None or subtype not in RIB_SUBTYPE_AFI_SAFI:
+                continue
+
+            afi, safi = RIB_SUBTYPE_AFI_SAFI[subtype]
+            prefixes = self._prefixes[subtype]
+            routes = self._routes.get((peer_key, subtype), ())
+            raw_prefixes = bytearray()
+
+            for prefix_id, attribute_hash in enumerate(old_routes):
+
+                if attribute_hash and (prefix_id >= len(routes) or not routes[prefix_id]):
+                    raw_prefix = prefixes[prefix_id]
+
+                    if raw_prefixes and len(raw_prefixes) + len(raw_prefix) > max_prefixes_size:
+                        forward_queue.put(BMP_Helper.createRouteWithdrawMessage(peer, afi, safi, raw_prefixes))
+                        raw_prefixes = bytearray()
+
+                    raw_prefixes += raw_prefix
+                    withdrawn += 1
+
+            if raw_prefixes:
+                forward_queue.put(BMP_Helper.createRouteWithdrawMessage(peer, afi, safi, raw_prefixes))
+
+        return withdrawn
+
+    def save(self):
+        """ Save the routes of the dump as pending fingerprint for the next one
+
+            Prefixes without a route are dropped and the remaining ones renumbered. The fingerprint is written
+            to a temporary file renamed to the pending file, which is promoted to the fingerprint file once the
+            messages of the dump are written.
+
+            :return: Path of the pending fingerprint file
+        """
+        prefixes = {}
+        routes = {}
+
+        for subtype, subtype_prefixes in self._prefixes.items():
+            subtype_routes = {key: r for key, r in self._routes.items() if key[1] == subtype}
+
+            live = bytearray(len(subtype_prefixes))
+            for r in subtype_routes.values():
+                for prefix_id, attribute_hash in enumerate(r):
+                    if attribute_hash:
+                        live[prefix_id] = 1
+
+            prefixes[subtype] = [prefix for prefix, is_live in zip(subtype_prefixes, live) if is_live]
+
+            for key, r in subtype_routes.items():
+                r.frombytes(bytes(r.itemsize * (len(live) - len(r))))
+                routes[key] = array.array('Q', (h for h, is_live in zip(r, live) if is_live)).tobytes()
+
+        pending_path = '%s.%020d%s' % (self._path, time.time_ns(), PENDING_FINGERPRINT_SUFFIX)
+        tmp_path = pending_path + '.tmp'
+
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'version': FINGERPRINT_VERSION, 'prefixes': prefixes, 'routes': routes}, f,
+                        pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, pending_path)
+
+        return pending_path
@@ -0,0 +1,352 @@
+""" Compaction of BGP4MP updates
+
+  The UPDATEs of a window of MRT records, an update file or a number of seconds of MRT timestamps, are parsed
+  into routes and only the last state of every (peer, prefix) is kept: the path attributes of its last
+  announcement or its withdrawal. At the end of the window the routes are packed into full UPDATEs by peer and
+  path attributes, so a prefix flapping within the window is sent once.
+
+  Prefixes of IPv4/IPv6 unicast and multicast are compacted. Other BGP messages, UPDATEs of other address
+  families and malformed UPDATEs are forwarded as they are, after the routes of the peer recorded before them.
+"""
+import struct
+
+from mrt2bmp.HelperClasses import BGP_Helper, BMP_Helper, PEER_HEADER_CACHE, AttributeTable, BGP_MAX_MESSAGE_SIZE, \
+    BGP_UPDATE_OVERHEAD, BGP_WITHDRAW_OVERHEAD
+from mrt2bmp.Metrics import METRICS
+
+BGP_HEADER_STRUCT = struct.Struct('!16s H B')
+BGP_MSG_TYPE_UPDATE = 2
+BGP_MSG_TYPE_KEEPALIVE = 4
+
+# BGP header, withdrawn routes length and total path attribute length of an UPDATE.
+BGP_UPDATE_MIN_SIZE = 19 + 2 + 2
+
+ATTR_FLAG_EXTENDED_LENGTH = 0x10
+ATTR_TYPE_NEXT_HOP = 3
+ATTR_TYPE_MP_REACH_NLRI = 14
+ATTR_TYPE_MP_UNREACH_NLRI = 15
+
+MP_AFI_SAFI_STRUCT = struct.Struct('!H B')
+MP_REACH_NLRI_ATTR_HEADER_STRUCT = struct.Struct('!B B H')
+
+# Max prefix length by AFI of the compacted address families, SAFI unicast and multicast.
+MAX_PREFIX_LENGTH = {1: 32, 2: 128}
+COMPACTED_SAFIS = (1, 2)
+
+
+def parsePrefixes(buf, afi):
+    """ Split encoded NLRI into prefixes
+
+        :param buf:     Encoded prefixes
+        :param afi:     AFI of the prefixes
+
+        :return: List of encoded prefixes
+
+        :raises ValueError: Prefix length out of range or truncated prefix
+    """
+    max_length = MAX_PREFIX_LENGTH[afi]
+    prefixes = []
+    p = 0
+
+    while p < len(buf):
+        length = buf[p]
+        end = p + 1 + (length + 7) // 8
+
+        if length > max_length or end > len(buf):
+            raise ValueError("Invalid prefix at offset %d" % p)
+
+        prefixes.append(bytes(buf[p:end]))
+        p = end
+
+    return prefixes
+
+
+def checkAddressFamily(afi, safi):
+    """ :raises ValueError: Address family is not compacted """
+    if afi not in MAX_PREFIX_LENGTH or safi not in COMPACTED_SAFIS:
+        raise ValueError("AFI %d SAFI %d is not compacted" % (afi, safi))
+
+
+def parseUpdate(raw_bgp_message):
+    """ Routes of a BGP UPDATE message
+
+        :param raw_bgp_message:     BGP message with header
+
+        :return: List of (AFI, SAFI, encoded prefix, path attributes) in the order withdrawn routes, MP_UNREACH_NLRI,
+                 MP_REACH_NLRI, NLRI. Path attributes are a tuple of raw path attributes and the MP_REACH_NLRI value
+                 up to the NLRI (None for NLRI, the path attributes hold the NEXT_HOP), None for a withdrawal.
+                 None if the message is not an UPDATE, an empty list for a KEEPALIVE.
+
+        :raises ValueError: Malformed UPDATE or address family that is not compacted
+    """
+    buf = memoryview(raw_bgp_message)
+
+    if len(buf) < BGP_HEADER_STRUCT.size:
+        raise ValueError("Truncated BGP header")
+
+    marker, length, msg_type = BGP_HEADER_STRUCT.unpack_from(buf)
+
+    if msg_type == BGP_MSG_TYPE_KEEPALIVE:
+        return []
+
+    if msg_type != BGP_MSG_TYPE_UPDATE:
+        return None
+
+    if length < BGP_UPDATE_MIN_SIZE or length > len(buf):
+        raise ValueError("Invalid UPDATE length %d" % length)
+
+    buf = buf[:length]
+    p = BGP_HEADER_STRUCT.size
+
+    withdrawn_length = struct.unpack_from('!H', buf, p)[0]
+    p += 2
+    withdrawn_routes = buf[p:p + withdrawn_length]
+    p += withdrawn_length
+
+    if p + 2 > length:
+        raise ValueError("Truncated withdrawn routes")
+
+    attributes_length = struct.unpack_from('!H', buf, p)[0]
+    p += 2
+    attributes = buf[p:p + attributes_length]
+    p += attributes_length
+
+    if p > length:
+        raise ValueError("Truncated path attributes")
+
+    nlri = buf[p:]
+
+    # Split the MP attributes from the other path attributes.
+    mp_reach = None
+    mp_unreach = None
+    other_attributes = []
+    q = 0
+
+    while q < len(attributes):
+        if q + 3 > len(attributes):
+            raise ValueError("Truncated path attribute header")
+
+        flags, attr_type = attributes[q], attributes[q + 1]
+
+        if flags & ATTR_FLAG_EXTENDED_LENGTH:
+            if q + 4 > len(attributes):
+                raise ValueError("Truncated path attribute header")
+
+            attr_length = struct.unpack_from('!H', attributes, q + 2)[0]
+            header_length = 4
+        else:
+            attr_length = attributes[q + 2]
+            header_length = 3
+
+        end = q + header_length + attr_length
+        if end > len(attributes):
+            raise ValueError("Truncated path attribute %d" % attr_type)
+
+        if attr_type == ATTR_TYPE_MP_REACH_NLRI:
+            mp_reach = attributes[q + header_length:end]
+        elif attr_type == ATTR_TYPE_MP_UNREACH_NLRI:
+            mp_unreach = attributes[q + header_length:end]
+        else:
+            other_attributes.append((attr_type, attributes[q:end]))
+
+        q = end
+
+    routes = [(1, 1, prefix, None) for prefix in parsePrefixes(withdrawn_routes, 1)]
+
+    if mp_unreach is not None:
+        if len(mp_unreach) < MP_AFI_SAFI_STRUCT.size:
+            raise ValueError("Truncated MP_UNREACH_NLRI")
+
+        afi, safi = MP_AFI_SAFI_STRUCT.unpack_from(mp_unreach)
+        checkAddressFamily(afi, safi)
+
+        routes.extend((afi, safi, prefix, None)
+                      for prefix in parsePrefixes(mp_unreach[MP_AFI_SAFI_STRUCT.size:], afi))
+
+    if mp_reach is not None:
+        if len(mp_reach) < MP_AFI_SAFI_STRUCT.size + 1:
+            raise ValueError("Truncated MP_REACH_NLRI")
+
+        afi, safi = MP_AFI_SAFI_STRUCT.unpack_from(mp_reach)
+        checkAddressFamily(afi, safi)
+
+        # AFI, SAFI, next hop length, next hop and reserved byte.
+        nlri_offset = MP_AFI_SAFI_STRUCT.size + 1 + mp_reach[MP_AFI_SAFI_STRUCT.size] + 1
+        if nlri_offset > len(mp_reach):
+            raise ValueError("Truncated MP_REACH_NLRI next hop")
+
+        # The NEXT_HOP attribute only applies to the NLRI.
+        path_attributes = (b''.join(raw for attr_type, raw in other_attributes if attr_type != ATTR_TYPE_NEXT_HOP),
+                           bytes(mp_reach[:nlri_offset]))
+
+        routes.extend((afi, safi, prefix, path_attributes)
+                      for prefix in parsePrefixes(mp_reach[nlri_offset:], afi))
+
+    if nlri:
+        path_attributes = (b''.join(raw for attr_type, raw in other_attributes), None)
+
+        routes.extend((1, 1, prefix, path_attributes) for prefix in parsePrefixes(nlri, 1))
+
+    return routes
+
+
+class UpdateCompactor():
+    """ Keeps the last state of every (peer, prefix) of the UPDATEs of a window """
+
+    def __init__(self, forward_queue, max_message_size=BGP_MAX_MESSAGE_SIZE):
+        """ Constructor
+
+            :param forward_queue:       Output for BMP raw message forwarding
+            :param max_message_size:    Max BGP message size of the packed UPDATEs
+        """
+        self._forward_queue = forward_queue
+        self._max_message_size = max_message_size
+
+        # Last state by (peer key, AFI, SAFI, prefix): tuple of peer, AS number size, MRT timestamp and
+        # attribute table entry, None for a withdrawal.
+        self._routes = {}
+        self._attribute_table = AttributeTable()
+
+    def __len__(self):
+        return len(self._routes)
+
+    def addUpdate(self, peer, as_number_size, timestamp, raw_bgp_message):
+        """ Record the routes of a BGP message
+
+            :param peer:                Peer dictionary of the peer index table
+            :param as_number_size:      AS number size of the AS_PATH, 2 for BGP4MP_MESSAGE
+            :param timestamp:           MRT timestamp of the message
+            :param raw_bgp_message:     BGP message with header
+
+            :return: False if the message is not compacted, the routes of the peer recorded so far are sent and
+                     the caller forwards the message
+        """
+        peer_key = (peer['ip_address'], peer['asn'], peer['bgp_id'])
+
+        try:
+            routes = parseUpdate(raw_bgp_message)
+        except ValueError:
+            routes = None
+
+        if routes is None:
+            self.flush(peer_key)
+            return False
+        superseded = 0
+
+        for afi, safi, raw_prefix, path_attributes in routes:
+
+            if path_attributes is not None:
+                path_attributes = self._attribute_table.intern(*path_attributes)
+
+            key = (peer_key, afi, safi, raw_prefix)
+
+            if key in self._routes:
+                superseded += 1
+
+            self._routes[key] = (peer, as_number_size, timestamp, path_attributes)
+
+        if superseded:
+            METRICS.inc('update_compaction_superseded_routes_total', superseded)
+
+        return True
+
+    def flush(self, peer_key=None):
+        """ Send the routes recorded so far in UPDATEs packed by peer and path attributes
+
+            :param peer_key:        Only send the routes of the peer with the (IP address, ASN, BGP ID)
+        """
+        if peer_key is None:
+            routes = self._routes
+            self._routes = {}
+
+        else:
+            routes = {key: route for key, route in self._routes.items() if key[0] == peer_key}
+
+            for key in routes:
+                del self._routes[key]
+
+        if not self._routes:
+            self._attribute_table.clear()
+
+        # Prefixes and latest timestamp by peer, AS number size, address family and path attributes.
+        groups = {}
+
+        for (peer_key, afi, safi, raw_prefix), (peer, as_number_size, timestamp, path_attributes) in routes.items():
+
+            group_key = (peer_key, as_number_size, afi, safi,
+                         path_attributes[0] if path_attributes is not None else None)
+
+            group = groups.get(group_key)
+            if group is None:
+                group = groups[group_key] = [peer, path_attributes, timestamp, []]
+
+            group[2] = max(group[2], timestamp)
+            group[3].append(raw_prefix)
+
+        for (peer_key, as_number_size, afi, safi, attribute_id), (peer, path_attributes, timestamp, prefixes) in \
+                groups.items():
+
+            per_peer_header = bytes(PEER_HEADER_CACHE.getPerPeerHeader(peer, timestamp, 0, as_number_size))
+
+            self.__sendRoutes(per_peer_header, afi, safi, path_attributes, prefixes)
+
+    def __sendRoutes(self, per_peer_header, afi, safi, path_attributes, prefixes):
+        """ Put route monitoring messages with the prefixes, split at the max message size """
+        if path_attributes is None:
+            max_prefixes_size = self._max_message_size - BGP_UPDATE_MIN_SIZE if (afi, safi) == (1, 1) \
+                else self._max_message_size - BGP_WITHDRAW_OVERHEAD
+
+        else:
+            attribute_id, raw_path_attributes, mp_reach_attribute = path_attributes
+            max_prefixes_size = self._max_message_size - BGP_UPDATE_OVERHEAD - len(raw_path_attributes) - \
+                len(mp_reach_attribute or b'')
+
+        raw_prefixes = bytearray()
+
+        for raw_prefix in prefixes:
+            if raw_prefixes and len(raw_prefixes) + len(raw_prefix) > max_prefixes_size:
+                self.__sendMessage(per_peer_header, afi, safi, path_attributes, bytes(raw_prefixes))
+                raw_prefixes = bytearray()
+
+            raw_prefixes += raw_prefix
+
+        if raw_prefixes:
+            self.__sendMessage(per_peer_header, afi, safi, path_attributes, bytes(raw_prefixes))
+
+    def __sendMessage(self, per_peer_header, afi, safi, path_attributes, raw_prefixes):
+
+        if path_attributes is None:
+            if (afi, safi) == (1, 1):
+                bgp_update = BGP_Helper.createBgpUpdateMessage(raw_prefixes, b'', b'')
+
+            else:
+                # b'10010000' as big endian = 144, optional and extended length.
+                mp_unreach_attribute = MP_AFI_SAFI_STRUCT.pack(afi, safi) + raw_prefixes
+                bgp_update = BGP_Helper.createBgpUpdateMessage(
+                    b'', MP_REACH_NLRI_ATTR_HEADER_STRUCT.pack(144, ATTR_TYPE_MP_UNREACH_NLRI,
+                                                               len(mp_unreach_attribute)) + mp_unreach_attribute, b'')
+
+            bgp_message = BGP_Helper.createBgpHeader(len(bgp_update), BGP_MSG_TYPE_UPDATE) + bgp_update
+            self.__putMessage(per_peer_header, bgp_message)
+            return
+
+        attribute_id, raw_path_attributes, mp_reach_attribute = path_attributes
+
+        if mp_reach_attribute is None:
+            bgp_update = BGP_Helper.createBgpUpdateMessage(b'', raw_path_attributes, raw_prefixes)
+
+        else:
+            mp_reach_length = len(mp_reach_attribute) + len(raw_prefixes)
+            bgp_update = BGP_Helper.createBgpUpdateMessage(
+                b'', raw_path_attributes + MP_REACH_NLRI_ATTR_HEADER_STRUCT.pack(144, ATTR_TYPE_MP_REACH_NLRI,
+                                                                                mp_reach_length) +
+                mp_reach_attribute + raw_prefixes, b'')
+
+        bgp_message = BGP_Helper.createBgpHeader(len(bgp_update), BGP_MSG_TYPE_UPDATE) + bgp_update
+        self.__putMessage(per_peer_header, bgp_message)
+
+    def __putMessage(self, per_peer_header, bgp_message):
+
+        common_header = BMP_Helper.createBmpCommonHeader(3, len(per_peer_header) + len(bgp_message) + 6, 0)
+
+        self._forward_queue.put(common_header + per_peer_header + bgp_message)
@@ -0,0 +1,220 @@
+""" Helpers of the tests: MRT files of a router and the routes of the BMP messages converted from them """
+import os
+import queue
+import socket
+import struct
+
+import mrt_generator
+
+from mrt2bmp.Checkpoint import isCheckpointMessage
+from mrt2bmp.MrtProcessors import RouterProcessor
+
+ROUTER_NAME = 'test_router'
+RIB_FILE_NAME = 'rib.2020-04-17.09:54:48.mrt'
+UPDATES_FILE_NAME = 'updates.2020-04-17.10:00:00.mrt'
+
+ROUTER_CFG = {'timestamp_interval_limit': 20, 'ignore_timestamp_interval_abnormality': True,
+              'max_queue_size': 10000}
+
+BMP_ROUTE_MONITORING = 0
+BGP_UPDATE = 2
+MP_REACH_NLRI = 14
+MP_UNREACH_NLRI = 15
+
+
+class ListQueue(list):
+    """ Forward queue keeping the messages """
+
+    def put(self, qm, block=True, timeout=None):
+        self.append(bytes(qm))
+
+    def qsize(self):
+        return len(self)
+
+
+def writeRouterFiles(directory, rib=True, updates=0, prefixes=2000, compression=None, seed=1):
+    """ Write a RIB and optionally an update file to the router directory
+
+        :return: List of the file names
+    """
+    suffix = {None: '', 'gz': '.gz', 'bz2': '.bz2'}[compression]
+    file_names = []
+
+    if rib:
+        file_names.append(RIB_FILE_NAME + suffix)
+        mrt_generator.generateRib(os.path.join(directory, file_names[-1]), prefixes, peers=8,
+                                  attribute_sets=50, seed=seed, compression=compression)
+
+    if updates:
+        file_names.append(UPDATES_FILE_NAME + suffix)
+        mrt_generator.generateUpdates(os.path.join(directory, file_names[-1]), updates, peers=8, prefix_pool=500,
+                                      seed=seed + 1, compression=compression)
+
+    return file_names
+
+
+def processRouter(directory, cfg=None, forward_queue=None):
+    """ Convert the files of the router directory
+
+        :return: List of the BMP messages put into the forward queue
+    """
+    router_cfg = dict(ROUTER_CFG, **(cfg or {}))
+    forward_queue = forward_queue if forward_queue is not None else ListQueue()
+
+    rp = RouterProcessor(ROUTER_NAME, directory, forward_queue, queue.Queue(), router_cfg)
+    rp.processRouteView(True)
+    rp.close()
+
+    return forward_queue
+
+
+def splitPrefixes(data):
+    prefixes = []
+    pos = 0
+
+    while pos < len(data):
+        length = (data[pos] + 7) // 8 + 1
+        prefixes.append(bytes(data[pos:pos + length]))
+        pos += length
+
+    return prefixes
+
+
+def splitAttributes(data):
+    """ Dictionary of type code to value of the path attributes """
+    attributes = {}
+    pos = 0
+
+    while pos < len(data):
+        flag, type_code = data[pos], data[pos + 1]
+
+        if flag & 0x10:
+            length = struct.unpack_from('!H', data, pos + 2)[0]
+            pos += 4
+        else:
+            length = data[pos + 2]
+            pos += 3
+
+        attributes[type_code] = bytes(data[pos:pos + length])
+        pos += length
+
+    return attributes
+
+
+def decodeRoutes(messages):
+    """ Announcements and withdrawals of the BMP route monitoring messages, in order, checkpoint messages are skipped
+
+        :return: List of (peer address, AFI, prefix, attributes or None for a withdrawal), the attributes
+                 are a dictionary without MP_REACH_NLRI and with the next hop under type code 3
+    """
+    routes = []
+
+    for m in messages:
+        if isCheckpointMessage(m):
+            continue
+
+        version, length, msg_type = struct.unpack_from('!B I B', m)
+        assert version == 3 and length == len(m)
+
+        if msg_type != BMP_ROUTE_MONITORING:
+            continue
+
+        peer = socket.inet_ntop(socket.AF_INET6, m[16:32])
+        bgp = m[48:]
+        bgp_length, bgp_type = struct.unpack_from('!H B', bgp, 16)
+        assert bgp[:16] == b'\xff' * 16 and bgp_length == len(bgp)
+
+        if bgp_type != BGP_UPDATE:
+            continue
+
+        withdrawn_length = struct.unpack_from('!H', bgp, 19)[0]
+        withdrawn = bgp[21:21 + withdrawn_length]
+        attributes_length = struct.unpack_from('!H', bgp, 21 + withdrawn_length)[0]
+        attributes = splitAttributes(bgp[23 + withdrawn_length:23 + withdrawn_length + attributes_length])
+        nlri = bgp[23 + withdrawn_length + attributes_length:]
+
+        routes.extend((peer, 1, prefix, None) for prefix in splitPrefixes(withdrawn))
+
+        mp_reach = attributes.pop(MP_REACH_NLRI, None)
+        mp_unreach = attributes.pop(MP_UNREACH_NLRI, None)
+
+        routes.extend((peer, 1, prefix, attributes) for prefix in splitPrefixes(nlri))
+
+        if mp_reach is not None:
+            afi, safi, next_hop_length = struct.unpack_from('!H B B', mp_reach)
+            mp_attributes = dict(attributes)
+            mp_attributes[3] = mp_reach[4:4 + next_hop_length]
+            routes.extend((peer, afi, prefix, mp_attributes)
+                          for prefix in splitPrefixes(mp_reach[5 + next_hop_length:]))
+
+        if mp_unreach is not None:
+            afi = struct.unpack_from('!H', mp_unreach)[0]
+            routes.extend((peer, afi, prefix, None) for prefix in splitPrefixes(mp_unreach[3:]))
+
+    return routes
+
+
+def getRouteState(messages):
+    """ Routes after applying the BMP messages in order
+
+        :return: Dictionary of (peer address, AFI, prefix) to the attributes
+    """
+    state = {}
+
+    for peer, afi, prefix, attributes in decodeRoutes(messages):
+        if attributes is None:
+            state.pop((peer, afi, prefix), None)
+        else:
+            state[(peer, afi, prefix)] = attributes
+
+    return state
+
+
+def readRibRoutes(file_path):
+    """ Routes of an uncompressed TABLE_DUMP_V2 RIB file, read without mrt2bmp
+
+        :return: Dictionary of (peer address, AFI, prefix) to the attributes as returned by decodeRoutes()
+    """
+    with open(file_path, 'rb') as f:
+        data = f.read()
+
+    peers = []
+    routes = {}
+    pos = 0
+
+    while pos < len(data):
+        timestamp, msg_type, subtype, length = struct.unpack_from('!I H H I', data, pos)
+        body = data[pos + 12:pos + 12 + length]
+        pos += 12 + length
+
+        if subtype == mrt_generator.PEER_INDEX_TABLE:
+            view_name_length = struct.unpack_from('!H', body, 4)[0]
+            peer_count = struct.unpack_from('!H', body, 6 + view_name_length)[0]
+            peer_pos = 8 + view_name_length
+
+            for _ in range(peer_count):
+                peer_type = body[peer_pos]
+                address_length = 16 if peer_type & 1 else 4
+                address = body[peer_pos + 5:peer_pos + 5 + address_length].rjust(16, b'\0')
+                peers.append(socket.inet_ntop(socket.AF_INET6, address))
+                peer_pos += 5 + address_length + (4 if peer_type & 2 else 2)
+
+            continue
+
+        afi = 2 if subtype == mrt_generator.RIB_IPV6_UNICAST else 1
+        prefix_length = (body[4] + 7) // 8 + 1
+        prefix = body[4:4 + prefix_length]
+        entry_pos = 4 + prefix_length + 2
+
+        while entry_pos < len(body):
+            peer_index, originated, attributes_length = struct.unpack_from('!H I H', body, entry_pos)
+            attributes = splitAttributes(body[entry_pos + 8:entry_pos + 8 + attributes_length])
+            entry_pos += 8 + attributes_length
+
+            # RIB entries only hold the next hop in MP_REACH_NLRI.
+            if MP_REACH_NLRI in attributes:
+                attributes[3] = attributes.pop(MP_REACH_NLRI)[1:]
+
+            routes[(peers[peer_index], afi, prefix)] = attributes
+
+    return routes
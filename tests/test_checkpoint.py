@@ -0,0 +1,76 @@
+import os
+
+from mrt2bmp.Checkpoint import CheckpointJournal, JOURNAL_FILE_NAME, isCheckpointMessage, parseCheckpointMessage
+
+from bmp_routes import writeRouterFiles, processRouter, RIB_FILE_NAME, UPDATES_FILE_NAME
+
+CHECKPOINT_CFG = {'checkpoint_interval': 300}
+
+
+def resumeAtCheckpoint(tmp_path, file_name, cfg=None):
+    """ Convert the file with checkpoints, then again resumed at a checkpoint in the middle
+
+        :return: Tuple of the BMP messages queued after the checkpoint and of the resumed conversion
+    """
+    source_dir = tmp_path / 'source'
+    source_dir.mkdir()
+    writeRouterFiles(str(source_dir), updates=2000)
+
+    router_dir = tmp_path / 'router'
+    router_dir.mkdir()
+
+    # The RIB writes router_pit.json for the update file.
+    if file_name != RIB_FILE_NAME:
+        os.link(str(source_dir / RIB_FILE_NAME), str(router_dir / RIB_FILE_NAME))
+        processRouter(str(router_dir))
+
+    os.link(str(source_dir / file_name), str(router_dir / file_name))
+    messages = processRouter(str(router_dir), dict(CHECKPOINT_CFG, **(cfg or {})))
+
+    positions = [i for i, m in enumerate(messages) if isCheckpointMessage(m)]
+    assert len(positions) > 2
+
+    # The writer saves a checkpoint once the messages before it are written.
+    position = positions[len(positions) // 2]
+    checkpoint = parseCheckpointMessage(messages[position])
+    assert checkpoint['journal'] == str(router_dir / JOURNAL_FILE_NAME)
+    assert checkpoint['file'] == file_name
+
+    CheckpointJournal(checkpoint['journal']).save(checkpoint['file'], checkpoint['offset'])
+
+    os.link(str(source_dir / file_name), str(router_dir / file_name))
+    resumed = processRouter(str(router_dir), dict(CHECKPOINT_CFG, **(cfg or {})))
+
+    return ([m for m in messages[position + 1:] if not isCheckpointMessage(m)],
+            [m for m in resumed if not isCheckpointMessage(m)])
+
+
+def test_checkpoint_resume_rib(tmp_path):
+    expected, resumed = resumeAtCheckpoint(tmp_path, RIB_FILE_NAME)
+
+    assert resumed == expected
+
+
+def test_checkpoint_resume_rib_pool(tmp_path):
+    expected, resumed = resumeAtCheckpoint(tmp_path, RIB_FILE_NAME, {'rib_workers': 2, 'rib_chunk_records': 100})
+
+    assert resumed == expected
+
+
+def test_checkpoint_resume_updates(tmp_path):
+    expected, resumed = resumeAtCheckpoint(tmp_path, UPDATES_FILE_NAME)
+
+    assert resumed == expected
+
+
+def test_checkpoint_journal(tmp_path):
+    journal = CheckpointJournal(str(tmp_path / JOURNAL_FILE_NAME))
+    assert journal.load() is None
+
+    journal.save(RIB_FILE_NAME, 1234)
+
+    assert journal.getOffset(RIB_FILE_NAME) == 1234
+    assert journal.getOffset(UPDATES_FILE_NAME) == 0
+
+    (tmp_path / JOURNAL_FILE_NAME).write_text('{"file": ')
+    assert journal.getOffset(RIB_FILE_NAME) == 0
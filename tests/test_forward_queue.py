@@ -0,0 +1,61 @@
+import multiprocessing
+import queue
+
+import pytest
+
+from mrt2bmp.ForwardQueue import SharedMemoryQueue
+
+
+@pytest.fixture
+def ring():
+    forward_queue = SharedMemoryQueue(100)
+    yield forward_queue
+    forward_queue.unlink()
+
+
+def createMessage(i):
+    return bytes([i % 256]) * (1 + i % 37)
+
+
+def putMessages(forward_queue, count):
+    for i in range(count):
+        forward_queue.put(createMessage(i))
+
+
+def test_shared_memory_queue_wraparound(ring):
+    # Frames of odd sizes wrap around the end of the ring at varying offsets.
+    for i in range(500):
+        ring.put(createMessage(i))
+        ring.put(createMessage(i + 1))
+
+        assert ring.get() == createMessage(i)
+        assert ring.get() == createMessage(i + 1)
+
+    assert ring.empty() and ring.bytesUsed() == 0
+
+
+def test_shared_memory_queue_full(ring):
+    with pytest.raises(ValueError):
+        ring.put(b'x' * 100)
+
+    ring.put(b'x' * 60)
+
+    with pytest.raises(queue.Full):
+        ring.put_nowait(b'y' * 60)
+
+    assert ring.get() == b'x' * 60
+
+    with pytest.raises(queue.Empty):
+        ring.get_nowait()
+
+
+def test_shared_memory_queue_processes(ring):
+    producer = multiprocessing.Process(target=putMessages, args=(ring, 2000))
+    producer.start()
+
+    # The producer blocks while the ring is full.
+    messages = [ring.get(True, 10) for _ in range(2000)]
+    producer.join()
+
+    assert messages == [createMessage(i) for i in range(2000)]
+    assert producer.exitcode == 0
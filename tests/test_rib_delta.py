@@ -0,0 +1,114 @@
+import os
+import struct
+
+import mrt_generator
+
+from mrt2bmp.Checkpoint import isCheckpointMessage, parseCheckpointMessage, promoteFile
+from mrt2bmp.RibDelta import FINGERPRINT_FILE_NAME, discardPendingFingerprints, getPendingFingerprints
+
+from bmp_routes import writeRouterFiles, processRouter, decodeRoutes, getRouteState, readRibRoutes, RIB_FILE_NAME
+
+NEXT_RIB_FILE_NAME = 'rib.2020-04-17.11:54:48.mrt'
+
+DELTA_CFG = {'rib_delta_mode': True}
+
+
+def writeRouters(tmp_path):
+    source_dir = tmp_path / 'source'
+    source_dir.mkdir()
+    writeRouterFiles(str(source_dir))
+
+    router_dir = tmp_path / 'router'
+    router_dir.mkdir()
+
+    return source_dir, router_dir
+
+
+def dropPrefixes(source_path, path, every=10):
+    """ Write the RIB without every n-th prefix """
+    with open(source_path, 'rb') as f:
+        data = f.read()
+
+    records = []
+    pos = 0
+    rib_records = 0
+
+    while pos < len(data):
+        subtype, length = struct.unpack_from('!H I', data, pos + 6)
+        record = data[pos:pos + 12 + length]
+        pos += 12 + length
+
+        if subtype != mrt_generator.PEER_INDEX_TABLE:
+            rib_records += 1
+            if rib_records % every == 0:
+                continue
+
+        records.append(record)
+
+    with open(path, 'wb') as f:
+        f.write(b''.join(records))
+
+
+def promoteFiles(messages):
+    """ Promote the pending files as the BMP writer does once the messages are written
+
+        :return: BMP messages without the checkpoint messages
+    """
+    for m in messages:
+        if isCheckpointMessage(m):
+            checkpoint = parseCheckpointMessage(m)
+            promoteFile(checkpoint['promote'], checkpoint['path'])
+
+    return [m for m in messages if not isCheckpointMessage(m)]
+
+
+def test_rib_delta_withdraw(tmp_path):
+    source_dir, router_dir = writeRouters(tmp_path)
+    os.link(str(source_dir / RIB_FILE_NAME), str(router_dir / RIB_FILE_NAME))
+    dropPrefixes(str(source_dir / RIB_FILE_NAME), str(source_dir / NEXT_RIB_FILE_NAME))
+
+    first = promoteFiles(processRouter(str(router_dir), DELTA_CFG))
+    assert getRouteState(first) == readRibRoutes(str(source_dir / RIB_FILE_NAME))
+
+    os.link(str(source_dir / NEXT_RIB_FILE_NAME), str(router_dir / NEXT_RIB_FILE_NAME))
+    second = promoteFiles(processRouter(str(router_dir), DELTA_CFG))
+
+    # Unchanged routes are skipped, the dropped prefixes are withdrawn.
+    routes = decodeRoutes(second)
+    assert routes and all(attributes is None for peer, afi, prefix, attributes in routes)
+    assert getRouteState(first + second) == readRibRoutes(str(source_dir / NEXT_RIB_FILE_NAME))
+
+    # The same dump again has no changes.
+    os.link(str(source_dir / NEXT_RIB_FILE_NAME), str(router_dir / RIB_FILE_NAME))
+    assert not decodeRoutes(promoteFiles(processRouter(str(router_dir), DELTA_CFG)))
+
+
+def test_rib_delta_saved_after_write(tmp_path):
+    source_dir, router_dir = writeRouters(tmp_path)
+    os.link(str(source_dir / RIB_FILE_NAME), str(router_dir / RIB_FILE_NAME))
+    fingerprint_path = str(router_dir / FINGERPRINT_FILE_NAME)
+
+    messages = processRouter(str(router_dir), DELTA_CFG)
+
+    # The fingerprint is pending until the messages before the promote message are written.
+    assert not os.path.exists(fingerprint_path)
+    assert len(getPendingFingerprints(fingerprint_path)) == 1
+    assert isCheckpointMessage(messages[-1])
+
+    promoteFiles(messages)
+
+    assert os.path.exists(fingerprint_path)
+    assert not getPendingFingerprints(fingerprint_path)
+
+
+def test_rib_delta_pending_discarded(tmp_path):
+    source_dir, router_dir = writeRouters(tmp_path)
+    os.link(str(source_dir / RIB_FILE_NAME), str(router_dir / RIB_FILE_NAME))
+    first = processRouter(str(router_dir), DELTA_CFG)
+
+    # The messages of the first dump were not written before the restart, the next dump is sent in full.
+    discardPendingFingerprints(str(router_dir))
+    os.link(str(source_dir / RIB_FILE_NAME), str(router_dir / NEXT_RIB_FILE_NAME))
+    second = processRouter(str(router_dir), DELTA_CFG)
+
+    assert len(decodeRoutes(second)) == len(decodeRoutes(first))
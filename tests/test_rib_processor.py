@@ -0,0 +1,65 @@
+import os
+
+from mrt2bmp.Metrics import METRICS, initMetrics
+from mrt2bmp.MrtProcessors import getRibPoolContext
+
+from bmp_routes import writeRouterFiles, processRouter, getRouteState, readRibRoutes, RIB_FILE_NAME
+
+
+def readRib(tmp_path):
+    source_dir = tmp_path / 'source'
+    source_dir.mkdir()
+    writeRouterFiles(str(source_dir))
+
+    return readRibRoutes(str(source_dir / RIB_FILE_NAME))
+
+
+def test_rib_round_trip(tmp_path):
+    expected = readRib(tmp_path)
+    writeRouterFiles(str(tmp_path))
+
+    messages = processRouter(str(tmp_path))
+
+    assert getRouteState(messages) == expected
+    assert not os.path.exists(str(tmp_path / RIB_FILE_NAME))
+
+
+def test_rib_round_trip_compressed(tmp_path):
+    expected = readRib(tmp_path)
+    writeRouterFiles(str(tmp_path), compression='gz')
+
+    assert getRouteState(processRouter(str(tmp_path))) == expected
+
+
+def test_rib_round_trip_pool(tmp_path):
+    expected = readRib(tmp_path)
+    writeRouterFiles(str(tmp_path))
+
+    messages = processRouter(str(tmp_path), {'rib_workers': 2, 'rib_chunk_records': 300})
+
+    assert getRouteState(messages) == expected
+
+
+def test_rib_pool_with_metrics(tmp_path):
+    expected = readRib(tmp_path)
+    writeRouterFiles(str(tmp_path))
+
+    metrics_queue = getRibPoolContext().Queue()
+    initMetrics(metrics_queue)
+
+    try:
+        messages = processRouter(str(tmp_path), {'rib_workers': 2, 'rib_chunk_records': 300})
+        METRICS.flush(True)
+
+    finally:
+        METRICS.setQueue(None)
+
+    assert getRouteState(messages) == expected
+
+    # Workers count the RIB records they parse.
+    records = 0
+    while not metrics_queue.empty():
+        counters, gauges = metrics_queue.get(True, 1)
+        records += sum(value for (name, labels), value in counters.items() if name == 'mrt_records_total')
+
+    assert records >= len({prefix for peer, afi, prefix in expected})
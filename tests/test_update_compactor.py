@@ -0,0 +1,32 @@
+from bmp_routes import writeRouterFiles, processRouter, decodeRoutes, getRouteState
+
+
+def processUpdates(directory, cfg=None):
+    writeRouterFiles(str(directory), updates=2000)
+
+    return processRouter(str(directory), cfg)
+
+
+def test_update_compaction_final_state(tmp_path):
+    (tmp_path / 'plain').mkdir()
+    (tmp_path / 'compacted').mkdir()
+
+    messages = processUpdates(tmp_path / 'plain')
+    compacted = processUpdates(tmp_path / 'compacted', {'update_compaction': True})
+
+    # The routes end up the same, flapping prefixes of the file are sent once.
+    assert getRouteState(compacted) == getRouteState(messages)
+    assert len(decodeRoutes(compacted)) < len(decodeRoutes(messages))
+
+
+def test_update_compaction_window(tmp_path):
+    (tmp_path / 'plain').mkdir()
+    (tmp_path / 'file').mkdir()
+    (tmp_path / 'window').mkdir()
+
+    messages = processUpdates(tmp_path / 'plain')
+    compacted = processUpdates(tmp_path / 'file', {'update_compaction': True})
+    windowed = processUpdates(tmp_path / 'window', {'update_compaction': True, 'update_compaction_window': 5})
+
+    assert getRouteState(windowed) == getRouteState(messages)
+    assert len(decodeRoutes(compacted)) < len(decodeRoutes(windowed)) < len(decodeRoutes(messages))